@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmark of the report renderer, for testbeds of growing sizes
+
+Each scenario renders the html and plain-text reports for a synthetic
+testbed - a tenth of the nodes failed, all come with phase durations
+and week-over-week trends - first into a string, the way nightly does,
+then streamed into /dev/null.
+
+We report the time per node, that should not grow with the size,
+and the peak memory while streaming; from the smallest size to the
+largest, that peak should only grow by a small fraction of what the
+document grows, as only the node ids get sorted on the way.
+Exits with 1 if either check fails, so this can be used
+as a regression check.
+
+Examples:
+    bench-mail.py
+    bench-mail.py -n 1000 10000 100000 -r 3
+"""
+
+# pylint: disable=c0111
+
+import os
+import time
+import random
+import tracemalloc
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+from nightmail import (
+    TIMING_COLUMNS, complete_html, complete_text, write_html, write_text)
+from nightrun import Reason
+
+
+SCENARIOS = [100, 1000, 4000, 16000]
+
+
+def synthetic(nb_nodes, seed=0):
+    """
+    the arguments to the renderers, for that many nodes
+    """
+    rng = random.Random(seed)
+    node_ids = list(range(1, nb_nodes + 1))
+    nodenames = [f"fit{node_id:02d}" for node_id in node_ids]
+    failures = {node_id: rng.choice(list(Reason))
+                for node_id in rng.sample(node_ids, nb_nodes // 10)}
+    durations = {node_id: {phase: rng.uniform(2, 200) for phase in TIMING_COLUMNS}
+                 for node_id in node_ids}
+    trends = {node_id: ((7, rng.randrange(3), rng.uniform(250, 350)),
+                        (7, rng.randrange(3), rng.uniform(250, 350)))
+              for node_id in node_ids}
+    return (nodenames, failures, (), None, (), durations, trends)
+
+
+def run_one(nb_nodes, repeat):
+    report = synthetic(nb_nodes)
+    best = float('inf')
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        size = len(complete_html(*report)) + len(complete_text(*report))
+        best = min(best, time.perf_counter() - begin)
+    with open(os.devnull, 'w') as sink:
+        tracemalloc.start()
+        write_html(sink.write, *report)
+        write_text(sink.write, *report)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return best, size, peak
+
+
+def main():
+    parser = ArgumentParser(description=__doc__,
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--nodes", type=int, nargs='+', default=SCENARIOS,
+                        help="testbed sizes (default: %(default)s)")
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+                        help="renders per size, the best one is kept")
+    parser.add_argument("--max-growth", type=float, default=2.,
+                        help="max ratio between the time per node of the largest"
+                        " and of the smallest size (%(default)s)")
+    parser.add_argument("--max-memory", type=float, default=.05,
+                        help="max growth of the streaming peak memory,"
+                        " as a fraction of the document growth (%(default)s)")
+    args = parser.parse_args()
+
+    per_node, sizes, peaks = [], [], []
+    print(f"{'nodes':>7} {'time':>8} {'per node':>9} {'document':>10}"
+          f" {'stream peak':>12}")
+    for nb_nodes in sorted(args.nodes):
+        elapsed, size, peak = run_one(nb_nodes, args.repeat)
+        per_node.append(elapsed / nb_nodes)
+        sizes.append(size)
+        peaks.append(peak)
+        print(f"{nb_nodes:>7} {elapsed*1000:>6.1f}ms {per_node[-1]*1e6:>7.1f}us"
+              f" {size/1024:>8.0f}Ki {peak/1024:>10.0f}Ki")
+    failed = (per_node[-1] > args.max_growth * min(per_node)
+              or peaks[-1] - peaks[0] > args.max_memory * (sizes[-1] - sizes[0]))
+    if failed:
+        print("REGRESSION: rendering is not linear, or streaming holds too much")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+"""
+End-to-end benchmark of the nightly engine, against simulated testbeds
+
+Each scenario is a full nightly run against a simulated testbed of
+a given size - see nightsim.py - in a fresh interpreter; failures and
+latencies are drawn from a fixed seed, so runs can be compared
+from one version of the code to the next.
+
+For each scenario we report wall-clock time, CPU, peak memory and
+event-loop lag, overall and per stage; use -d for the per-phase details.
+
+Examples:
+    bench-nightly.py
+    bench-nightly.py -n 37 400 --time-scale .05 -d
+    bench-nightly.py --save results.json
+"""
+
+# pylint: disable=c0111
+
+import sys
+import json
+import tempfile
+import subprocess
+from pathlib import Path
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+from nightsim import add_simulation_arguments, simulation_argv, report
+
+
+SCENARIOS = [37, 400, 2000]
+
+
+def run_one(nb_nodes, argv):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output = Path(tmpdir) / "metrics.json"
+        # the nightly output itself is of no interest here
+        subprocess.run(
+            [sys.executable, "nightsim.py", "--nodes", str(nb_nodes),
+             "--json", str(output)] + argv,
+            cwd=Path(__file__).parent, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, check=True)
+        return json.loads(output.read_text())
+
+
+def main():
+    parser = ArgumentParser(description=__doc__,
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--nodes", type=int, nargs='+', default=SCENARIOS,
+                        help="testbed sizes (default: %(default)s)")
+    parser.add_argument("-d", "--details", action='store_true', default=False,
+                        help="show per-stage and per-phase metrics")
+    parser.add_argument("--save", default=None,
+                        help="store all metrics in that json file")
+    add_simulation_arguments(parser)
+    args = parser.parse_args()
+    # passed along to nightsim.py
+    argv = simulation_argv(args)
+
+    results = []
+    print(f"{'nodes':>6} {'wall':>8} {'cpu':>8} {'maxrss':>8}"
+          f" {'lag-p99':>8} {'lag-max':>8} {'ok':>6} {'failed':>6} {'incompl':>7}")
+    for nb_nodes in args.nodes:
+        result = run_one(nb_nodes, argv)
+        results.append(result)
+        print(f"{nb_nodes:>6} {result['wall']:>7.1f}s {result['cpu']:>7.1f}s"
+              f" {result['maxrss']:>5.0f}MiB"
+              f" {result['lag_p99']*1000:>6.1f}ms {result['lag_max']*1000:>6.1f}ms"
+              f" {result['completed']:>6} {result['failures']:>6}"
+              f" {result['incomplete']:>7}", flush=True)
+    if args.details:
+        for result in results:
+            print(report(result))
+    if args.save:
+        with open(args.save, 'w') as output:
+            json.dump(dict(argv=argv, results=results), output, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+"""
+Startup benchmark for the hourly invocation of nightly.py
+
+In the common cases where we do not hold the nightly lease
+(either somebody else does, or nobody at all), nightly.py should
+exit quickly and without loading the heavy parts (asyncssh, apssh,
+asynciojobs, the rhubarbe loading stack, ...).
+
+Each scenario runs in a fresh interpreter, with the lease check
+stubbed out so no network is involved; we measure wall-clock time
+and peak memory, and check which heavy modules got imported.
+Exits with 1 if any threshold is exceeded, so this can be used
+as a regression check.
+
+Examples:
+    bench-startup.py
+    bench-startup.py -r 10 --max-time 0.5 --max-rss 60
+"""
+
+# pylint: disable=c0111
+
+import sys
+import json
+import time
+import tempfile
+import subprocess
+from pathlib import Path
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+
+# none of these should be loaded unless we own the testbed
+HEAVY_MODULES = [
+    'asyncssh', 'apssh', 'asynciojobs', 'aiohttp', 'websockets',
+    'r2lab', 'rhubarbe.node', 'rhubarbe.imageloader', 'rhubarbe.display',
+    'nightrun',
+]
+
+# what runs in the child interpreter; %r's are scenario and history
+CHILD = """
+import sys, time, json, resource
+begin = time.perf_counter()
+import nightly
+owner = {'not-ours': False, 'nobody': None}[%r]
+nightly.current_owner = lambda: (owner, None)
+nightly.turn_all_off = lambda *args: None
+sys.argv = ['nightly.py', '--history', %r, '1-37']
+retcod = nightly.main()
+elapsed = time.perf_counter() - begin
+print(json.dumps(dict(
+    retcod=retcod, elapsed=elapsed,
+    maxrss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    modules=sorted(sys.modules))))
+"""
+
+SCENARIOS = ['not-ours', 'nobody']
+
+
+def run_one(scenario, history):
+    begin = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-c", CHILD % (scenario, history)],
+        cwd=Path(__file__).parent, capture_output=True, text=True, check=True)
+    wall = time.perf_counter() - begin
+    # the last line is ours
+    result = json.loads(completed.stdout.strip().split("\n")[-1])
+    result['wall'] = wall
+    return result
+
+
+def main():
+    parser = ArgumentParser(description=__doc__,
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+                        help="runs per scenario, the best one is kept")
+    parser.add_argument("--max-time", type=float, default=.5,
+                        help="max process wall-clock time in s (%(default)s)")
+    parser.add_argument("--max-rss", type=float, default=40.,
+                        help="max peak memory in MiB (%(default)s)")
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmpdir:
+        history = str(Path(tmpdir) / "history.sqlite")
+        print(f"{'scenario':>10} {'wall':>7} {'in-py':>7} {'rss':>8}  heavy modules")
+        for scenario in SCENARIOS:
+            results = [run_one(scenario, history) for _ in range(args.repeat)]
+            best = min(results, key=lambda result: result['wall'])
+            rss = best['maxrss'] / 1024
+            heavy = [module for module in HEAVY_MODULES
+                     if module in best['modules']]
+            print(f"{scenario:>10} {best['wall']:>6.3f}s {best['elapsed']:>6.3f}s"
+                  f" {rss:>6.1f}Mi  {' '.join(heavy) or '-'}")
+            if heavy or best['wall'] > args.max_time or rss > args.max_rss:
+                failed = True
+    if failed:
+        print("REGRESSION: thresholds exceeded or heavy modules loaded")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -5,6 +5,19 @@ Book leases for the nightly routine on faraday.inria.fr.
 Searches for matching weekdays in a date range and creates a lease
 for each on the specified time slot. All times are local (DST-aware).
 
+The leases already in the range are fetched once beforehand; slots that
+the slice already holds are skipped, so running this again is a no-op,
+and slots that overlap somebody else's lease are reported as conflicts.
+The others are booked concurrently, over one pool of connections, with
+a few attempts each; the outcome is shown slot by slot.
+
+With --plan, the time slot is no longer fixed: for each day, the slot
+of the same length is searched for within a window of preferred hours,
+among the free time left by the other leases; the best one wastes the
+least free time in leftovers too short to be of any use, and then is
+the closest to the given time slot. Days where the slice already has
+a lease in the window keep it.
+
 The slice name defaults to r2lab-nightly, matching what nightly.py expects.
 
 Examples:
@@ -19,22 +32,43 @@ Examples:
 
     # dry-run to see what would be booked
     book-nightly.py --today -n
+
+    # a whole year, every day
+    book-nightly.py -u 2027-10-31 -D -j 16
+
+    # wed+sun, 1 hour anywhere between 01:00 and 07:00, ideally at 04:10
+    book-nightly.py --plan
+    book-nightly.py --plan 22:00-23:59 -t 23:00-23:30 -n
 """
 
 import re
 import sys
+import math
+import time
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 from datetime import date as Date, datetime as DateTime, timedelta as TimeDelta
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from rhubarbe.config import Config
-from rhubarbe.r2labapiproxy import R2labApiProxy
+from rhubarbe.r2labapiproxy import R2labApiProxy, iso_to_epoch
 
 
 ALL_WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
 DEFAULT_WEEKDAYS = "wed,sun"
 DEFAULT_TIME = "04:10-05:10"
+# how many leases to create at the same time
+DEFAULT_PARALLELISM = 8
+# for each lease, how many requests, and how long to wait in between
+ATTEMPTS = 3
+BACKOFF = 1.
+# with --plan, the preferred hours
+DEFAULT_WINDOW = "01:00-07:00"
+# free time shorter than that, between two leases, is of no use to anybody
+MIN_USEFUL = 3600
 
 
 def parse_time_slot(time_str):
@@ -84,29 +118,266 @@ def get_resource_name():
     return config.value('r2labapi', 'resource_name')
 
 
-def book_one_lease(proxy, slicename, resource, day, time_slot, dry_run, verbose):
+def matching_days(from_, until, days):
+    result = []
+    day = from_
+    while day <= until:
+        if f"{day:%a}".lower() in days:
+            result.append(day)
+        day += TimeDelta(days=1)
+    return result
+
+
+def requested_slots(days_in_range, time_slot):
+    """
+    the slots to book, as a list of (day, t_from, t_until)
+    with t_from and t_until as ISO strings
+    """
     (h1, m1), (h2, m2) = time_slot
-    t_from = local_iso(day, h1, m1)
-    t_until = local_iso(day, h2, m2)
-    label = f"{day:%a} {day} {h1:02d}:{m1:02d}-{h2:02d}:{m2:02d}"
+    return [(day, local_iso(day, h1, m1), local_iso(day, h2, m2))
+            for day in days_in_range]
 
-    if dry_run:
-        print(f"  would book {label}")
-        return
-    if verbose:
-        print(f"  booking {label}")
 
-    try:
-        data = proxy.create_lease({
-            "slice_name": slicename,
-            "resource_name": resource,
-            "t_from": t_from,
-            "t_until": t_until,
-        })
-        if verbose:
-            print(f"    -> lease id={data['id']}")
-    except requests.HTTPError as exc:
-        print(f"  ERROR {exc.response.status_code}: {exc.response.text}")
+def slot_label(slot):
+    day, t_from, t_until = slot
+    return f"{day:%a} {day} {t_from[11:16]}-{t_until[11:16]}"
+
+
+class LeaseIndex:
+    """
+    the leases on one resource, sorted, for fast overlap and gap queries;
+    each lease gets its bounds as epochs in 'from' and 'until'; leases on
+    one resource do not overlap, so their ends are sorted as well
+    """
+
+    def __init__(self, leases):
+        for lease in leases:
+            lease['from'] = iso_to_epoch(lease['t_from'])
+            lease['until'] = iso_to_epoch(lease['t_until'])
+        self.leases = sorted(leases, key=lambda lease: lease['from'])
+        self.ends = [lease['until'] for lease in self.leases]
+
+    def __len__(self):
+        return len(self.leases)
+
+    def overlapping(self, t_from, t_until):
+        """
+        the leases that overlap [t_from, t_until[, in epochs
+        """
+        result = []
+        for index in range(bisect_right(self.ends, t_from), len(self.leases)):
+            lease = self.leases[index]
+            if lease['from'] >= t_until:
+                break
+            result.append(lease)
+        return result
+
+    def gaps(self, t_from, t_until):
+        """
+        the free intervals within [t_from, t_until[, as (start, end) tuples
+        """
+        result, start = [], t_from
+        for lease in self.overlapping(t_from, t_until):
+            if lease['from'] > start:
+                result.append((start, lease['from']))
+            start = max(start, lease['until'])
+        if start < t_until:
+            result.append((start, t_until))
+        return result
+
+
+def fetch_leases(proxy, resource_id, after, before):
+    """
+    all the leases on the resource between after and before, ISO strings,
+    as a LeaseIndex
+    """
+    return LeaseIndex([lease for lease in proxy.get_leases(
+        resource_id=resource_id, after=after, before=before)
+                       if lease['resource_id'] == resource_id])
+
+
+def describe_leases(leases):
+    return ", ".join(
+        f"{lease['slice_name']} {DateTime.fromtimestamp(lease['from']):%H:%M}"
+        f"-{DateTime.fromtimestamp(lease['until']):%H:%M}"
+        for lease in leases)
+
+
+def diff_slots(slots, index, slicename):
+    """
+    returns a dict slot -> (outcome, detail) for the slots that
+    need not or cannot be booked, and the list of the slots to book
+    """
+    outcomes, todo = {}, []
+    for slot in slots:
+        _, t_from, t_until = slot
+        t_from, t_until = iso_to_epoch(t_from), iso_to_epoch(t_until)
+        found = index.overlapping(t_from, t_until)
+        ours = [lease for lease in found if lease['slice_name'] == slicename
+                and lease['from'] <= t_from and lease['until'] >= t_until]
+        if ours:
+            outcomes[slot] = ('already booked', f"id={ours[0]['id']}")
+        elif found:
+            outcomes[slot] = ('conflict', describe_leases(found))
+        else:
+            todo.append(slot)
+    return outcomes, todo
+
+
+def epoch_iso(epoch):
+    return DateTime.fromtimestamp(epoch).astimezone().isoformat()
+
+
+def best_slot(index, window, length, target,           # pylint: disable=r0913
+              granularity, slicename):
+    """
+    the best [start, end[ of length seconds within window, a pair of
+    epochs, and as close as possible to target; or None if there is no room
+
+    among the possible slots in each free interval - at either end,
+    or at the target - the best one leaves the least free time in
+    leftovers shorter than MIN_USEFUL, and then is the closest to target
+    """
+    w_from, w_until = window
+    # keep what we have, or we would end up with two leases on that day
+    for lease in index.overlapping(w_from, w_until):
+        if (lease['slice_name'] == slicename and lease['from'] >= w_from
+                and lease['until'] <= w_until
+                and lease['until'] - lease['from'] >= length):
+            return lease['from'], lease['until']
+    best = None
+    # the free time just outside the window counts for the leftovers
+    for g_from, g_until in index.gaps(w_from - MIN_USEFUL, w_until + MIN_USEFUL):
+        lowest = math.ceil(max(g_from, w_from) / granularity) * granularity
+        highest = (math.floor((min(g_until, w_until) - length) / granularity)
+                   * granularity)
+        if highest < lowest:
+            continue
+        aimed = min(max(round(target / granularity) * granularity, lowest), highest)
+        for start in {lowest, highest, aimed}:
+            wasted = sum(piece for piece in (start - g_from,
+                                             g_until - start - length)
+                         if 0 < piece < MIN_USEFUL)
+            score = (wasted, abs(start - target), start)
+            if best is None or score < best:
+                best = score
+    if best is None:
+        return None
+    start = best[-1]
+    return start, start + length
+
+
+def plan_slots(index, days_in_range, window, time_slot,  # pylint: disable=r0913
+               granularity, slicename):
+    """
+    for each of the days, the best slot within the local window - see
+    best_slot() - of the length of time_slot, and close to its start;
+    DST is taken care of, as bounds are computed day by day, like in
+    requested_slots()
+    returns a list of slots that can be booked as is, and a dict
+    slot -> (outcome, detail) for the days where there was no room,
+    where the slot is then the window itself
+    """
+    (wh1, wm1), (wh2, wm2) = window
+    (h1, m1), (h2, m2) = time_slot
+    length = (h2 * 60 + m2 - h1 * 60 - m1) * 60
+    slots, outcomes = [], {}
+    for day in days_in_range:
+        w_from = iso_to_epoch(local_iso(day, wh1, wm1))
+        w_until = iso_to_epoch(local_iso(day, wh2, wm2))
+        target = iso_to_epoch(local_iso(day, h1, m1))
+        found = best_slot(index, (w_from, w_until), length, target,
+                          granularity, slicename)
+        if found is None:
+            slot = (day, epoch_iso(w_from), epoch_iso(w_until))
+            outcomes[slot] = ('no room', describe_leases(
+                index.overlapping(w_from, w_until)))
+        else:
+            slot = (day, epoch_iso(found[0]), epoch_iso(found[1]))
+        slots.append(slot)
+    return slots, outcomes
+
+
+def pooled_proxy(parallelism):
+    """
+    an authenticated proxy, whose session keeps up to parallelism
+    connections open, so that concurrent bookings reuse them
+    """
+    proxy = get_proxy()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=parallelism)
+    proxy.session.mount('http://', adapter)
+    proxy.session.mount('https://', adapter)
+    # once and for all, not in each thread
+    proxy.ensure_authenticated()
+    return proxy
+
+
+def find_lease(proxy, slicename, resource_id, slot):
+    """
+    the lease of the slice on exactly that slot, if any
+    """
+    _, t_from, t_until = slot
+    for lease in proxy.get_leases(resource_id=resource_id,
+                                  after=t_from, before=t_until):
+        if (lease['slice_name'] == slicename
+                and iso_to_epoch(lease['t_from']) == iso_to_epoch(t_from)
+                and iso_to_epoch(lease['t_until']) == iso_to_epoch(t_until)):
+            return lease
+    return None
+
+
+def book_slot(proxy, slicename, resource, resource_id, slot):  # pylint: disable=r0913
+    """
+    create the lease for one slot, with retries on transient errors
+    returns a tuple (outcome, detail)
+    """
+    _, t_from, t_until = slot
+    error = None
+    for attempt in range(1, ATTEMPTS+1):
+        try:
+            data = proxy.create_lease({
+                "slice_name": slicename,
+                "resource_name": resource,
+                "t_from": t_from,
+                "t_until": t_until,
+            })
+            return 'booked', f"id={data['id']}"
+        except requests.HTTPError as exc:
+            code = exc.response.status_code
+            error = f"{code}: {exc.response.text.strip()}"
+            # no point in insisting
+            if code < 500 and code != 429:
+                return 'failed', error
+        except requests.RequestException as exc:
+            error = f"{type(exc).__name__} {exc}"
+        # the lease may have been created even though we got no answer
+        try:
+            lease = find_lease(proxy, slicename, resource_id, slot)
+            if lease:
+                return 'booked', f"id={lease['id']}"
+        except requests.RequestException:
+            pass
+        if attempt < ATTEMPTS:
+            time.sleep(BACKOFF * attempt)
+    return 'failed', error
+
+
+def book_slots(proxy, slicename, resource, resource_id,  # pylint: disable=r0913
+               slots, parallelism, verbose):
+    """
+    book all slots concurrently; returns a dict slot -> (outcome, detail)
+    """
+    outcomes = {}
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        futures = {executor.submit(book_slot, proxy, slicename, resource,
+                                   resource_id, slot): slot
+                   for slot in slots}
+        for future in as_completed(futures):
+            slot = futures[future]
+            outcomes[slot] = future.result()
+            if verbose:
+                print(f"  {slot_label(slot)}: {' '.join(outcomes[slot])}")
+    return outcomes
 
 
 def main():
@@ -136,11 +407,19 @@ def main():
     slot.add_argument(
         "-t", "--time", dest="time", default=DEFAULT_TIME,
         help="local time slot as HH:MM-HH:MM or H-H (default: %(default)s)")
+    slot.add_argument(
+        "-P", "--plan", metavar="WINDOW", nargs='?', const=DEFAULT_WINDOW,
+        default=None,
+        help="look for the best free slot of the same length as --time,"
+        f" within WINDOW (default: {DEFAULT_WINDOW}), and close to --time")
 
     misc = parser.add_argument_group("misc")
     misc.add_argument(
         "-s", "--slice", dest="slice", default="r2lab-nightly",
         help="slice name (default: %(default)s)")
+    misc.add_argument(
+        "-j", "--parallel", type=int, default=DEFAULT_PARALLELISM,
+        help="how many leases to create at the same time (default: %(default)s)")
     misc.add_argument("-n", "--dry-run", dest="dry_run", action='store_true')
     misc.add_argument("-v", "--verbose", dest="verbose", action='store_true')
 
@@ -163,27 +442,57 @@ def main():
 
     # rhubarbe config
     resource = get_resource_name()
-    proxy = None if dry_run else get_proxy()
 
     (h1, m1), (h2, m2) = time_slot
     print(f"slice {slicename} on {resource},"
           f" {h1:02d}:{m1:02d}-{h2:02d}:{m2:02d},"
+          f"{f' planned within {args.plan},' if args.plan else ''}"
           f" {from_} to {until}, days={','.join(days)}"
           f"{' (dry-run)' if dry_run else ''}")
 
-    count = 0
-    day = from_
-    while day <= until:
-        if f"{day:%a}".lower() in days:
-            book_one_lease(
-                proxy, slicename, resource, day, time_slot, dry_run, verbose)
-            count += 1
-        elif verbose:
-            print(f"  skipping {day:%a} {day}")
-        day += TimeDelta(days=1)
+    days_in_range = matching_days(from_, until, days)
+    if not days_in_range:
+        print("no matching day in range")
+        return 0
+    started = time.time()
+    proxy = pooled_proxy(args.parallel) if not dry_run else get_proxy()
+    info = proxy.get_resource_by_name(resource)
+    resource_id = info['id']
+    # with a margin, for the leftovers in plan mode
+    index = fetch_leases(proxy, resource_id,
+                         local_iso(from_ - TimeDelta(days=1), 0, 0),
+                         local_iso(until + TimeDelta(days=2), 0, 0))
+    if args.plan:
+        slots, missing = plan_slots(
+            index, days_in_range, parse_time_slot(args.plan), time_slot,
+            info.get('granularity') or 60, slicename)
+        outcomes, todo = diff_slots([slot for slot in slots if slot not in missing],
+                                    index, slicename)
+        outcomes.update(missing)
+    else:
+        slots = requested_slots(days_in_range, time_slot)
+        outcomes, todo = diff_slots(slots, index, slicename)
+    if verbose:
+        print(f"  {len(index)} lease(s) in range,"
+              f" {len(todo)}/{len(slots)} slot(s) to book"
+              f" - in {time.time() - started:.2f}s")
+
+    if dry_run:
+        outcomes.update({slot: ('would book', '') for slot in todo})
+    else:
+        outcomes.update(book_slots(proxy, slicename, resource, resource_id,
+                                   todo, args.parallel, verbose))
 
-    print(f"{'would book' if dry_run else 'booked'} {count} lease(s)")
+    counts = {}
+    for slot in slots:
+        outcome, detail = outcomes[slot]
+        counts[outcome] = counts.get(outcome, 0) + 1
+        print(f"  {slot_label(slot)}  {outcome:<14} {detail}".rstrip())
+    print(", ".join(f"{count} {outcome}" for outcome, count in counts.items())
+          + f" - in {time.time() - started:.1f}s")
+    return (1 if counts.get('failed') or counts.get('conflict')
+            or counts.get('no room') else 0)
 
 
 if __name__ == '__main__':
-    main()
+    exit(main())
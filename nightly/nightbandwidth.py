@@ -0,0 +1,87 @@
+"""
+picking the multicast bandwidth for the nightly loads
+
+the configured bandwidth is only where we start from; each load session
+records its outcome in the history - see NightlyHistory.record_load() -
+and each run derives its bandwidth from the outcome of the previous one,
+AIMD-style: after a clean night the bandwidth goes up by a fixed step,
+after a lossy one it gets cut by a factor, and otherwise it is kept;
+it always remains within bounds that are relative to the configured value
+
+a night is lossy if a load session timed out, if the transfer failed on
+too many nodes, or if too much of the image had to be sent again - when
+that is known; nodes that never got to the transfer, and stragglers that
+got evicted, say nothing about the network and are not counted as lost
+"""
+
+# pylint: disable=c0111
+
+# bounds, relative to the configured bandwidth
+BANDWIDTH_FLOOR = .5
+BANDWIDTH_CEILING = 1.5
+# additive increase, in Mibps, and multiplicative decrease
+BANDWIDTH_STEP = 50
+BANDWIDTH_DECREASE = .7
+# share of the nodes whose transfer failed
+LOSSY_NODES = .1
+CLEAN_NODES = .05
+# share of the image that was sent more than once
+LOSSY_RESENT = .05
+CLEAN_RESENT = .01
+
+
+def loss(loads):
+    """
+    (share of nodes lost, share resent or None, any timeout)
+    over the main load sessions of one run; loads as returned
+    by NightlyHistory.last_loads()
+    """
+    main = [load for load in loads if not load['catch_up']]
+    nb_nodes = sum(load['nb_nodes'] for load in main)
+    lost = sum(load['nb_failed'] for load in main)
+    known = [load for load in main if load['resent'] is not None]
+    resent = (None if not known else
+              sum(load['resent'] * load['nb_nodes'] for load in known)
+              / max(1, sum(load['nb_nodes'] for load in known)))
+    timed_out = any(load['timed_out'] for load in main)
+    return lost / max(1, nb_nodes), resent, timed_out
+
+
+class AdaptiveBandwidth:                                # pylint: disable=r0903
+    """
+    with history set to None, this boils down to the configured value
+    """
+
+    def __init__(self, history, configured, *,           # pylint: disable=r0913
+                 floor=BANDWIDTH_FLOOR, ceiling=BANDWIDTH_CEILING,
+                 step=BANDWIDTH_STEP, decrease=BANDWIDTH_DECREASE):
+        self.configured = configured
+        self.floor = int(configured * floor)
+        self.ceiling = int(configured * ceiling)
+        self.step = step
+        self.decrease = decrease
+        self.loads = [] if history is None else history.last_loads()
+
+    def clamp(self, bandwidth):
+        return max(self.floor, min(self.ceiling, int(bandwidth)))
+
+    def choose(self):
+        """
+        returns the bandwidth for this run, and why
+        """
+        main = [load for load in self.loads if not load['catch_up']]
+        if not main:
+            return self.clamp(self.configured), "configured value, no past load"
+        previous = max(load['bandwidth'] for load in main)
+        lost, resent, timed_out = loss(main)
+        details = f"{lost:.0%} nodes lost" + (
+            "" if resent is None else f", {resent:.1%} resent") + (
+                ", timed out" if timed_out else "")
+        if (timed_out or lost > LOSSY_NODES
+                or (resent is not None and resent > LOSSY_RESENT)):
+            return (self.clamp(previous * self.decrease),
+                    f"down from {previous} ({details})")
+        if lost <= CLEAN_NODES and (resent is None or resent <= CLEAN_RESENT):
+            return (self.clamp(previous + self.step),
+                    f"up from {previous} ({details})")
+        return self.clamp(previous), f"kept ({details})"
@@ -0,0 +1,66 @@
+"""
+keeping track of the time left in the nightly lease
+
+the lease end is a hard limit; some time is set aside at the end
+for the wrap-up (report and power-off), and the rest is what
+node work can use
+"""
+
+# pylint: disable=c0111
+
+import time
+
+
+class TimeBudget:
+
+    def __init__(self, total, reserve):
+        """
+        total: how many seconds we have from now on
+        reserve: how many of these are kept for the wrap-up
+        """
+        self.started = time.monotonic()
+        self.deadline = self.started + total
+        self.reserve = reserve
+
+    def __repr__(self):
+        return (f"<TimeBudget {self.remaining():.0f}s left,"
+                f" {self.available():.0f}s available for work>")
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def remaining(self):
+        """
+        until the end of the lease
+        """
+        return max(0., self.deadline - time.monotonic())
+
+    def available(self):
+        """
+        for node work, i.e. before the wrap-up
+        """
+        return max(0., self.remaining() - self.reserve)
+
+    def is_exhausted(self):
+        return self.available() <= 0
+
+    def clamp(self, timeout):
+        """
+        a phase timeout never goes past the work deadline
+        """
+        return min(timeout, self.available())
+
+    def affordable(self, items, cost, upfront=0.):
+        """
+        the longest prefix of items whose cumulated cost fits in the budget;
+        cost is a function that estimates the duration of one item,
+        and upfront is the estimated duration of what comes before;
+        always keep at least the first item
+        """
+        kept, total = [], upfront
+        for item in items:
+            total += cost(item)
+            if kept and total > self.available():
+                break
+            kept.append(item)
+        return kept
@@ -0,0 +1,55 @@
+"""
+splitting the nodes into one cohort per reference image
+
+in cohort mode, each node checks only one of the reference images
+per night, and the cohorts load their images at the same time;
+a node gets the image that it has gone the longest without trying,
+so cohorts swap from one run to the next and every node covers every
+image over as many runs as there are images
+
+cohorts are balanced, so that each image gets checked every night
+on the same share of the nodes, give or take one
+"""
+
+# pylint: disable=c0111
+
+
+def assign_cohorts(node_ids, images, last_tried):
+    """
+    node_ids: the nodes to split
+    images: the image names, in order of preference
+    last_tried: dict (node_id, image) -> when that node last tried
+    that image, see NightlyHistory.last_tried()
+
+    returns a dict image -> list of node ids
+    """
+    node_ids = sorted(node_ids)
+    cohorts = {image: [] for image in images}
+    base, extras = divmod(len(node_ids), len(images))
+
+    def preferences(node_id):
+        # never tried comes first; ties are spread across images
+        return sorted(images, key=lambda image: (
+            last_tried.get((node_id, image), 0),
+            (images.index(image) - node_id) % len(images)))
+
+    # the nodes that are the most overdue pick first
+    for node_id in sorted(node_ids, key=lambda node_id: min(
+            last_tried.get((node_id, image), 0) for image in images)):
+        for image in preferences(node_id):
+            if len(cohorts[image]) < base:
+                break
+            if len(cohorts[image]) == base and extras:
+                extras -= 1
+                break
+        cohorts[image].append(node_id)
+    return cohorts
+
+
+def overdue(node_ids, images, last_tried, since):
+    """
+    a dict image -> the nodes that have not tried it since that time
+    """
+    return {image: [node_id for node_id in sorted(node_ids)
+                    if last_tried.get((node_id, image), 0) < since]
+            for image in images}
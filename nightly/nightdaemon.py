@@ -0,0 +1,171 @@
+"""
+resident mode for nightly - see nightly.py --daemon
+
+instead of waiting for the next hourly tick, the daemon keeps an index
+of the upcoming nightly leases, sleeps until the next one begins,
+and then triggers a regular nightly.py run right away
+
+the index is refreshed incrementally: only the leases beyond what was
+already fetched are retrieved, plus the next few hours that are
+re-read to catch leases that have been moved or deleted
+"""
+
+# pylint: disable=c0111, import-outside-toplevel
+
+import sys
+import time
+import bisect
+import subprocess
+
+from rhubarbe.config import Config
+
+
+# how far ahead we look for leases
+HORIZON = 14 * 24 * 3600
+# how often the index is refreshed
+REFRESH_PERIOD = 15 * 60
+# the window that gets re-read on each refresh
+NEAR_WINDOW = 3 * 3600
+# never sleep longer than that - we want to see clock jumps and the like
+MAX_SLEEP = 5 * 60
+
+
+class LeaseIndex:
+    """
+    the leases of one slice, indexed by start time
+    """
+
+    def __init__(self, slice_name):
+        self.slice_name = slice_name
+        # lease id -> (t_from, t_until) as epochs
+        self.by_id = {}
+        # sorted list of (t_from, lease_id)
+        self.starts = []
+        # up to where we have fetched leases
+        self.fetched_until = None
+        self.fetches = 0
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def _add(self, lease_id, t_from, t_until):
+        if lease_id in self.by_id:
+            self._remove(lease_id)
+        self.by_id[lease_id] = (t_from, t_until)
+        bisect.insort(self.starts, (t_from, lease_id))
+
+    def _remove(self, lease_id):
+        t_from, _ = self.by_id.pop(lease_id)
+        index = bisect.bisect_left(self.starts, (t_from, lease_id))
+        del self.starts[index]
+
+    def merge(self, leases, window_start, window_end):
+        """
+        leases is what the API returns for [window_start, window_end[;
+        any lease of ours that we had in that window and that does
+        not show up anymore is dropped
+        """
+        from rhubarbe.r2labapiproxy import iso_to_epoch
+        seen = set()
+        for lease in leases:
+            if lease.get('slice_name') != self.slice_name:
+                continue
+            t_from = iso_to_epoch(lease['t_from'])
+            t_until = iso_to_epoch(lease['t_until'])
+            self._add(lease['id'], t_from, t_until)
+            seen.add(lease['id'])
+        low = bisect.bisect_left(self.starts, (window_start, ))
+        high = bisect.bisect_left(self.starts, (window_end, ))
+        for _, lease_id in self.starts[low:high]:
+            if lease_id not in seen:
+                self._remove(lease_id)
+
+    def forget_before(self, epoch):
+        while self.starts and self.by_id[self.starts[0][1]][1] <= epoch:
+            self._remove(self.starts[0][1])
+
+    def refresh(self, proxy, now):
+        """
+        re-read the near future, and fetch beyond what we already know
+        """
+        self.forget_before(now)
+        fetch_from = now
+        if self.fetched_until is not None and self.fetched_until > now + NEAR_WINDOW:
+            # near window first
+            self._fetch(proxy, now, now + NEAR_WINDOW)
+            fetch_from = self.fetched_until
+        if fetch_from < now + HORIZON:
+            self._fetch(proxy, fetch_from, now + HORIZON)
+            self.fetched_until = now + HORIZON
+
+    def _fetch(self, proxy, window_start, window_end):
+        from rhubarbe.r2labapiproxy import epoch_to_iso
+        leases = proxy.get_leases(after=epoch_to_iso(window_start),
+                                  before=epoch_to_iso(window_end))
+        self.fetches += 1
+        self.merge(leases, window_start, window_end)
+
+    def current_or_next(self, now):
+        """
+        returns (lease_id, t_from, t_until) for the lease that is
+        running at that time, or otherwise the next one; or None
+        """
+        index = bisect.bisect_right(self.starts, (now, float('inf')))
+        # the one that started last may still be running
+        if index > 0:
+            t_from, lease_id = self.starts[index-1]
+            t_until = self.by_id[lease_id][1]
+            if t_until > now:
+                return lease_id, t_from, t_until
+        if index < len(self.starts):
+            t_from, lease_id = self.starts[index]
+            return lease_id, t_from, self.by_id[lease_id][1]
+        return None
+
+
+def run_daemon(slice_name, nightly_argv, verbose):
+    """
+    nightly_argv is the command to run when a lease begins
+    """
+    from rhubarbe.r2labapiproxy import R2labApiProxy
+
+    def log(*args):
+        showtime = time.strftime("%Y-%m-%d@%H:%M:%S")
+        print(showtime, *args, flush=True)
+
+    api_url = Config().value('r2labapi', 'url')
+    proxy = R2labApiProxy(api_url)
+    index = LeaseIndex(slice_name)
+    next_refresh = 0
+    # the leases we have already run in
+    done = set()
+
+    while True:
+        now = time.time()
+        if now >= next_refresh:
+            try:
+                index.refresh(proxy, now)
+                next_refresh = now + REFRESH_PERIOD
+                if verbose:
+                    log(f"{len(index)} lease(s) indexed,"
+                        f" {index.fetches} fetch(es) so far")
+            except Exception as exc:                    # pylint: disable=w0703
+                log(f"could not refresh leases: {exc}")
+                next_refresh = now + 60
+        found = index.current_or_next(now)
+        if found:
+            lease_id, t_from, t_until = found
+            if t_from <= now < t_until and lease_id not in done:
+                log(f"lease {lease_id} has begun - running {' '.join(nightly_argv)}")
+                done.add(lease_id)
+                subprocess.run([sys.executable] + nightly_argv, check=False)
+                # the lease might have been changed meanwhile
+                next_refresh = 0
+                continue
+        wake_up = next_refresh
+        if found and found[1] > now:
+            wake_up = min(wake_up, found[1])
+        delay = min(MAX_SLEEP, max(1., wake_up - now))
+        if verbose:
+            log(f"sleeping {delay:.0f}s")
+        time.sleep(delay)
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+
+"""
+what the frisbee multicast traffic says about an image load
+
+reads a pcap capture - a file, stdin, or a live tcpdump - as a stream,
+and computes per frisbee session (multicast group and port):
+
+(*) throughput of the image blocks sent by the server
+(*) retransmission rate, i.e. the share of blocks sent more than once
+(*) loss rate, i.e. the share of blocks that receivers asked for again
+    after they had been sent
+(*) per-receiver counts of requests and of requested blocks
+
+memory does not depend on the size of the capture: packets are
+dropped as soon as they are counted, and the only per-session state
+is one bit per image block, plus counters per receiver
+
+    nightfrisbee.py capture.pcap
+    tcpdump -i control -U -w - udp | nightfrisbee.py -
+    nightfrisbee.py --live control --port 7001    # ^C to stop
+
+nightly runs the latter during each load, see FrisbeeCapture
+"""
+
+# pylint: disable=c0111
+
+import sys
+import json
+import time
+import signal
+import socket
+import struct
+import asyncio
+import subprocess
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+
+# frisbee packet header: type, subtype, datalen, srcip
+HEADER = 16
+PKTTYPE_REQUEST, PKTTYPE_REPLY = 1, 2
+JOIN, LEAVE, BLOCK, REQUEST, LEAVE2, PREQUEST, JOIN2, PROGRESS = range(1, 9)
+SUBTYPES = {JOIN: 'join', LEAVE: 'leave', BLOCK: 'block', REQUEST: 'request',
+            LEAVE2: 'leave', PREQUEST: 'prequest', JOIN2: 'join',
+            PROGRESS: 'progress'}
+# image blocks, and blocks per chunk
+BLOCK_SIZE = 1024
+CHUNK_BLOCKS = 1024
+CHUNK_BYTES = CHUNK_BLOCKS // 8
+# anything beyond is garbage rather than a 64GB image
+MAX_CHUNKS = 65536
+# no need to capture whole image blocks
+SNAPLEN = 256
+
+PCAP_MAGICS = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1e-6),
+    b'\xa1\xb2\xc3\xd4': ('>', 1e-6),
+    b'\x4d\x3c\xb2\xa1': ('<', 1e-9),
+    b'\xa1\xb2\x3c\x4d': ('>', 1e-9),
+}
+# link type -> (offset of the ethertype, offset of the network header)
+LINKTYPES = {
+    1: (12, 14),            # ethernet
+    113: (14, 16),          # linux cooked
+    276: (0, 20),           # linux cooked v2
+    101: (None, 0),         # raw ip
+}
+
+
+class PcapStream:
+    """
+    push-based pcap parser: feed() it bytes as they come,
+    and get back the packets that are complete
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.endian = None
+        self.unit = None
+        self.linktype = None
+
+    def feed(self, data):
+        """
+        yields (timestamp, linktype, original length, captured bytes)
+        """
+        self.buffer += data
+        offset = 0
+        if self.endian is None:
+            if len(self.buffer) < 24:
+                return
+            try:
+                self.endian, self.unit = PCAP_MAGICS[bytes(self.buffer[:4])]
+            except KeyError:
+                raise ValueError("not a pcap stream (pcapng is not supported)")
+            self.linktype, = struct.unpack_from(
+                self.endian + "I", self.buffer, 20)
+            offset = 24
+        record = struct.Struct(self.endian + "IIII")
+        while len(self.buffer) - offset >= 16:
+            seconds, fraction, captured, original = record.unpack_from(
+                self.buffer, offset)
+            if len(self.buffer) - offset - 16 < captured:
+                break
+            start = offset + 16
+            yield (seconds + fraction * self.unit, self.linktype, original,
+                   bytes(self.buffer[start:start + captured]))
+            offset = start + captured
+        del self.buffer[:offset]
+
+
+def udp_packet(linktype, frame):
+    """
+    (source ip, destination ip, destination port, udp length, payload)
+    or None if frame is not the first fragment of an IPv4 UDP packet;
+    addresses are left as 4 bytes, see socket.inet_ntoa()
+    """
+    try:
+        ethertype_at, offset = LINKTYPES[linktype]
+    except KeyError:
+        return None
+    if ethertype_at is not None:
+        ethertype = frame[ethertype_at:ethertype_at + 2]
+        # one 802.1Q tag
+        if ethertype == b'\x81\x00' and linktype == 1:
+            ethertype, offset = frame[16:18], offset + 4
+        if ethertype != b'\x08\x00':
+            return None
+    if len(frame) < offset + 20 or frame[offset] >> 4 != 4:
+        return None
+    ihl = (frame[offset] & 0x0f) * 4
+    flags_fragment, = struct.unpack_from("!H", frame, offset + 6)
+    if frame[offset + 9] != 17 or flags_fragment & 0x1fff:
+        return None
+    udp = offset + ihl
+    if len(frame) < udp + 8:
+        return None
+    _, port, length = struct.unpack_from("!HHH", frame, udp)
+    return (frame[offset + 12:offset + 16], frame[offset + 16:offset + 20],
+            port, length - 8, frame[udp + 8:])
+
+
+def frisbee_header(payload):
+    """
+    (byte order, subtype, message) or None; frisbee does not convert
+    to network byte order, so both orders are tried
+    """
+    if len(payload) < HEADER:
+        return None
+    for endian in "<>":
+        kind, subtype = struct.unpack_from(endian + "ii", payload)
+        if kind in (PKTTYPE_REQUEST, PKTTYPE_REPLY) and subtype in SUBTYPES:
+            return endian, subtype, payload[HEADER:]
+    return None
+
+
+class FrisbeeSession:
+    """
+    the counters for one multicast group and port
+    """
+
+    def __init__(self, group, port):
+        self.group = group
+        self.port = port
+        self.first = self.last = None
+        self.packets = 0
+        self.bytes = 0
+        self.blocks = 0
+        self.distinct = 0
+        self.first_block = self.last_block = None
+        # one bit per image block that was sent at least once
+        self.sent = bytearray()
+        # blocks asked for again after they had been sent
+        self.lost = 0
+        # ip -> [requests, requested blocks, joins, leaves]
+        self.receivers = {}
+
+    def receiver(self, address):
+        return self.receivers.setdefault(address, [0, 0, 0, 0])
+
+    def was_sent(self, chunk, block):
+        index = chunk * CHUNK_BYTES + block // 8
+        return index < len(self.sent) and self.sent[index] >> (block % 8) & 1
+
+    def mark_sent(self, chunk, block):
+        """
+        returns True if that block had been sent already
+        """
+        index = chunk * CHUNK_BYTES + block // 8
+        if index >= len(self.sent):
+            self.sent.extend(bytes((chunk + 1) * CHUNK_BYTES - len(self.sent)))
+        bit = 1 << (block % 8)
+        if self.sent[index] & bit:
+            return True
+        self.sent[index] |= bit
+        return False
+
+    def feed(self, timestamp, source, length, endian, subtype, message):
+        # pylint: disable=r0913
+        if self.first is None:
+            self.first = timestamp
+        self.last = timestamp
+        self.packets += 1
+        self.bytes += length
+        if subtype == BLOCK:
+            if len(message) < 8:
+                return
+            chunk, block = struct.unpack_from(endian + "ii", message)
+            if not 0 <= chunk < MAX_CHUNKS or not 0 <= block < CHUNK_BLOCKS:
+                return
+            if self.first_block is None:
+                self.first_block = timestamp
+            self.last_block = timestamp
+            self.blocks += 1
+            if not self.mark_sent(chunk, block):
+                self.distinct += 1
+        elif subtype == REQUEST:
+            if len(message) < 12:
+                return
+            chunk, block, count = struct.unpack_from(endian + "iii", message)
+            if not 0 <= chunk < MAX_CHUNKS or not 0 <= block < CHUNK_BLOCKS:
+                return
+            count = max(0, min(count, CHUNK_BLOCKS - block))
+            self._request(source, chunk, range(block, block + count))
+        elif subtype == PREQUEST:
+            # chunk, retries, then the blockmap
+            if len(message) < 8 + CHUNK_BYTES:
+                return
+            chunk, = struct.unpack_from(endian + "i", message)
+            if not 0 <= chunk < MAX_CHUNKS:
+                return
+            blockmap = message[8:8 + CHUNK_BYTES]
+            self._request(source, chunk, (
+                block for block in range(CHUNK_BLOCKS)
+                if blockmap[block // 8] >> (block % 8) & 1))
+        elif subtype in (JOIN, JOIN2):
+            self.receiver(source)[2] += 1
+        elif subtype in (LEAVE, LEAVE2):
+            self.receiver(source)[3] += 1
+
+    def _request(self, source, chunk, blocks):
+        counters = self.receiver(source)
+        counters[0] += 1
+        for block in blocks:
+            counters[1] += 1
+            if self.was_sent(chunk, block):
+                self.lost += 1
+
+    def metrics(self):
+        duration = ((self.last_block - self.first_block)
+                    if self.first_block is not None else 0.)
+        return dict(
+            group=self.group and socket.inet_ntoa(self.group), port=self.port,
+            duration=round(duration, 3),
+            packets=self.packets, bytes=self.bytes,
+            blocks=self.blocks, distinct_blocks=self.distinct,
+            throughput=(round(self.blocks * BLOCK_SIZE * 8 / duration / 2**20, 1)
+                        if duration > 0 else None),
+            resent=(self.blocks - self.distinct) / self.blocks if self.blocks else 0.,
+            loss=self.lost / self.distinct if self.distinct else 0.,
+            receivers={socket.inet_ntoa(address): dict(
+                requests=requests, requested=requested, joins=joins, leaves=leaves)
+                       for address, (requests, requested, joins, leaves)
+                       in sorted(self.receivers.items())})
+
+
+class FrisbeeAnalyzer:
+
+    def __init__(self):
+        # (group, port) -> FrisbeeSession
+        self.sessions = {}
+        self.pcap = PcapStream()
+        self.skipped = 0
+
+    def feed(self, data):
+        """
+        a chunk of a pcap stream
+        """
+        for timestamp, linktype, _, frame in self.pcap.feed(data):
+            packet = udp_packet(linktype, frame)
+            parsed = packet and frisbee_header(packet[4])
+            if not parsed:
+                self.skipped += 1
+                continue
+            source, destination, port, length, _ = packet
+            endian, subtype, message = parsed
+            # requests may go to the server rather than to the group;
+            # the port is what tells sessions apart
+            session = self.sessions.get(port)
+            if session is None:
+                session = self.sessions[port] = FrisbeeSession(None, port)
+            if subtype == BLOCK:
+                session.group = destination
+            session.feed(timestamp, source, length, endian, subtype, message)
+
+    def analyze(self, stream, size=1 << 16):
+        """
+        read a binary stream up to its end
+        """
+        while (data := stream.read(size)):
+            self.feed(data)
+        return self
+
+    def metrics(self):
+        return [session.metrics() for _, session in sorted(self.sessions.items())]
+
+
+def describe(metrics):
+    """
+    a one-liner for the logs and the mail
+    """
+    throughput = metrics['throughput']
+    return (f"{metrics['group']}:{metrics['port']}"
+            f" {metrics['blocks']} blocks in {metrics['duration']:.1f}s"
+            + (f" = {throughput:.0f} Mibps" if throughput else "")
+            + f", {metrics['resent']:.1%} resent, {metrics['loss']:.1%} lost,"
+            f" {len(metrics['receivers'])} receiver(s),"
+            f" {sum(r['requests'] for r in metrics['receivers'].values())} request(s)")
+
+
+def tcpdump_command(interface, port=None):
+    return ["tcpdump", "-i", interface, "-U", "-w", "-", "-s", str(SNAPLEN),
+            "-q", "udp" + (f" port {port}" if port else "")]
+
+
+def analyze_live(interface, port):
+    """
+    until interrupted with SIGINT or SIGTERM
+    """
+    analyzer = FrisbeeAnalyzer()
+    tcpdump = subprocess.Popen(tcpdump_command(interface, port),
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    # SIGTERM is what we get from FrisbeeCapture
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        while (data := tcpdump.stdout.read1(1 << 16)):
+            analyzer.feed(data)
+    except KeyboardInterrupt:
+        tcpdump.terminate()
+        # what tcpdump still has in store
+        analyzer.analyze(tcpdump.stdout)
+    finally:
+        tcpdump.wait()
+    return analyzer
+
+
+class FrisbeeCapture:
+    """
+    a live analysis of one frisbee session, that runs in a separate
+    process so as to keep the packet rate off the nightly event loop
+    """
+
+    def __init__(self, interface, group, port):
+        self.interface = interface
+        self.group = group
+        self.port = int(port)
+        self.process = None
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, __file__, "--live", self.interface,
+            "--port", str(self.port), "--json",
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+
+    async def stop(self, timeout=10):
+        """
+        the metrics of our session, or None if not available
+        """
+        if self.process is None:
+            return None
+        process, self.process = self.process, None
+        if process.returncode is None:
+            process.terminate()
+        try:
+            output, _ = await asyncio.wait_for(process.communicate(), timeout)
+            sessions = json.loads(output)
+        except (asyncio.TimeoutError, ValueError):
+            if process.returncode is None:
+                process.kill()
+            return None
+        return next((session for session in sessions
+                     if session['port'] == self.port), None)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__,
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("capture", nargs='?', default=None,
+                        help="pcap file, or - for stdin")
+    parser.add_argument("-l", "--live", metavar="INTERFACE", default=None,
+                        help="run tcpdump on that interface until interrupted")
+    parser.add_argument("-p", "--port", type=int, default=None,
+                        help="only that frisbee session")
+    parser.add_argument("-j", "--json", action='store_true', default=False,
+                        help="output the metrics as json")
+    parser.add_argument("-v", "--verbose", action='store_true', default=False,
+                        help="also show per-receiver counts")
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    if args.live:
+        analyzer = analyze_live(args.live, args.port)
+    elif args.capture in (None, '-'):
+        analyzer = FrisbeeAnalyzer().analyze(sys.stdin.buffer)
+    else:
+        with open(args.capture, 'rb') as capture:
+            analyzer = FrisbeeAnalyzer().analyze(capture)
+    sessions = [metrics for metrics in analyzer.metrics()
+                if args.port is None or metrics['port'] == args.port]
+    if args.json:
+        json.dump(sessions, sys.stdout)
+        return 0
+    for metrics in sessions:
+        print(describe(metrics))
+        if args.verbose:
+            for address, counters in metrics['receivers'].items():
+                print(f"    {address:>15} {counters['requests']:>6} request(s)"
+                      f" for {counters['requested']:>7} block(s)"
+                      f" joins={counters['joins']} leaves={counters['leaves']}")
+    print(f"{analyzer.skipped} non-frisbee packet(s) skipped,"
+          f" analyzed in {time.monotonic() - started:.1f}s", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,568 @@
+#!/usr/bin/env python3
+
+"""
+persistent record of nightly runs, in a local sqlite file
+
+each run appends one row in the 'runs' table, and one row per node
+and per phase in the 'phases' table; phase rows are kept in memory
+during the run and written in a single transaction at the end
+
+run as a script, this offers a few queries on the stored history:
+
+    nighthistory.py flaky          # failure rate per node
+    nighthistory.py durations      # p50 / p95 phase durations per node
+    nighthistory.py regressions    # last week vs the weeks before
+    nighthistory.py facts          # what the nodes reported in the last run
+    nighthistory.py bandwidth      # load bandwidth and outcome per run
+"""
+
+# pylint: disable=c0111
+
+import os
+import json
+import math
+import time
+import sqlite3
+from argparse import ArgumentParser
+from collections import defaultdict
+
+from nightprobe import describe
+from nightbandwidth import loss
+
+DEFAULT_HISTORY = "/var/lib/r2lab-nightly/history.sqlite"
+
+# the phases as recorded by nightly, in pipeline order
+# 'triage' is the pre-flight check, 'bye' the final power-off of the whole testbed
+PHASES = ['triage', 'on', 'reset', 'off', 'load', 'ssh', 'check', 'bye']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    started REAL NOT NULL,
+    ended REAL,
+    nb_nodes INTEGER,
+    nb_failures INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+CREATE TABLE IF NOT EXISTS phases (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    node_id INTEGER NOT NULL,
+    phase TEXT NOT NULL,
+    image TEXT,
+    started REAL NOT NULL,
+    ended REAL NOT NULL,
+    outcome INTEGER NOT NULL,
+    reason INTEGER
+);
+CREATE INDEX IF NOT EXISTS phases_started ON phases (started);
+CREATE INDEX IF NOT EXISTS phases_node ON phases (node_id, phase, started);
+CREATE TABLE IF NOT EXISTS facts (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    node_id INTEGER NOT NULL,
+    image TEXT,
+    facts TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS facts_run ON facts (run_id, node_id);
+CREATE TABLE IF NOT EXISTS loads (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    image TEXT NOT NULL,
+    bandwidth INTEGER NOT NULL,
+    started REAL NOT NULL,
+    ended REAL NOT NULL,
+    catch_up INTEGER NOT NULL,
+    nb_nodes INTEGER NOT NULL,
+    nb_failed INTEGER NOT NULL,
+    nb_evicted INTEGER NOT NULL,
+    timed_out INTEGER NOT NULL,
+    resent REAL
+);
+CREATE INDEX IF NOT EXISTS loads_run ON loads (run_id);
+CREATE TABLE IF NOT EXISTS traffic (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    image TEXT NOT NULL,
+    started REAL NOT NULL,
+    metrics TEXT NOT NULL
+);
+"""
+
+
+def percentile(sorted_values, fraction):
+    """
+    nearest-rank percentile on an already sorted list
+    """
+    if not sorted_values:
+        return None
+    rank = math.ceil(fraction * len(sorted_values)) - 1
+    return sorted_values[max(0, min(len(sorted_values) - 1, rank))]
+
+
+class NightlyHistory:
+
+    def __init__(self, path=DEFAULT_HISTORY):
+        self.path = path
+        self._connection = None
+        # the current run
+        self.run_id = None
+        self.records = []
+        self.facts = []
+        self.loads = []
+        self.traffic = []
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._connection = sqlite3.connect(self.path)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(SCHEMA)
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    # recording
+    def start_run(self, kind, nb_nodes, started=None):
+        """
+        started defaults to now
+        """
+        with self.connection as connection:
+            cursor = connection.execute(
+                "INSERT INTO runs (kind, started, nb_nodes) VALUES (?, ?, ?)",
+                (kind, started or time.time(), nb_nodes))
+        self.run_id = cursor.lastrowid
+        self.records = []
+        self.facts = []
+        self.loads = []
+        self.traffic = []
+        return self.run_id
+
+    def record(self, node_id, phase, image,             # pylint: disable=r0913
+               started, ended, outcome, reason=None):
+        """
+        buffered until end_run()
+        """
+        self.records.append(
+            (self.run_id, node_id, phase, image, started, ended,
+             1 if outcome else 0, int(reason) if reason else None))
+
+    def record_facts(self, node_id, image, facts):
+        """
+        what a node reported about itself - see nightprobe.py
+        buffered until end_run() as well
+        """
+        self.facts.append((self.run_id, node_id, image, json.dumps(facts)))
+
+    def record_load(self, image, bandwidth, started, ended, *,  # pylint: disable=r0913
+                    catch_up, nb_nodes, nb_failed, nb_evicted, timed_out,
+                    resent=None):
+        """
+        the outcome of one load session - see nightbandwidth.py;
+        nb_failed counts the nodes whose transfer failed, as opposed
+        to the ones that never got that far; resent is the share
+        of the image that was sent more than once, when known;
+        buffered until end_run()
+        """
+        self.loads.append(
+            (self.run_id, image, bandwidth, started, ended, int(catch_up),
+             nb_nodes, nb_failed, nb_evicted, int(timed_out), resent))
+
+    def record_traffic(self, image, started, metrics):
+        """
+        what the capture of a load session found - see nightfrisbee.py
+        started tells which load; buffered until end_run()
+        """
+        self.traffic.append((self.run_id, image, started, json.dumps(metrics)))
+
+    def end_run(self, nb_failures):
+        with self.connection as connection:
+            connection.executemany(
+                "INSERT INTO phases VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                self.records)
+            connection.executemany(
+                "INSERT INTO facts VALUES (?, ?, ?, ?)", self.facts)
+            connection.executemany(
+                "INSERT INTO loads VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                self.loads)
+            connection.executemany(
+                "INSERT INTO traffic VALUES (?, ?, ?, ?)", self.traffic)
+            connection.execute(
+                "UPDATE runs SET ended = ?, nb_failures = ? WHERE id = ?",
+                (time.time(), nb_failures, self.run_id))
+        self.records = []
+        self.facts = []
+        self.loads = []
+        self.traffic = []
+
+    # querying
+    def phase_durations(self, since, until=None):
+        """
+        returns a dict (node_id, phase) -> sorted list of durations
+        for the phases that went fine in the [since, until] period
+        """
+        until = until or time.time()
+        durations = defaultdict(list)
+        for node_id, phase, duration in self.connection.execute(
+                "SELECT node_id, phase, ended - started FROM phases"
+                " WHERE started >= ? AND started < ? AND outcome = 1",
+                (since, until)):
+            durations[(node_id, phase)].append(duration)
+        for values in durations.values():
+            values.sort()
+        return durations
+
+    def flakiness(self, since, until=None):
+        """
+        returns a dict node_id -> (nb_runs, nb_failed_runs, worst_reason)
+        a run counts as failed for a node if any of its phases failed
+        """
+        until = until or time.time()
+        result = {}
+        for node_id, nb_runs, nb_failed, worst_reason in self.connection.execute(
+                "SELECT node_id, COUNT(*), SUM(failed), MAX(reason) FROM"
+                " (SELECT node_id, run_id, 1 - MIN(outcome) AS failed,"
+                "         MAX(reason) AS reason"
+                "  FROM phases WHERE started >= ? AND started < ?"
+                "  GROUP BY node_id, run_id)"
+                " GROUP BY node_id", (since, until)):
+            result[node_id] = (nb_runs, nb_failed, worst_reason)
+        return result
+
+    def last_tried(self):
+        """
+        returns a dict (node_id, image) -> the last time that node
+        went for that image, whatever the outcome
+        """
+        return {(node_id, image): started
+                for node_id, image, started in self.connection.execute(
+                    "SELECT node_id, image, MAX(started) FROM phases"
+                    " WHERE phase IN ('load', 'check') AND image IS NOT NULL"
+                    " GROUP BY node_id, image")}
+
+    def last_verified(self):
+        """
+        returns a dict (node_id, image) -> the last time that node
+        passed the check of that image
+        """
+        return {(node_id, image): started
+                for node_id, image, started in self.connection.execute(
+                    "SELECT node_id, image, MAX(started) FROM phases"
+                    " WHERE phase = 'check' AND outcome = 1 AND image IS NOT NULL"
+                    " GROUP BY node_id, image")}
+
+    def last_passes(self):
+        """
+        returns a dict node_id -> the start of the last nightly run
+        where that node went through all its phases fine, checks included
+        """
+        return dict(self.connection.execute(
+            "SELECT node_id, MAX(started) FROM"
+            " (SELECT node_id, runs.started AS started, MIN(outcome) AS passed,"
+            "         SUM(phase = 'check') AS checks"
+            "  FROM phases JOIN runs ON runs.id = phases.run_id"
+            "  WHERE runs.kind = 'nightly' GROUP BY node_id, run_id)"
+            " WHERE passed = 1 AND checks > 0 GROUP BY node_id"))
+
+    def count_runs(self, kind, since):
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM runs WHERE kind = ? AND started >= ?"
+            " AND ended IS NOT NULL", (kind, since)).fetchone()[0]
+
+    def run_facts(self, run_id):
+        """
+        a list of (node_id, image, facts) for that run
+        """
+        return [(node_id, image, json.loads(facts))
+                for node_id, image, facts in self.connection.execute(
+                    "SELECT node_id, image, facts FROM facts WHERE run_id = ?"
+                    " ORDER BY node_id, rowid", (run_id,))]
+
+    def run_loads(self, run_id):
+        """
+        the load sessions of that run, as a list of dicts
+        """
+        cursor = self.connection.execute(
+            "SELECT * FROM loads WHERE run_id = ? ORDER BY started", (run_id,))
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+    def run_traffic(self, run_id):
+        """
+        a list of (image, started, metrics) for that run
+        """
+        return [(image, started, json.loads(metrics))
+                for image, started, metrics in self.connection.execute(
+                    "SELECT image, started, metrics FROM traffic WHERE run_id = ?"
+                    " ORDER BY started", (run_id,))]
+
+    def run_durations(self, run_id):
+        """
+        returns a dict node_id -> phase -> seconds spent in that run,
+        summed over the images; triage and bye are left out
+        """
+        result = defaultdict(dict)
+        for node_id, phase, duration in self.connection.execute(
+                "SELECT node_id, phase, SUM(ended - started) FROM phases"
+                " WHERE run_id = ? AND phase NOT IN ('triage', 'bye')"
+                " GROUP BY node_id, phase", (run_id,)):
+            result[node_id][phase] = duration
+        return result
+
+    def cycles(self, since, until=None):
+        """
+        returns a dict node_id -> (nb_runs, nb_failed_runs, p50) where p50
+        is the median time the node spent in its phases, triage and bye
+        aside, over the runs where it went fine - None if there was none
+        """
+        until = until or time.time()
+        runs = defaultdict(lambda: [0, 0, []])
+        for node_id, total, passed in self.connection.execute(
+                "SELECT node_id, SUM(ended - started), MIN(outcome)"
+                " FROM phases WHERE started >= ? AND started < ?"
+                " AND phase NOT IN ('triage', 'bye')"
+                " GROUP BY node_id, run_id", (since, until)):
+            counters = runs[node_id]
+            counters[0] += 1
+            if passed:
+                counters[2].append(total)
+            else:
+                counters[1] += 1
+        return {node_id: (nb_runs, nb_failed, percentile(sorted(totals), .5))
+                for node_id, (nb_runs, nb_failed, totals) in runs.items()}
+
+    def trends(self, now=None):
+        """
+        week over week: returns a dict node_id -> (this week, previous week)
+        for the nodes seen this week, each as returned by cycles()
+        """
+        now = now or time.time()
+        this_week = self.cycles(now - WEEK, now)
+        previous = self.cycles(now - 2 * WEEK, now - WEEK)
+        return {node_id: (cycle, previous.get(node_id, (0, 0, None)))
+                for node_id, cycle in this_week.items()}
+
+    def last_loads(self):
+        """
+        the load sessions of the last nightly run that had any
+        """
+        row = self.connection.execute(
+            "SELECT MAX(loads.run_id) FROM loads JOIN runs ON runs.id = loads.run_id"
+            " WHERE runs.kind = 'nightly'").fetchone()
+        return [] if row[0] is None else self.run_loads(row[0])
+
+    def last_runs(self, count=10, kind=None):
+        """
+        the last count runs, most recent first, of that kind if specified;
+        mind that there is an 'off' run every hour, see nightly.py
+        """
+        if kind is None:
+            return list(self.connection.execute(
+                "SELECT id, kind, started, ended, nb_nodes, nb_failures FROM runs"
+                " ORDER BY started DESC LIMIT ?", (count,)))
+        return list(self.connection.execute(
+            "SELECT id, kind, started, ended, nb_nodes, nb_failures FROM runs"
+            " WHERE kind = ? ORDER BY started DESC LIMIT ?", (kind, count)))
+
+
+####################
+DAY = 24 * 3600
+WEEK = 7 * DAY
+
+
+class AdaptiveDeadlines:                                # pylint: disable=r0903
+    """
+    per-node and per-phase timeouts, derived from the past durations
+    of that same phase on that same node
+
+    a deadline is the given percentile of past durations, times margin,
+    plus slack; it never exceeds the configured default, which is also
+    what is used for nodes that do not have enough history;
+    with history set to None, this boils down to the defaults
+    """
+
+    def __init__(self, history, defaults, *,            # pylint: disable=r0913
+                 days=60, fraction=.95, margin=1.5, slack=10.,
+                 min_samples=5):
+        self.defaults = defaults
+        self.fraction = fraction
+        self.margin = margin
+        self.slack = slack
+        self.min_samples = min_samples
+        self.durations = ({} if history is None
+                          else history.phase_durations(time.time() - days * DAY))
+
+    def timeout(self, node_id, phase):
+        default = self.defaults[phase]
+        values = self.durations.get((node_id, phase), [])
+        if len(values) < self.min_samples:
+            return default
+        learned = percentile(values, self.fraction) * self.margin + self.slack
+        return min(default, learned)
+
+    def norm(self, node_id, phase):
+        """
+        the median duration, or None if not enough history
+        """
+        values = self.durations.get((node_id, phase), [])
+        if len(values) < self.min_samples:
+            return None
+        return percentile(values, .5)
+
+
+def show_flaky(history, args):
+    since = time.time() - args.days * DAY
+    flakiness = history.flakiness(since)
+    print(f"{'node':>5} {'runs':>5} {'failed':>7} {'rate':>6}  worst-reason")
+    for node_id, (nb_runs, nb_failed, reason) in sorted(
+            flakiness.items(), key=lambda item: -item[1][1] / item[1][0]):
+        if args.all or nb_failed:
+            print(f"{node_id:>5} {nb_runs:>5} {nb_failed:>7}"
+                  f" {nb_failed/nb_runs:>6.0%}  {reason or ''}")
+
+
+def show_durations(history, args):
+    since = time.time() - args.days * DAY
+    durations = history.phase_durations(since)
+    node_ids = sorted({node_id for node_id, _ in durations})
+    header = " ".join(f"{phase:>13}" for phase in PHASES)
+    print(f"{'node':>5} {header}")
+    print(f"{'':>5} " + " ".join(f"{'p50/p95':>13}" for _ in PHASES))
+    for node_id in node_ids:
+        cells = []
+        for phase in PHASES:
+            values = durations.get((node_id, phase))
+            cells.append(
+                f"{percentile(values, .5):>6.1f}/{percentile(values, .95):<6.1f}"
+                if values else f"{'-':>13}")
+        print(f"{node_id:>5} " + " ".join(cells))
+
+
+def show_regressions(history, args):
+    """
+    compare the last week with the args.weeks weeks before
+    """
+    now = time.time()
+    recent = history.phase_durations(now - WEEK, now)
+    baseline = history.phase_durations(now - (args.weeks + 1) * WEEK, now - WEEK)
+    recent_flaky = history.flakiness(now - WEEK, now)
+    baseline_flaky = history.flakiness(now - (args.weeks + 1) * WEEK, now - WEEK)
+    found = False
+    for key in sorted(recent):
+        if key not in baseline:
+            continue
+        before, after = percentile(baseline[key], .5), percentile(recent[key], .5)
+        if before and after > before * args.ratio:
+            node_id, phase = key
+            print(f"node {node_id:>2} {phase:>6}: p50 {before:.1f}s -> {after:.1f}s")
+            found = True
+    for node_id, (nb_runs, nb_failed, _) in sorted(recent_flaky.items()):
+        prev_runs, prev_failed, _ = baseline_flaky.get(node_id, (0, 0, None))
+        rate = nb_failed / nb_runs
+        prev_rate = prev_failed / prev_runs if prev_runs else 0.
+        if rate > prev_rate + args.rate_increase:
+            print(f"node {node_id:>2} failures: {prev_rate:.0%} -> {rate:.0%}")
+            found = True
+    if not found:
+        print(f"no regression found over the last week vs previous {args.weeks}")
+
+
+def show_facts(history, args):
+    run_id = args.run
+    if run_id is None:
+        run_id = next((run[0] for run in history.last_runs(1, kind='nightly')),
+                      None)
+    if run_id is None:
+        print("no nightly run found")
+        return
+    print(f"facts from run {run_id}")
+    for node_id, image, facts in history.run_facts(run_id):
+        if args.node is None or node_id == args.node:
+            print(f"{node_id:>5} {image or '-':>12} {describe(facts)}")
+            if args.verbose:
+                for error in facts.get('dmesg_errors', []):
+                    print(f"{'':>19}{error}")
+
+
+def show_bandwidth(history, args):
+    """
+    the bandwidth that each run used, and how its loads went
+    """
+    print(f"{'run':>5} {'date':>16} {'Mibps':>6} {'loads':>5} {'nodes':>6}"
+          f" {'lost':>5} {'resent':>7} {'load-p50':>9}")
+    for run_id, _, started, *_ in reversed(
+            history.last_runs(args.runs, kind='nightly')):
+        loads = history.run_loads(run_id)
+        if not loads:
+            continue
+        lost, resent, timed_out = loss(loads)
+        durations = sorted(
+            duration for (duration,) in history.connection.execute(
+                "SELECT ended - started FROM phases WHERE run_id = ?"
+                " AND phase = 'load' AND outcome = 1", (run_id,)))
+        p50 = percentile(durations, .5)
+        bandwidths = sorted({load['bandwidth'] for load in loads})
+        print(f"{run_id:>5} {time.strftime('%Y-%m-%d %H:%M', time.localtime(started))}"
+              f" {'/'.join(str(bandwidth) for bandwidth in bandwidths):>6}"
+              f" {len(loads):>5} {sum(load['nb_nodes'] for load in loads):>6}"
+              f" {lost:>5.0%} {'-' if resent is None else f'{resent:.1%}':>7}"
+              f" {'-' if p50 is None else f'{p50:.1f}s':>9}"
+              f"{' timed out' if timed_out else ''}")
+        if args.verbose:
+            # nightfrisbee pulls asyncio, keep it off nightly.py's hourly path
+            from nightfrisbee import describe as describe_traffic  # pylint: disable=c0415
+            for image, _, metrics in history.run_traffic(run_id):
+                print(f"{'':>5} {image:>16} {describe_traffic(metrics)}")
+
+
+def main():
+    parser = ArgumentParser(usage="query the nightly history")
+    parser.add_argument("-H", "--history", default=DEFAULT_HISTORY,
+                        help="sqlite file (default: %(default)s)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    flaky = subparsers.add_parser("flaky", help="failure rate per node")
+    flaky.add_argument("-d", "--days", type=int, default=30)
+    flaky.add_argument("-a", "--all", action='store_true',
+                       help="also show nodes that never failed")
+    flaky.set_defaults(func=show_flaky)
+
+    durations = subparsers.add_parser(
+        "durations", help="p50 / p95 phase durations per node")
+    durations.add_argument("-d", "--days", type=int, default=30)
+    durations.set_defaults(func=show_durations)
+
+    regressions = subparsers.add_parser(
+        "regressions", help="last week compared to the weeks before")
+    regressions.add_argument("-w", "--weeks", type=int, default=4)
+    regressions.add_argument("-r", "--ratio", type=float, default=1.5,
+                             help="p50 slowdown that is worth mentioning")
+    regressions.add_argument("--rate-increase", type=float, default=.2,
+                             help="failure rate increase worth mentioning")
+    regressions.set_defaults(func=show_regressions)
+
+    facts = subparsers.add_parser(
+        "facts", help="what the nodes reported in a run (default: the last one)")
+    facts.add_argument("-r", "--run", type=int, default=None)
+    facts.add_argument("-n", "--node", type=int, default=None)
+    facts.add_argument("-v", "--verbose", action='store_true',
+                       help="also show kernel errors")
+    facts.set_defaults(func=show_facts)
+
+    bandwidth = subparsers.add_parser(
+        "bandwidth", help="load bandwidth and outcome per run")
+    bandwidth.add_argument("-r", "--runs", type=int, default=30,
+                           help="how many runs to look at")
+    bandwidth.add_argument("-v", "--verbose", action='store_true',
+                           help="also show the captured frisbee traffic")
+    bandwidth.set_defaults(func=show_bandwidth)
+
+    args = parser.parse_args()
+    history = NightlyHistory(args.history)
+    args.func(history, args)
+    history.close()
+
+
+if __name__ == '__main__':
+    main()
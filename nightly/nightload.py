@@ -0,0 +1,160 @@
+"""
+multicast loads where one slow receiver does not hold back the others
+
+rhubarbe's ImageLoader waits for all the frisbee clients of a session;
+as slow receivers ask for retransmissions, they also slow down the
+whole session; here each node's frisbee client is followed on its own,
+using the percentages that show up on the message bus, and nodes that
+fall far behind the rest of the cohort are evicted - their client gets
+cancelled and the node turned off - so that they can be reloaded in
+a smaller catch-up session, see ImageSession in nightrun.py
+"""
+
+# pylint: disable=c0111
+
+import asyncio
+
+from rhubarbe.imageloader import ImageLoader
+from rhubarbe.leases import Leases
+
+from nighthistory import percentile
+
+
+# how often the cohort is looked at
+STRAGGLER_PERIOD = 5.
+# no eviction until the median node has gone that far (percents)
+STRAGGLER_COHORT = 50
+# a node that far behind the median is a straggler (percents)
+STRAGGLER_GAP = 30
+# never evict more than that share of a session
+STRAGGLER_SHARE = .25
+# no eviction in smaller sessions
+STRAGGLER_MIN_NODES = 4
+
+
+class CohortLoader(ImageLoader):
+    """
+    progress is a dict node_id -> percent, that the display keeps up to date;
+    on_done(node, is_ok) is called for each node as soon as it is done,
+    except for evicted nodes, that end up in self.evicted;
+    the nodes whose frisbee client ran and failed end up in self.failed;
+    capture, if set, is a function (multicast group, port) -> FrisbeeCapture,
+    see nightfrisbee.py; the traffic metrics then end up in self.traffic;
+    resent is the share of the image that had to be sent more than once,
+    or None when that is not known
+    """
+
+    def __init__(self, nodes, image, bandwidth,         # pylint: disable=r0913
+                 message_bus, display, *, progress, on_done,
+                 evict=True, period=STRAGGLER_PERIOD, capture=None):
+        super().__init__(nodes, image, bandwidth, message_bus, display)
+        self.progress = progress
+        self.on_done = on_done
+        self.evict = evict and len(nodes) >= STRAGGLER_MIN_NODES
+        self.period = period
+        self.evicted = []
+        self.failed = []
+        self.capture = capture
+        self.traffic = None
+        self.resent = None
+
+    async def authorized(self):
+        """
+        whether we hold the current lease, as ImageLoader.run() checks it
+        """
+        return await Leases(self.message_bus).booked_now_by_me()
+
+    async def run(self, reset):
+        # same as ImageLoader.run(), with the lease check on its own
+        await self.feedback('authorization', 'checking for a valid lease')
+        if not await self.authorized():
+            await self.feedback('authorization',
+                                "Access refused : you have no lease "
+                                "on the testbed at this time")
+            return False
+        await self.feedback('authorization', 'access granted')
+        await (self.stage1()
+               if reset
+               else self.feedback('info', "Skipping stage1"))
+        return await self.stage2(reset)
+
+    async def run_node(self, node, ipaddr, port, reset):
+        return await node.run_frisbee(ipaddr, port, reset)
+
+    async def stop_node(self, node):
+        """
+        make sure an evicted node's frisbee client does not go on
+        asking for retransmissions
+        """
+        await node.turn_off()
+        # or else ensure_reset() would trust the cached status
+        # and send a reset to a node that is off
+        node.status = None
+
+    async def _node(self, node, ipaddr, port, reset):
+        try:
+            is_ok = bool(await self.run_node(node, ipaddr, port, reset))
+        except asyncio.CancelledError:
+            raise
+        except Exception:                               # pylint: disable=w0703
+            is_ok = False
+        if not is_ok:
+            self.failed.append(node)
+        self.on_done(node, is_ok)
+        return is_ok
+
+    def stragglers(self, tasks):
+        """
+        the running nodes that are far behind the cohort median
+        """
+        percents = sorted(self.progress.get(node_id, 0) for node_id in tasks)
+        median = percentile(percents, .5)
+        if median < STRAGGLER_COHORT:
+            return []
+        budget = int(len(self.nodes) * STRAGGLER_SHARE) - len(self.evicted)
+        behind = sorted(
+            (node for node in self.nodes
+             if node.id in tasks and not tasks[node.id].done()
+             and self.progress.get(node.id, 0) <= median - STRAGGLER_GAP),
+            key=lambda node: self.progress.get(node.id, 0))
+        return behind[:max(0, budget)]
+
+    async def watch(self, tasks):
+        while True:
+            await asyncio.sleep(self.period)
+            for node in self.stragglers(tasks):
+                tasks.pop(node.id).cancel()
+                self.evicted.append(node)
+                await self.feedback(
+                    'info', f"evicting straggler {node.id}"
+                    f" at {self.progress.get(node.id, 0)}%")
+                await self.stop_node(node)
+
+    async def stage2(self, reset):
+        for node in self.nodes:
+            self.progress[node.id] = 0
+        ipaddr, port = await self.start_frisbeed()
+        capture = None
+        if self.capture is not None:
+            capture = self.capture(ipaddr, port)
+            await capture.start()
+        tasks = {node.id: asyncio.create_task(self._node(node, ipaddr, port, reset))
+                 for node in self.nodes}
+        running = list(tasks.values())
+        watcher = asyncio.create_task(self.watch(tasks)) if self.evict else None
+        try:
+            results = await asyncio.gather(*running, return_exceptions=True)
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            # still running if we got cancelled ourselves
+            for task in running:
+                task.cancel()
+            if capture is not None:
+                self.traffic = await capture.stop()
+                if self.traffic:
+                    self.resent = self.traffic['resent']
+        if self.frisbeed:
+            self.frisbeed.stop_nowait()
+        return all(result is True for result in results
+                   if not isinstance(result, asyncio.CancelledError))
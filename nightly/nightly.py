@@ -8,421 +8,150 @@ Features:
 (*) designed to be run on an hourly basis, at typically nn:19
     will check for a lease being currently held by nightly slice; returns if not
 (*) defaults to all nodes but can exclude some hand-picked ones on the command-line
-(*) updates sidecar status (available / unavailable)
-(*) sends status mail
-
-Performed checks on all nodes:
-
-(*) turn node on - check it answers ping
-(*) turn node off - check it does not answer ping
-(*) uses 2 reference images (typically fedora and ubuntu)
-(*) uploads first one, check for running image
-(*) uploads second one, check for running image
-
+(*) updates sidecar status (available / unavailable), through one batched session
+(*) sends status mail, through an outbox on disk so that a report that
+    cannot be delivered gets another chance at the next run, hourly
+    runs included - see nightoutbox.py
+(*) while running, keeps a live status of each node in a json file,
+    see nightstatus.py
+
+On most hours, nobody holds the nightly lease; so this entry point
+only imports what it takes to check for the current lease, and the
+actual nightly engine - see nightrun.py - is loaded only when needed.
+Use bench-startup.py to keep an eye on the cost of these common cases.
+
+With --daemon, this instead stays resident and triggers a run as soon as
+a nightly lease begins - see nightdaemon.py; concurrent runs, e.g. from
+both the daemon and the hourly timer, are prevented by a lock file, and
+a lease that has had its run already does not get another one.
 """
 
-# pylint: disable=c0111, r0201
+# pylint: disable=c0111, import-outside-toplevel
 
 import sys
-import os
-import signal
-import subprocess
 import time
-import ssl
-from enum import IntEnum
+import fcntl
+import sqlite3
+import subprocess
 from argparse import ArgumentParser
-import logging
-
-import asyncio
-
-from asyncssh import set_log_level
-
-from asynciojobs import Scheduler, Job, set_debug as set_asynciojobs_debug
-from apssh import SshNode, SshJob, load_private_keys
-
-from r2lab.sidecar import SidecarSyncClient
 
 from rhubarbe.config import Config
-from rhubarbe.imagesrepo import ImagesRepo
-from rhubarbe.display import Display
-
-from rhubarbe.node import Node
-from rhubarbe.r2labapiproxy import R2labApiProxy
 from rhubarbe.selector import (
     add_selector_arguments, selected_selector, MisformedRange)
-from rhubarbe.imageloader import ImageLoader
-from rhubarbe.ssh import SshProxy as SshWaiter
-from rhubarbe.logger import monitor_logger
 
-from nightmail import complete_html, send_email
+from nighthistory import NightlyHistory, DEFAULT_HISTORY
+from nightpriority import SWEEP_DAYS
+from nightoutbox import MailOutbox, DEFAULT_OUTBOX
+from nightstatus import DEFAULT_STATUS
 
 
 # global - need to be configurable ?
 NIGHTLY_SLICE = "r2lab-nightly"
-EMAIL_FROM = "nightly@faraday.inria.fr"
-EMAIL_TO = ["fit-r2lab-dev@inria.fr"]
-
-# ws: looked more appropriate but won't work as it turns out
-# SIDECAR_URL = "ws://r2lab-sidecar.inria.fr:443/"
-SIDECAR_URL = "wss://r2lab-sidecar.inria.fr:443/"
-SSL_ARGS = dict(
-    # we cannot verify the server certificate - as it has none for now
-    # ssl=ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)) as sidecar:
-)
-
-# each image is defined by a tuple
-#  0: image name (for rload)
-#  1: strings to expect in /etc/rhubarbe-image (any of these means it's OK)
-IMAGES_TO_CHECK = [
-    ("ubuntu-24", ["ubuntu-24", "u24"]),
-    ("fedora-41", ["fedora-41", "f41"]),
-    # ("centos-8-ssh", ["CentOS"]),
-]
-
-
-# reasons for failure
-class Reason(IntEnum):
-    WONT_TURN_ON = 1
-    WONT_TURN_OFF = 2
-    WONT_RESET = 3
-    WONT_SSH = 4
-    CANT_CHECK_IMAGE = 5
-    DID_NOT_LOAD = 6
-
-    def mail_column(self):
-        # the outgoing mail comes with 3 columns
-        # return 0 1 or 2 depending on the outgoing column
-        return (0 if self.value <= 3                   # pylint: disable=w0143
-                else 1 if self.value <= 5              # pylint: disable=w0143
-                else 2)
-
-# not sure how progressbar would behave in unattended mode
-# that would meand no terminal and so no width to display a progressbar..
-
-
-class NoProgressBarDisplay(Display):
-    def dispatch_ip_percent_hook(self, *_ignore):
-        print('.', end='', flush=True)
-
-    def dispatch_ip_tick_hook(self, *_ignore):
-        print('.', end='', flush=True)
-
-
-cached_keys = None
-
-# hacky; buggy apssh creates verbose session{start/end} messages
-def silent_sshnode(rhubarbe_node, verbose):
-    global cached_keys
-    if cached_keys is None:
-        # load keys only once
-        cached_keys = load_private_keys()
-    ssh_node = SshNode(hostname=rhubarbe_node.control_hostname(),
-                       keys=cached_keys)
-    ssh_node.formatter.verbose = verbose
-    return ssh_node
-
-
-class Nightly:                                         # pylint: disable=r0902
-
-    def __init__(self, selector, *, verbose, dry_run, speedy):
-        # work selector; will remove nodes as they fail
-        self.selector = selector
-        self.verbose = verbose
-        self.dry_run = dry_run
-        self.speedy = speedy
-        #
-        # keep a backup of initial scope for proper cleanup
-        self.all_names = list(selector.node_names())
-        # the list of failed nodes together with the reason why
-        self.failures = {}
-        #
-        # from rhubarbe config, retrieve bandwidth and other details
-        config = Config()
-        self.bandwidth = int(config.value('networking', 'bandwidth'))
-        self.backoff = int(config.value('networking', 'ssh_backoff'))
-        self.load_timeout = float(config.value('nodes', 'load_nightly_timeout'))
-        self.wait_timeout = float(config.value('nodes', 'wait_nightly_timeout'))
-        self.ssh_timeout = float(config.value('nodes', 'ssh_nightly_timeout'))
-        # explicitly call init_nodes() each time a scheduler is created
-        # any substraction (failing node) is done in mark_and_exclude()
-        # which acts directly on the selector
-        self.init_nodes()
-        if verbose:
-            monitor_logger.setLevel(logging.DEBUG)
-        else:
-            monitor_logger.setLevel(logging.INFO)
-
-
-    def init_nodes(self):
-        """
-        we need to redo this several times
-        because self.bus is attached to an asyncio loop
-        """
-        #
-        # accessories
-        self.bus = asyncio.Queue()
-        self.nodes = {Node(x, self.bus) for x in self.selector.cmc_names()}
-        self.display = NoProgressBarDisplay(self.nodes, self.bus)
-
-
-    def print(self, *args):
-        message = " ".join(str(x) for x in args)
-        self.display.dispatch(message)
-
-    def verbose_msg(self, *args):
-        if self.verbose:
-            self.print("verbose:", *args)
-
-
-    def mark_and_exclude(self, node, reason, message=None):
-        """
-        what to do when a node is found as being non-nominal
-        (*) remove it from further actions
-        (*) mark it as unavailable
-        (*) remember the reason why for producing summary
-        """
-        self.selector.add_or_delete(node.id, add_if_true=False)
-        self.failures[node.id] = reason
-        self.print(f"marking node {node.id} as unavailable for reason {reason}"
-                   f" {message or ''}")
-        try:
-            with SidecarSyncClient(SIDECAR_URL, timeout=10, **SSL_ARGS) as sidecar:
-                sidecar.set_node_attribute(node.id, 'available', 'ko')
-        except Exception as exc:
-            self.print(f"sidecar update failed for node {node.id}: {exc}")
-
-
-    def global_send_action(self, mode):
-        delay = 5.
-        self.verbose_msg(f"delay={delay}")
-        nodes = self.nodes
-        actions = (node.send_action(message=mode, check=True, check_delay=delay)
-                   for node in nodes)
-        async def gather_with_timeout(*actions, timeout):
-            return await asyncio.wait_for(
-                asyncio.gather(*actions),
-                timeout=timeout
-            )
-        with asyncio.Runner() as runner:
-            # somewhat arbitrary, but use wait_timeout
-            runner.run(
-                gather_with_timeout(
-                    *actions, timeout=self.wait_timeout))
-        reason = (
-            Reason.WONT_TURN_ON if mode == 'on'
-            else Reason.WONT_TURN_OFF if mode == 'off'
-            else Reason.WONT_RESET)
-        for node in nodes:
-            if node.action:
-                self.print(f"{node.control_hostname()}: {mode} OK")
-            else:
-                self.mark_and_exclude(
-                    node, reason, f"can't send action {mode} - delay was {delay}")
-
-
-    def global_load_image(self, image_name):
-
-        # locate image
-        the_imagesrepo = ImagesRepo()
-        actual_image = the_imagesrepo.locate_image(
-            image_name, look_in_global=True)
-        if not actual_image:
-            self.print(f"image file {image_name} not found - emergency exit")
-            exit(1)
-
-        # load image
-        self.verbose_msg(f"image={actual_image}")
-        self.verbose_msg(f"bandwidth={self.bandwidth}")
-        self.verbose_msg(f"timeout={self.load_timeout}")
-        self.init_nodes()
-        loader = ImageLoader(self.nodes, image=actual_image,
-                             bandwidth=self.bandwidth,
-                             message_bus=self.bus,
-                             display=self.display)
-        self.print(f"loading image {actual_image}"
-                   f" (timeout = {self.load_timeout})")
-        loader.main(reset=True, timeout=self.load_timeout)
-        self.print("load done")
-
-
-    def global_wait_ssh(self):
-        # wait for nodes to be ssh-reachable
-        self.print(f"waiting for {len(self.nodes)} nodes"
-                   f" (timeout={self.wait_timeout})")
-        self.init_nodes()
-        sshs = [SshWaiter(node, verbose=self.verbose) for node in self.nodes]
-        jobs = [Job(ssh.wait_for(self.backoff, timeout=self.ssh_timeout), critical=False)
-                for ssh in sshs]
-
-        scheduler = Scheduler(Job(self.display.run(), forever=True),
-                              *jobs,
-                              critical=False,
-                              timeout=self.wait_timeout)
-        if not scheduler.run():
-            self.verbose and scheduler.debrief()        # pylint: disable=w0106
-        # exclude nodes that have not behaved
-        for node, job in zip(self.nodes, jobs):
-            self.verbose_msg(
-                f"node {node.id} wait_ssh_job -> done={job.is_done()}",
-                f"exc={job.raised_exception()}")
-
-            if exc := job.raised_exception():
-                message = f"OOPS {type(exc)} {exc}"
-                self.mark_and_exclude(node, Reason.WONT_SSH, message)
-
-
-    def global_check_image(self, _image, check_strings):
-        # on the remaining nodes: check image marker
-        self.init_nodes()
-        self.print(f"checking {len(self.nodes)} nodes"
-                   f" against {check_strings} in /etc/rhubarbe-image")
-
-        grep_pattern = "|".join(check_strings)
-        check_command = (
-            f"tail -1 /etc/rhubarbe-image | grep -q -E '{grep_pattern}'")
-        jobs = [
-            SshJob(node=silent_sshnode(node, verbose=self.verbose),
-                   command=check_command,
-                   critical=False)
-            for node in self.nodes
-        ]
-
-        scheduler = Scheduler(Job(self.display.run(), forever=True),
-                              *jobs,
-                              critical=False,
-                              timeout=self.wait_timeout)
-        if not scheduler.run():
-            self.verbose and scheduler.debrief()        # pylint: disable=w0106
-        # exclude nodes that have not behaved
-        for node, job in zip(self.nodes, jobs):
-            if not job.is_done() or job.raised_exception():
-                self.verbose_msg(
-                    f"checking {grep_pattern}: something went badly wrong with {node}")
-                message = None
-                if exc := job.raised_exception():
-                    message = f"OOPS {type(exc)} {exc}"
-                self.mark_and_exclude(node, Reason.CANT_CHECK_IMAGE, message)
-                continue
-            if not job.result() == 0:
-                explanation = f"wrong image found on {node} - looking for {grep_pattern}"
-                self.verbose_msg(explanation)
-                self.mark_and_exclude(node, Reason.DID_NOT_LOAD, explanation)
-                continue
-            self.print(f"node {node} checked out OK" )
-
-
-    def current_owner(self):
-        """
-        return:
-        * None if nobody currently has a lease
-        * True if we currently have the lease
-        * False if somebody else currently has the lease
-        """
-        config = Config()
-        api_url = config.value('r2labapi', 'url')
-        proxy = R2labApiProxy(api_url)
-        current = proxy.get_current_leases()
-        if not current:
-            return None
-        for lease in current:
-            if lease.get('slice_name') == NIGHTLY_SLICE:
-                return True
+# only one actual run at a time
+LOCK_FILE = "/run/lock/r2lab-nightly.lock"
+# the hourly check should not wait on a dead MTA
+HOURLY_MAIL_BUDGET = 60.
+
+
+def current_owner():
+    """
+    return a tuple (owner, lease) where owner is
+    * None if nobody currently has a lease
+    * True if we currently have the lease
+    * False if somebody else currently has the lease
+    and lease is our current lease if owner is True
+    """
+    from rhubarbe.r2labapiproxy import R2labApiProxy
+    config = Config()
+    api_url = config.value('r2labapi', 'url')
+    proxy = R2labApiProxy(api_url)
+    current = proxy.get_current_leases()
+    if not current:
+        return None, None
+    for lease in current:
+        if lease.get('slice_name') == NIGHTLY_SLICE:
+            return True, lease
+    return False, None
+
+
+def already_run(history_path, lease):
+    """
+    whether a nightly run has started already during that lease,
+    e.g. triggered by the daemon before the hourly tick
+    """
+    from rhubarbe.r2labapiproxy import iso_to_epoch
+    try:
+        last = NightlyHistory(history_path).last_runs(1, kind='nightly')
+    except (sqlite3.Error, OSError) as exc:
+        print(f"could not check the runs in {history_path}: {exc}")
         return False
+    return bool(last) and last[0][2] >= iso_to_epoch(lease['t_from'])
+
+
+def turn_all_off(node_names, dry_run):
+    """
+    nobody is using the testbed, make sure it's off
+    """
+    if dry_run:
+        print("dry_run mode: skip all-off")
+        return
+    command = "rhubarbe bye"
+    for host in node_names:
+        command += f" {host}"
+    try:
+        subprocess.run(command, shell=True, timeout=300)
+    except subprocess.TimeoutExpired:
+        print("all_off: timed out after 300s — moving on")
 
 
-    def all_off(self):
-        if self.dry_run:
-            self.print("dry_run mode: skip all-off")
-            return
-        command = "rhubarbe bye"
-        for host in self.all_names:
-            command += f" {host}"
-        # command += "> /var/log/all-off.log"
-        try:
-            subprocess.run(command, shell=True, timeout=300)
-        except subprocess.TimeoutExpired:
-            self.print("all_off: timed out after 300s — moving on")
-
-
-    def run(self):
-        """
-        does everything and returns True if all nodes are fine
-        """
-
-        def _alarm_handler(signum, frame):
-            raise SystemExit("nightly: SIGALRM hard timeout — forcing exit")
-        signal.signal(signal.SIGALRM, _alarm_handler)
-        signal.alarm(3600)
-
-        # we have the lease, let's get down to business
-        # skip this test in dry_run mode
-        self.print(40*'=')
-        showtime = time.strftime("%Y-%m-%d@%H:%M:%S", time.localtime(time.time()))
-        self.print(f"Nightly check - starting at {showtime}")
-
-        self.print(40*'=')
-
-        self.verbose_msg(f"focus is {self.all_names}")
-
-        number_nodes = len(self.all_names)
-
-        current_owner = self.current_owner()
-        self.verbose_msg(f"current_owner={current_owner}")
-
-        # somebody else
-        if current_owner is False:
-            self.verbose_msg("somebody else owns the testbed - silently exit")
-            exit(0)
-        # nobody at all : make sure the testbed is switched off
-        elif current_owner is None:
-            self.all_off()
-            self.verbose_msg("no lease set - turning off")
-            return True
-
-        if not self.dry_run:
-            self.global_send_action('on')
-            self.global_send_action('reset')
-            self.global_send_action('off')
-        else:
-            print("nightly in dry_run mode just does ON - off and reset are skipped")
-            self.global_send_action('on')
-
-
-        images_expected = (
-            IMAGES_TO_CHECK
-            if not self.speedy
-            else IMAGES_TO_CHECK[:1])
-
-        for image, check_strings in images_expected:
-            if not self.dry_run:
-                self.global_load_image(image)
-            else:
-                print("nightly in dry_run mode won't load any image on node")
-            self.global_wait_ssh()
-            self.global_check_image(image, check_strings)
-
-        self.print("sending summary mail")
-        html = complete_html(self.all_names, self.failures)
-        if self.failures:
-            subject = (f"R2lab nightly : {len(self.failures)} issue(s)"
-                       f" on {number_nodes} node(s)")
-        else:
-            subject = (f"R2lab nightly : all is fine"
-                       f" on {number_nodes} node(s)")
-
-        if self.dry_run:
-            print("dry_run mode: sending just one mail")
-            send_email(EMAIL_FROM, ['thierry.parmentelat@inria.fr'], subject, html)
+def acquire_lock():
+    """
+    returns an open file if we got the lock, None otherwise
+    the lock is released when the process exits
+    """
+    lock = open(LOCK_FILE, 'w')                     # pylint: disable=r1732
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
+
+def without_flag(parser, argv, dest):
+    """
+    argv minus the occurrences of the boolean flag stored in dest, as
+    parser would see them: long options, possibly abbreviated, and short
+    ones, possibly clustered like in -vD - but not e.g. the D in -H/tmp/D.db
+    """
+    # pylint: disable=w0212
+    options = parser._option_string_actions
+    result, positional = [], False
+    for arg in argv:
+        if positional or not arg.startswith('-') or arg == '-':
+            result.append(arg)
+        elif arg == '--':
+            positional = True
+            result.append(arg)
+        elif arg.startswith('--'):
+            matches = {action.dest for option, action in options.items()
+                       if option.startswith(arg.split('=')[0])}
+            if matches != {dest}:
+                result.append(arg)
         else:
-            send_email(EMAIL_FROM, EMAIL_TO, subject, html)
-
-        self.print("turning off")
-        self.all_off()
-        self.print("turned off - bye")
-
-        signal.alarm(0)
-        # True means everything is OK
-        return True
+            # walk the cluster the way argparse does, until an option
+            # that takes a value swallows the rest of it
+            kept = '-'
+            for index, char in enumerate(arg[1:], 1):
+                action = options.get(f"-{char}")
+                if action is None or action.nargs != 0:
+                    kept += arg[index:]
+                    break
+                if action.dest != dest:
+                    kept += char
+            if kept != '-':
+                result.append(kept)
+    return result
 
 
 ####################
@@ -442,13 +171,114 @@ def main():
                         "won't load any image on node")
     parser.add_argument("-s", "--speedy", action='store_true', default=False,
                         help="DEBUG ONLY: will only load one image")
+    parser.add_argument("-H", "--history", default=DEFAULT_HISTORY,
+                        help="sqlite file where to record runs"
+                        " (default: %(default)s)")
+    parser.add_argument("-O", "--outbox", default=DEFAULT_OUTBOX,
+                        help="directory where reports wait for delivery"
+                        " (default: %(default)s)")
+    parser.add_argument("-S", "--status", default=DEFAULT_STATUS,
+                        help="where to keep the live status of the run,"
+                        " see nightstatus.py (default: %(default)s)")
+    parser.add_argument("-N", "--no-adaptive", dest='adaptive',
+                        action='store_false', default=True,
+                        help="use configured timeouts for all nodes,"
+                        " rather than timeouts learned from the history")
+    parser.add_argument("-C", "--cohorts", action='store_true', default=False,
+                        help="each node checks only one image per run,"
+                        " all images at the same time, and nodes take turns"
+                        " on the images from one run to the next")
+    parser.add_argument("-I", "--incremental", metavar="DAYS", type=float,
+                        nargs='?', const=SWEEP_DAYS, default=None,
+                        help="only test the nodes that need it the most,"
+                        " while testing all nodes at least once every DAYS"
+                        f" days (default: {SWEEP_DAYS:g})")
+    parser.add_argument("-c", "--capture", metavar="INTERFACE", default=None,
+                        help="analyze the frisbee traffic on that interface"
+                        " during each load; needs tcpdump")
+    parser.add_argument("-T", "--timeline", metavar="FILE", default=None,
+                        help="write the timing of the run, per stage, node"
+                        " and phase, as a Chrome trace that e.g."
+                        " ui.perfetto.dev can show")
+    parser.add_argument("-M", "--metrics", metavar="FILE", default=None,
+                        help="write the run metrics in that Prometheus textfile,"
+                        " e.g. in node_exporter's textfile collector directory")
+    parser.add_argument("-R", "--record", metavar="TRACE", default=None,
+                        help="record the run in that file,"
+                        " for replaying it with nightreplay.py")
+    parser.add_argument("-D", "--daemon", action='store_true', default=False,
+                        help="stay resident and run as soon as a nightly"
+                        " lease begins; other options are passed along")
     add_selector_arguments(parser)
 
     args = parser.parse_args()
 
+    if args.daemon:
+        from nightdaemon import run_daemon
+        nightly_argv = [__file__] + without_flag(parser, sys.argv[1:], 'daemon')
+        run_daemon(NIGHTLY_SLICE, nightly_argv, args.verbose)
+        return 0
+
     selector = selected_selector(args, defaults_to_all=True)
-    nightly = Nightly(selector,
-                      dry_run=args.dry_run, verbose=args.verbose, speedy=args.speedy)
+    node_names = list(selector.node_names())
+
+    owner, lease = current_owner()
+    if args.verbose:
+        print(f"current_owner={owner}")
+
+    # somebody else
+    if owner is False:
+        if args.verbose:
+            print("somebody else owns the testbed - silently exit")
+        return 0
+    # nobody at all : make sure the testbed is switched off
+    if owner is None:
+        if args.verbose:
+            print("no lease set - turning off")
+        # first things first, the history is just for the record
+        started = time.time()
+        turn_all_off(node_names, args.dry_run)
+        try:
+            history = NightlyHistory(args.history)
+            history.start_run('off', len(node_names), started)
+            history.end_run(0)
+        # a broken database, or a missing or read-only directory
+        except (sqlite3.Error, OSError) as exc:
+            print(f"could not record the run in {args.history}: {exc}")
+        # reports that previous runs could not deliver
+        MailOutbox(args.outbox).deliver('localhost', budget=HOURLY_MAIL_BUDGET)
+        return 0
+
+    # we have the lease, let's get down to business
+    # unless another instance is already at it
+    lock = acquire_lock()
+    if lock is None:
+        if args.verbose:
+            print("another nightly run is in progress - silently exit")
+        return 0
+    # one run per lease, or the next ones would count it twice
+    if already_run(args.history, lease):
+        if args.verbose:
+            print("this lease has had its nightly run - silently exit")
+        return 0
+
+    import logging
+    from asyncssh import set_log_level
+    from asynciojobs import set_debug as set_asynciojobs_debug
+    from nightrun import Nightly
+
+    nightly_class, more = Nightly, {}
+    if args.record:
+        from nightreplay import recording
+        nightly_class, more = recording(Nightly), dict(record=args.record)
+    nightly = nightly_class(selector,
+                            dry_run=args.dry_run, verbose=args.verbose,
+                            speedy=args.speedy,
+                            history=args.history, adaptive=args.adaptive,
+                            capture_interface=args.capture, cohorts=args.cohorts,
+                            incremental=args.incremental,
+                            timeline=args.timeline, metrics=args.metrics,
+                            outbox=args.outbox, status=args.status, **more)
 
     # turn off asyncssh info message unless verbose
     if not args.verbose:
@@ -456,7 +286,7 @@ def main():
     # temporary?
     set_asynciojobs_debug(True)
 
-    return 0 if nightly.run() else 1
+    return 0 if nightly.run(lease) else 1
 
 
 if __name__ == '__main__':
@@ -2,10 +2,18 @@
 helper functions to prepare and send a summary mail once nightly is done
 """
 
+import io
+import re
 from datetime import datetime
 import smtplib
 
 
+# the phases shown in the timing table, in pipeline order
+TIMING_COLUMNS = ['on', 'reset', 'off', 'load', 'ssh', 'check']
+# a cycle that got slower by more than that is outlined
+TREND_SLOWER = .1
+
+
 def font_color_tick(column, failed_column):
     "return a couple of style and content for a span element"
 
@@ -19,26 +27,63 @@ def font_color_tick(column, failed_column):
         else ('18px Arial, Tahoma, Sans-serif', 'gray', '&#65110;'))
 
 
-def header_line(nodenames, failures):
+def power_off_line(power_off):
     """
-    Returns a HTML fragment with an overview of the results
+    a HTML fragment about the final power-off
+    power_off maps node ids to latency in seconds, or None if it failed
     """
-    return (f"<p>On [DATE]"
-            f"<br/>Report on {len(nodenames)} nodes"
-            f"<br/>Detected {len(failures)} issues.</p>")
+    latencies = {node_id: latency for node_id, latency in power_off.items()
+                 if latency is not None}
+    failed = sorted(node_id for node_id, latency in power_off.items()
+                    if latency is None)
+    result = f"<br/>Turned off {len(latencies)} nodes"
+    if latencies:
+        slowest = max(latencies, key=latencies.get)
+        result += (f" in {max(latencies.values()):.1f}s"
+                   f" (slowest fit{slowest:02d})")
+    if failed:
+        result += (f"<br/>Could not turn off {len(failed)} nodes: "
+                   + " ".join(str(node_id) for node_id in failed))
+    return result
 
-def summary_table(nodenames, failures):
+
+def header_line(write, nodenames, failures, incomplete=(),  # pylint: disable=r0913
+                power_off=None, skipped=(), today=None):
+    """
+    writes a HTML fragment with an overview of the results
+    """
+    write(f"<p>On {today}"
+          f"<br/>Report on {len(nodenames)} nodes"
+          f"<br/>Detected {len(failures)} issues.")
+    if skipped:
+        write(f"<br/>Incremental run, {len(skipped)} nodes"
+              f" not tested this time")
+    if incomplete:
+        write(f"<br/>Ran out of time before completing {len(incomplete)} nodes:")
+        for node_id in sorted(incomplete):
+            write(f" {node_id}")
+    if power_off:
+        write(power_off_line(power_off))
+    write("</p>")
+
+
+def summary_table(write, nodenames, failures, skipped=(), today=None):
     """
     based on the failures structure that maps node ids to a failure reason
-    produce a table where eavh failed node is attached a failure reason
+    writes the rows of a table where each failed node is attached a failure reason
     """
 
     if not failures:
-        return f"<p>All {len(nodenames)} nodes were found to be fine.</p>"
+        if skipped:
+            write(f"<tr><td>All {len(nodenames) - len(skipped)} tested nodes"
+                  f" were found to be fine.</td></tr>")
+        else:
+            write(f"<tr><td>All {len(nodenames)} nodes were found to be fine.</td></tr>")
+        return
 
-    header = """<tr>
+    write(f"""<tr>
 <td style="width: 40px; text-align: center;">
- <h5><span style="background:#f0ad4e; color:#fff; padding:4px; border-radius: 5px;">[DATE]
+ <h5><span style="background:#f0ad4e; color:#fff; padding:4px; border-radius: 5px;">{today}
  </span></h5></td>
 <td style="font:11px Arial, Tahoma, Sans-serif; width: 40px; text-align: center;">
  <img src="http://r2lab.inria.fr/assets/img/nightly-power.png"
@@ -50,22 +95,75 @@ def summary_table(nodenames, failures):
  <img src="http://r2lab.inria.fr/assets/img/nightly-zombie.png"
  style="width:25px;height:25px;" />zombie</td>
 <td>&nbsp;&nbsp;</td>
-</tr>"""
+</tr>""")
 
-    result = header
     for node_id in sorted(failures):
-        reason = failures[node_id]
         # the node id badge
-        line = f"""<tr>
-<td><span class="foo"><span class="bar">{node_id}</span></span></td>"""
+        write(f"""<tr>
+<td><span class="foo"><span class="bar">{node_id}</span></span></td>""")
         # which column should be outlined
-        failed_column = reason.mail_column()
+        failed_column = failures[node_id].mail_column()
         for column in range(3):
             font, color, tick = font_color_tick(column, failed_column)
-            line += f"""<td style="text-align: center; font:{font}; color:{color}">{tick}</td>"""
-        line += "</tr>"
-        result += line
-    return result
+            write(f"""<td style="text-align: center; font:{font}; color:{color}">{tick}</td>""")
+        write("</tr>")
+
+
+def seconds(duration):
+    return "-" if duration is None else f"{duration:.0f}"
+
+
+def trend_cells(trend):
+    """
+    trend is (this week, previous week), each a tuple
+    (nb_runs, nb_failed_runs, p50 cycle) - see NightlyHistory.trends()
+    returns (failures, cycle, slower) as plain text, where slower
+    tells whether the cycle went up by more than TREND_SLOWER
+    """
+    (runs, failed, cycle), (prev_runs, prev_failed, prev_cycle) = trend
+    failures = f"{failed}/{runs} ({prev_failed}/{prev_runs})"
+    if cycle is None or not prev_cycle:
+        return failures, seconds(cycle), False
+    change = cycle / prev_cycle - 1
+    return (failures, f"{cycle:.0f} ({change:+.0%})",
+            change > TREND_SLOWER)
+
+
+def timing_table(write, durations, trends=None):
+    """
+    writes one row per node: the time spent in each phase during that run,
+    and when trends are known, how this week compares with the previous one;
+    durations maps node_id -> phase -> seconds, see NightlyHistory.run_durations()
+    """
+    if not durations:
+        return
+    trends = trends or {}
+    cell = '<td style="text-align: right; padding: 0 6px;">'
+    write('<tr><td style="padding-top: 20px;"><b>node</b></td>')
+    for column in TIMING_COLUMNS:
+        write(f"{cell}<b>{column}</b></td>")
+    write(f'{cell}<b>total</b></td>')
+    if trends:
+        write(f'{cell}<b>failed week (prev)</b></td>'
+              f'{cell}<b>cycle p50 (prev)</b></td>')
+    write("</tr>\n")
+    for node_id in sorted(durations):
+        phases = durations[node_id]
+        write(f"<tr><td>{node_id}</td>")
+        for column in TIMING_COLUMNS:
+            write(f"{cell}{seconds(phases.get(column))}</td>")
+        write(f"{cell}{seconds(sum(phases.values()))}</td>")
+        if trends:
+            trend = trends.get(node_id)
+            if trend is None:
+                write(f"{cell}-</td>{cell}-</td>")
+            else:
+                failures, cycle, slower = trend_cells(trend)
+                color = ' color: red;' if slower else ''
+                write(f'{cell}{failures}</td>'
+                      f'<td style="text-align: right; padding: 0 6px;{color}">'
+                      f'{cycle}</td>')
+        write("</tr>\n")
 
 
 def html_skeleton():
@@ -99,33 +197,123 @@ td>span.bar {
  <table style="padding: 10px;">
   [TABLE]
  </table>
+ <table style="padding: 10px; border-collapse: collapse;">
+  [TIMING]
+ </table>
 </body>
 </html>'''
     return body
 
 
+# the skeleton is split once and for all on its placeholders, into
+# literal text at even indexes and placeholder names at odd ones
+SKELETON = re.split(r"\[(HEADER|TABLE|TIMING)\]", html_skeleton())
+
+
 # entry points of interest start here
-def complete_html(nodenames, failures):
+def write_html(write, nodenames, failures,              # pylint: disable=r0913
+               incomplete=(), power_off=None, skipped=(),
+               durations=None, trends=None):
+    """
+    streams the mail body through write, e.g. a file's write method,
+    in one pass and without holding the whole document
+    """
+    today = datetime.now().strftime("%d/%m/%Y")
+    for index, piece in enumerate(SKELETON):
+        if index % 2 == 0:
+            write(piece)
+        elif piece == 'HEADER':
+            header_line(write, nodenames, failures, incomplete, power_off,
+                        skipped, today)
+        elif piece == 'TABLE':
+            summary_table(write, nodenames, failures, skipped, today)
+        elif piece == 'TIMING':
+            timing_table(write, durations, trends)
+
+
+def complete_html(nodenames, failures, incomplete=(),  # pylint: disable=r0913
+                  power_off=None, skipped=(), durations=None, trends=None):
     """
     The main entry point to the outside
     Put it all together and create the mail body
+    incomplete is the list of node ids that could not be checked in time
+    power_off is the outcome of the final power-off, see power_off_line()
+    skipped are the node ids that an incremental run left out
+    durations and trends feed the timing table, see timing_table()
     """
-    now = datetime.now()
-    today = now.strftime("%d/%m/%Y")
-    template = html_skeleton()
-    html = (template
-            .replace("[HEADER]",
-                     header_line(nodenames, failures))
-            .replace("[TABLE]",
-                     summary_table(nodenames, failures))
-            .replace("[DATE]",
-                     today))
-    return html
+    buffer = io.StringIO()
+    write_html(buffer.write, nodenames, failures, incomplete, power_off,
+               skipped, durations, trends)
+    return buffer.getvalue()
 
 
-def send_email(sender, receiver, subject, content):
+def write_text(write, nodenames, failures,              # pylint: disable=r0913
+               incomplete=(), power_off=None, skipped=(),
+               durations=None, trends=None):
     """
-    actually send email
+    the plain-text counterpart of write_html()
+    """
+    write(f"On {datetime.now():%d/%m/%Y}\n"
+          f"Report on {len(nodenames)} nodes\n"
+          f"Detected {len(failures)} issues.\n")
+    if skipped:
+        write(f"Incremental run, {len(skipped)} nodes not tested this time\n")
+    if incomplete:
+        write(f"Ran out of time before completing {len(incomplete)} nodes:")
+        for node_id in sorted(incomplete):
+            write(f" {node_id}")
+        write("\n")
+    if power_off:
+        on = [node_id for node_id, latency in power_off.items() if latency is None]
+        write(f"Turned off {len(power_off) - len(on)} nodes\n")
+        if on:
+            write(f"Could not turn off {len(on)} nodes:")
+            for node_id in sorted(on):
+                write(f" {node_id}")
+            write("\n")
+    write("\n")
+    for node_id in sorted(failures):
+        reason = failures[node_id]
+        write(f"{node_id:>5} {reason.name.lower().replace('_', ' ')}\n")
+    if not durations:
+        return
+    trends = trends or {}
+    write(f"\n{'node':>5}")
+    for column in TIMING_COLUMNS:
+        write(f" {column:>6}")
+    write(f" {'total':>6}")
+    if trends:
+        write(f" {'failed week (prev)':>18} {'cycle p50 (prev)':>16}")
+    write("\n")
+    for node_id in sorted(durations):
+        phases = durations[node_id]
+        write(f"{node_id:>5}")
+        for column in TIMING_COLUMNS:
+            write(f" {seconds(phases.get(column)):>6}")
+        write(f" {seconds(sum(phases.values())):>6}")
+        if trends:
+            trend = trends.get(node_id)
+            failures_cell, cycle, slower = (trend_cells(trend) if trend
+                                            else ('-', '-', False))
+            write(f" {failures_cell:>18} {cycle:>16}{' !' if slower else ''}")
+        write("\n")
+
+
+def complete_text(nodenames, failures, incomplete=(),  # pylint: disable=r0913
+                  power_off=None, skipped=(), durations=None, trends=None):
+    """
+    the plain-text alternative to complete_html()
+    """
+    buffer = io.StringIO()
+    write_text(buffer.write, nodenames, failures, incomplete, power_off,
+               skipped, durations, trends)
+    return buffer.getvalue()
+
+
+def compose_email(sender, receiver, subject, content, text=None):
+    """
+    the whole message as a string, ready for sending
+    text is an optional plain-text alternative to the html content
     """
     from email.mime.multipart import MIMEMultipart
     from email.mime.text import MIMEText
@@ -145,14 +333,25 @@ def send_email(sender, receiver, subject, content):
     # Attach parts into message container.
     # According to RFC 2046, the last part of a multipart message, in this case
     # the HTML message, is best and preferred.
+    if text is not None:
+        msg.attach(MIMEText(text, 'plain'))
     msg.attach(body)
+    return msg.as_string()
 
+
+def send_email(sender, receiver, subject, content, mailhost='localhost',
+               timeout=30):
+    """
+    actually send email, see nightoutbox.py for the way nightly does it
+    mailhost may come as host:port
+    """
     # Send the message via local SMTP server.
-    with smtplib.SMTP('localhost') as mailer:
+    with smtplib.SMTP(mailhost, timeout=timeout) as mailer:
         # sendmail function takes 3 arguments:
         # sender's address, recipient's address
         # and message to send - here it is sent as one string.
-        mailer.sendmail(sender, receiver, msg.as_string())
+        mailer.sendmail(sender, receiver,
+                        compose_email(sender, receiver, subject, content))
         # I take it this is taken care of by context manager
         # mailer.quit()
 
@@ -162,7 +361,7 @@ def main():
     manual unit test
     """
 
-    from nightly import Reason
+    from nightrun import Reason
 
     fake_failures = {
         30 : Reason.WONT_TURN_ON,
@@ -170,9 +369,19 @@ def main():
         37 : Reason.DID_NOT_LOAD,
     }
     fake_nodenames = [f'fit{x:02d}' for x in range(1, 11)]
+    fake_durations = {
+        x: dict(on=12., reset=40., off=8., load=180. + x, ssh=30., check=2.)
+        for x in range(1, 11)
+    }
+    fake_trends = {
+        x: ((7, x % 3, 270. + 3 * x), (7, 0, 280.))
+        for x in range(1, 11)
+    }
     with open('foo.html', 'w') as output:
-        output.write(complete_html(
-            fake_nodenames, fake_failures))
+        write_html(output.write, fake_nodenames, fake_failures,
+                   durations=fake_durations, trends=fake_trends)
+    print(complete_text(fake_nodenames, fake_failures,
+                        durations=fake_durations, trends=fake_trends))
     print('see foo.html')
 
 
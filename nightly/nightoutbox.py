@@ -0,0 +1,174 @@
+"""
+a durable outbox for the nightly reports
+
+a report is first written on disk, one file per message, and only then
+delivered; what cannot be delivered - the MTA is down, or stuck - stays
+in the outbox until a later run gets it through, be it the next nightly
+run or just the hourly check of nightly.py
+
+delivery goes through one SMTP connection for all the pending messages,
+with a timeout on every exchange and a few attempts, and optionally
+a budget for the whole of it, so that it cannot hold anything back for
+long; messages that the MTA refuses for good, and files that cannot
+be read back, are moved aside, in the 'rejected' subdirectory
+
+this is light to import, as nightly.py checks the outbox every hour
+"""
+
+# pylint: disable=c0111
+
+import os
+import json
+import time
+import fcntl
+
+
+DEFAULT_OUTBOX = "/var/lib/r2lab-nightly/outbox"
+
+# for each exchange with the MTA, connection included
+SMTP_TIMEOUT = 30.
+# how many connections to try, and how long to wait in between
+SMTP_ATTEMPTS = 3
+SMTP_BACKOFF = 10.
+
+
+def permanent(exc):
+    """
+    whether an SMTP error means that retrying is pointless
+    """
+    recipients = getattr(exc, 'recipients', None)
+    if recipients:
+        return all(code >= 500 for code, _ in recipients.values())
+    return getattr(exc, 'smtp_code', 0) >= 500
+
+
+class MailOutbox:
+
+    def __init__(self, directory=DEFAULT_OUTBOX, printer=print):
+        self.directory = directory
+        self.printer = printer
+
+    def __len__(self):
+        return len(self.pending())
+
+    def pending(self):
+        """
+        the names of the messages waiting for delivery, oldest first
+        """
+        try:
+            return sorted(name for name in os.listdir(self.directory)
+                          if name.endswith('.json'))
+        except FileNotFoundError:
+            return []
+
+    def put(self, sender, receivers, message):
+        """
+        store a message for delivery, and make sure it hits the disk;
+        message is the whole text, headers included
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory,
+                            f"{time.time():.6f}-{os.getpid()}.json")
+        temporary = f"{path}.tmp"
+        with open(temporary, 'w') as output:
+            json.dump(dict(sender=sender, receivers=receivers,
+                           queued=time.time(), message=message), output)
+            output.flush()
+            os.fsync(output.fileno())
+        os.replace(temporary, path)
+        return path
+
+    def reject(self, name, exc):
+        rejected = os.path.join(self.directory, 'rejected')
+        os.makedirs(rejected, exist_ok=True)
+        os.replace(os.path.join(self.directory, name),
+                   os.path.join(rejected, name))
+        self.printer(f"mail: {name} rejected - {exc}")
+
+    def load(self, name):
+        """
+        the envelope stored under that name, or None if it cannot be
+        read back, in which case it gets moved aside
+        """
+        try:
+            with open(os.path.join(self.directory, name)) as feed:
+                envelope = json.load(feed)
+            return envelope['sender'], envelope['receivers'], envelope['message']
+        except (OSError, ValueError, KeyError, TypeError) as exc:
+            try:
+                self.reject(name, f"unreadable - {type(exc).__name__} {exc}")
+            except OSError:
+                pass
+            return None
+
+    def deliver(self, mailhost, *, timeout=SMTP_TIMEOUT,  # pylint: disable=r0912, r0913
+                attempts=SMTP_ATTEMPTS, backoff=SMTP_BACKOFF, budget=None):
+        """
+        try and send all pending messages; this is blocking,
+        see Nightly.send_mail() for running it in a thread;
+        mailhost may come as host:port; budget, if set, bounds
+        the whole delivery, in seconds, retries included
+        returns a tuple (delivered, left)
+        """
+        deadline = None if budget is None else time.monotonic() + budget
+
+        def remaining():
+            return (timeout if deadline is None
+                    else min(timeout, deadline - time.monotonic()))
+
+        pending = self.pending()
+        if not pending:
+            return 0, 0
+        # only one process at a time, or messages could go out twice
+        lock = open(os.path.join(self.directory, '.lock'), 'w')  # pylint: disable=r1732
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            self.printer("mail: outbox busy, leaving it to the other process")
+            return 0, len(pending)
+        # pylint: disable=import-outside-toplevel
+        import smtplib
+        delivered = 0
+        try:
+            # and in case another process went through it meanwhile
+            pending = self.pending()
+            for attempt in range(1, attempts+1):
+                left = remaining()
+                if left <= 0:
+                    self.printer(f"mail: out of time after {budget:g}s")
+                    break
+                try:
+                    with smtplib.SMTP(mailhost, timeout=left) as mailer:
+                        while pending:
+                            name = pending[0]
+                            envelope = self.load(name)
+                            if envelope is None:
+                                pending.pop(0)
+                                continue
+                            left = remaining()
+                            if left <= 0:
+                                raise TimeoutError("out of time")
+                            mailer.sock.settimeout(left)
+                            try:
+                                mailer.sendmail(*envelope)
+                                os.remove(os.path.join(self.directory, name))
+                                delivered += 1
+                            except (smtplib.SMTPRecipientsRefused,
+                                    smtplib.SMTPResponseException) as exc:
+                                if not permanent(exc):
+                                    raise
+                                self.reject(name, exc)
+                            pending.pop(0)
+                    break
+                except (OSError, smtplib.SMTPException) as exc:
+                    self.printer(f"mail: attempt {attempt}/{attempts} through"
+                                 f" {mailhost} failed - {type(exc).__name__} {exc}")
+                    if attempt < attempts:
+                        time.sleep(max(0., min(backoff, remaining())))
+        finally:
+            lock.close()
+        if pending:
+            self.printer(f"mail: {len(pending)} message(s) left in"
+                         f" {self.directory} for a later run")
+        return delivered, len(pending)
@@ -0,0 +1,87 @@
+"""
+which nodes to test in an incremental run
+
+a node's priority grows with the time since its last full pass, relative
+to the sweep period, with its recent failure rate, and with the share of
+the images that it has not passed within the period
+
+nodes that have not passed within the sweep period are always tested,
+which makes for a full sweep of the testbed over that period; on top of
+these, the highest priorities fill a quota of nodes per run, so that
+the sweep gets spread over the runs of the period
+"""
+
+# pylint: disable=c0111
+
+import math
+
+DAY = 24 * 3600
+
+# the period over which every node gets tested, in days
+SWEEP_DAYS = 7.
+# how a 100% failure rate, or no image verified, compare with
+# having gone a whole sweep period without a pass
+FAILURE_WEIGHT = 1.
+UNVERIFIED_WEIGHT = .5
+
+
+class NodePriorities:                                   # pylint: disable=r0903
+    """
+    last_pass: node_id -> when the node last went through a whole run fine
+    flakiness: node_id -> (nb_runs, nb_failed_runs, _), see NightlyHistory
+    last_verified: (node_id, image) -> when the node last passed that image
+    """
+
+    def __init__(self, images, *, now, period,          # pylint: disable=r0913
+                 last_pass, flakiness, last_verified):
+        self.images = images
+        self.now = now
+        self.period = period
+        self.last_pass = last_pass
+        self.flakiness = flakiness
+        self.last_verified = last_verified
+
+    def staleness(self, node_id):
+        """
+        time since the last pass, in sweep periods; infinite if never
+        """
+        last = self.last_pass.get(node_id)
+        return math.inf if last is None else (self.now - last) / self.period
+
+    def priority(self, node_id):
+        """
+        returns (score, why)
+        """
+        staleness = self.staleness(node_id)
+        nb_runs, nb_failed, _ = self.flakiness.get(node_id, (0, 0, None))
+        failure_rate = nb_failed / nb_runs if nb_runs else 0.
+        unverified = [image for image in self.images
+                      if self.now - self.last_verified.get((node_id, image), 0)
+                      > self.period]
+        score = (staleness + FAILURE_WEIGHT * failure_rate
+                 + UNVERIFIED_WEIGHT * len(unverified) / max(1, len(self.images)))
+        why = ("never passed" if staleness == math.inf
+               else f"passed {staleness * self.period / DAY:.1f} day(s) ago")
+        if failure_rate:
+            why += f", failed {nb_failed}/{nb_runs}"
+        if unverified:
+            why += f", unverified {' '.join(unverified)}"
+        return score, why
+
+    def select(self, node_ids, quota):
+        """
+        returns the selected node ids by decreasing priority, and a dict
+        node_id -> why for all nodes; nodes that did not pass within
+        the sweep period are selected even if this goes beyond quota
+        """
+        ranked = sorted(((*self.priority(node_id), node_id) for node_id in node_ids),
+                        key=lambda item: (-item[0], item[2]))
+        overdue = {node_id for _, _, node_id in ranked
+                   if self.staleness(node_id) >= 1}
+        selected = [node_id for _, _, node_id in ranked if node_id in overdue]
+        for _, _, node_id in ranked:
+            if len(selected) >= quota:
+                break
+            if node_id not in overdue:
+                selected.append(node_id)
+        return selected, {node_id: why for _, why, node_id in ranked}
@@ -0,0 +1,115 @@
+"""
+the remote health probe run on each node once it has booted an image
+
+one ssh round trip returns the image stamp together with a few facts
+about the node - kernel, uptime, boot time, disk, interfaces, recent
+kernel errors - as marked sections, that get parsed into a dict
+"""
+
+# pylint: disable=c0111
+
+import re
+
+
+MARKER = "@@@ "
+
+# each section is allowed to fail without spoiling the others
+PROBE_COMMAND = "; ".join([
+    f"echo '{MARKER}stamp'", "cat /etc/rhubarbe-image 2>/dev/null",
+    f"echo '{MARKER}kernel'", "uname -r",
+    f"echo '{MARKER}uptime'", "cat /proc/uptime",
+    f"echo '{MARKER}btime'", "grep '^btime' /proc/stat",
+    f"echo '{MARKER}disk'", "df -P / 2>/dev/null | tail -n 1",
+    f"echo '{MARKER}links'", "ip -br link 2>/dev/null",
+    f"echo '{MARKER}dmesg'",
+    "dmesg --level=emerg,alert,crit,err 2>/dev/null | tail -n 5",
+    "true",
+])
+
+
+def sections(output):
+    """
+    section name -> list of lines
+    """
+    result, current = {}, None
+    for line in output.splitlines():
+        if line.startswith(MARKER):
+            current = line[len(MARKER):].strip()
+            result[current] = []
+        elif current is not None and line.strip():
+            result[current].append(line.strip())
+    return result
+
+
+def parse_probe(output):
+    """
+    the facts as a dict, where anything that could not be found is missing
+    """
+    found = sections(output or "")
+    facts = {}
+    if (stamps := found.get('stamp')):
+        facts['image'] = stamps[-1]
+        facts['stamps'] = len(stamps)
+    if (kernel := found.get('kernel')):
+        facts['kernel'] = kernel[0]
+    try:
+        facts['uptime'] = float(found['uptime'][0].split()[0])
+    except (KeyError, IndexError, ValueError):
+        pass
+    try:
+        facts['boot_time'] = int(found['btime'][0].split()[1])
+    except (KeyError, IndexError, ValueError):
+        pass
+    try:
+        # Filesystem 1024-blocks Used Available Capacity Mounted-on
+        fields = found['disk'][0].split()
+        facts['disk_used'] = int(fields[4].rstrip('%'))
+        facts['disk_free_mb'] = int(fields[3]) // 1024
+    except (KeyError, IndexError, ValueError):
+        pass
+    if 'links' in found:
+        facts['links'] = {
+            fields[0].split('@')[0]: fields[1]
+            for fields in (line.split() for line in found['links'])
+            if len(fields) >= 2}
+    if 'dmesg' in found:
+        facts['dmesg_errors'] = found['dmesg']
+    return facts
+
+
+def image_matches(facts, check_strings):
+    """
+    like grep -E on the last line of the image stamp
+    """
+    return bool(re.search("|".join(check_strings), facts.get('image', "")))
+
+
+def describe(facts):
+    """
+    a one-liner for the logs and the mail
+    """
+    if not facts:
+        return "no facts"
+    parts = []
+    # from the pre-flight triage
+    if 'cmc' in facts:
+        parts.append(f"cmc {facts['cmc'] or 'unreachable'}")
+        parts.append("pings" if facts.get('ping') else "no ping")
+        if facts.get('banner'):
+            parts.append(facts['banner'])
+        return ", ".join(parts)
+    if 'kernel' in facts:
+        parts.append(f"kernel {facts['kernel']}")
+    if 'uptime' in facts:
+        parts.append(f"up {facts['uptime']:.0f}s")
+    if 'disk_used' in facts:
+        parts.append(f"disk {facts['disk_used']}%")
+    down = [name for name, state in facts.get('links', {}).items()
+            if state == 'DOWN']
+    if down:
+        parts.append(f"down: {','.join(down)}")
+    if facts.get('dmesg_errors'):
+        parts.append(f"{len(facts['dmesg_errors'])} dmesg error(s)")
+    if 'image' not in facts:
+        parts.append("no image stamp")
+    return ", ".join(parts)
@@ -0,0 +1,723 @@
+#!/usr/bin/env python3
+
+"""
+recording a nightly run, and replaying it without the testbed
+
+a recorded run writes a trace, one JSON entry per line, with all its
+interactions with the outside world, each with when it started and how
+long it took: CMC requests, ping and ssh banners, ssh connections and
+commands, the lease check and the frisbee progress of the loads, sidecar
+updates, plus the decisions that the run took from its lease and its
+history - time budget, deadlines, bandwidth, which node checks which
+image - and how it ended
+
+replaying a trace runs the actual nightly engine again, on the same
+nodes, with the recorded outcomes fed back to it; outcomes are looked up
+by kind, node and rank, so they do not depend on how the nodes interleave;
+with a time scale of 1 the replay goes at the recorded speed, with 0 it
+goes as fast as it can, which makes it a way to profile the orchestration
+itself; the replay compares how the run ended with the recorded one
+
+the calls that are made of other calls - a CMC action and its status
+check, a node reset, a frisbee client - are recorded as a whole,
+together with the state of the node afterwards
+
+    nightly.py --record /var/log/nightly.trace
+    nightreplay.py /var/log/nightly.trace --time-scale 0
+"""
+
+# pylint: disable=c0111
+
+import sys
+import json
+import time
+import asyncio
+import contextvars
+from types import SimpleNamespace
+from functools import partial
+from collections import defaultdict
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+from rhubarbe.node import Node
+from rhubarbe.display import DisplayNode
+
+from nightrun import Nightly, NoProgressBarDisplay
+from nightload import CohortLoader
+from nightsidecar import SidecarPublisher
+from nightssh import SshPool
+from nightbudget import TimeBudget
+from nighthistory import percentile
+
+
+# set while within a call that is recorded as a whole
+inside_composite = contextvars.ContextVar('inside_composite', default=False)
+
+
+def node_id_arg(node, *_args, **_kwds):
+    return node.id
+
+
+##########
+# recording
+class Recorder:
+    """
+    writes a trace; calls come with a kind, a node id or None, when they
+    started (t) and how long they took, in seconds since the recorder was
+    created, and either an outcome, or cancelled, or an error;
+    notes are entries without a duration
+    """
+
+    def __init__(self, path):
+        self.output = open(path, 'w')                   # pylint: disable=r1732
+        self.started = time.monotonic()
+        # node_id -> [(t, percent)], as shown by the display
+        self.percents = defaultdict(list)
+        self.entries = 0
+
+    def now(self):
+        return time.monotonic() - self.started
+
+    def write(self, entry):
+        self.output.write(json.dumps(entry) + "\n")
+        self.entries += 1
+
+    def note(self, kind, **data):
+        self.write(dict(kind=kind, t=self.now(), **data))
+
+    async def call(self, kind, node_id, coro, *,        # pylint: disable=r0913
+                   outcome=None, state=None, extras=None):
+        """
+        run coro and record how it went
+        outcome turns the result into something that JSON can take;
+        state, if set, makes it a composite call: a function node_id -> dict
+        that gets recorded on success, while the calls made within are not
+        recorded on their own; extras is a function entry -> dict
+        """
+        if inside_composite.get():
+            return await coro
+        entry = dict(kind=kind, node=node_id, t=self.now())
+        token = inside_composite.set(True) if state else None
+        try:
+            result = await coro
+            entry['outcome'] = outcome(result) if outcome else result
+            if state:
+                entry['state'] = state(node_id)
+            return result
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            entry['cancelled'] = True
+            raise
+        except Exception as exc:
+            entry['error'] = f"{type(exc).__name__}: {exc}"
+            raise
+        finally:
+            if token is not None:
+                inside_composite.reset(token)
+            entry['duration'] = self.now() - entry['t']
+            if extras:
+                entry.update(extras(entry))
+            self.write(entry)
+
+    def wrap(self, obj, name, kind, node_id=None, **kwds):
+        """
+        have the calls to obj.name - a coroutine method - recorded;
+        kind and node_id can be functions of the call arguments
+        """
+        method = getattr(obj, name)
+
+        async def recorded(*args, **call_kwds):
+            return await self.call(
+                kind(*args, **call_kwds) if callable(kind) else kind,
+                node_id(*args, **call_kwds) if callable(node_id) else node_id,
+                method(*args, **call_kwds), **kwds)
+        setattr(obj, name, recorded)
+
+    def close(self):
+        self.output.close()
+
+
+def cmc_kind(verb, *_args, **_kwds):
+    return f"cmc-{verb}"
+
+
+def ssh_outcome(completed):
+    return dict(exit_status=completed.exit_status, stdout=completed.stdout)
+
+
+class Recording:
+    """
+    a mixin for Nightly, or any of its subclasses, see recording()
+    """
+
+    def __init__(self, *args, record, **kwds):
+        super().__init__(*args, **kwds)
+        self.recorder = recorder = Recorder(record)
+        for node in self.nodes:
+            recorder.wrap(node, '_get_cmc_verb', cmc_kind, node.id)
+            recorder.wrap(node, 'send_action', 'action', node.id,
+                          outcome=lambda _: None, state=self.node_state)
+            recorder.wrap(node, 'ensure_reset', 'reset', node.id,
+                          state=self.node_state)
+        recorder.wrap(self.ssh, 'wait', 'ssh-wait', node_id_arg)
+        recorder.wrap(self.ssh, 'run', 'ssh-run', node_id_arg,
+                      outcome=ssh_outcome)
+        recorder.wrap(self.sidecar, 'flush', 'sidecar')
+        # the frisbee progress, as it comes through the message bus
+        display = self.display
+        hook = display.dispatch_ip_percent_hook
+
+        def percent_hook(ipaddr, node, message, *args):
+            hook(ipaddr, node, message, *args)
+            recorder.percents[display.nodes[node.rank].id].append(
+                (recorder.now(), int(message['percent'])))
+        display.dispatch_ip_percent_hook = percent_hook
+        recorder.note('nodes', nodes=[
+            dict(id=node.id, hostname=node.control_hostname(),
+                 ip=node.control_ip_address(), mac=node.control_mac_address())
+            for node in self.nodes])
+        recorder.note('options', names=self.all_names, dry_run=self.dry_run,
+                      speedy=self.speedy, cohorts=self.cohorts,
+                      incremental=self.incremental, load_linger=self.load_linger,
+                      off_verify=self.off_verify, off_poll=self.off_poll)
+
+    def node_state(self, node_id):
+        node = self.nodes[node_id]
+        return dict(status=node.status, action=node.action)
+
+    def lease_budget(self):
+        budget = super().lease_budget()
+        self.recorder.note('budget', lease=self.lease, total=budget.remaining(),
+                           reserve=budget.reserve)
+        return budget
+
+    def compute_deadlines(self):
+        super().compute_deadlines()
+        phases = list(self.deadlines.defaults)
+        self.recorder.note('deadlines', nodes={
+            node.id: {
+                phase: [self.deadlines.timeout(node.id, phase)
+                        if phase in phases else None,
+                        self.deadlines.norm(node.id, phase)]
+                for phase in phases + ['triage']}
+            for node in self.nodes})
+
+    def compute_bandwidth(self):
+        super().compute_bandwidth()
+        self.recorder.note('bandwidth', value=self.bandwidth)
+
+    def plan_images(self, images):
+        plan = super().plan_images(images)
+        self.recorder.note('plan', skipped=sorted(self.skipped), plan={
+            node_id: [image for image, _ in planned]
+            for node_id, planned in plan.items()})
+        return plan
+
+    def make_loader(self, batch, actual_image, *, evict, on_done):
+        loader = super().make_loader(batch, actual_image,
+                                     evict=evict, on_done=on_done)
+        recorder = self.recorder
+        # how the batch entries get looked up
+        key = min(node.id for node in batch)
+
+        def frisbee_extras(entry):
+            started = entry['t']
+            return dict(
+                percents=[(round(moment - started, 3), percent)
+                          for moment, percent in recorder.percents[entry['node']]
+                          if moment >= started],
+                evicted=any(node.id == entry['node'] for node in loader.evicted))
+        recorder.wrap(loader, 'authorized', 'lease', key)
+        recorder.wrap(loader, 'stage1', 'stage1', key)
+        recorder.wrap(loader, 'run_node', 'frisbee', node_id_arg, outcome=bool,
+                      state=self.node_state, extras=frisbee_extras)
+        return loader
+
+    async def ping(self, node, timeout):
+        return await self.recorder.call(
+            'ping', node.id, super().ping(node, timeout))
+
+    async def ssh_banner(self, node, timeout):
+        return await self.recorder.call(
+            'banner', node.id, super().ssh_banner(node, timeout))
+
+    async def send_mail(self, receivers, subject, html, text=None):
+        self.recorder.note('mail', receivers=receivers, subject=subject)
+        await super().send_mail(receivers, subject, html, text)
+
+    async def main(self):
+        try:
+            return await super().main()
+        finally:
+            self.recorder.note(
+                'end', wall=self.recorder.now(),
+                failures={node_id: reason.name
+                          for node_id, reason in self.failures.items()},
+                completed=sorted(self.completed),
+                incomplete=self.incomplete(), skipped=sorted(self.skipped))
+            self.recorder.close()
+
+
+def recording(nightly_class):
+    """
+    the subclass of nightly_class that records its run; it takes
+    one more keyword argument record, the file where to write the trace
+    """
+    return type(f"Recording{nightly_class.__name__}",
+                (Recording, nightly_class), {})
+
+
+##########
+# replaying
+class ReplayedError(Exception):
+    """
+    what a recorded call raised, e.g. an ssh failure
+    """
+
+
+class Trace:
+    """
+    a recorded run, ready to be replayed at that time scale
+    """
+
+    def __init__(self, path, time_scale=1.):
+        self.time_scale = time_scale
+        # kind -> entry, for the notes
+        self.notes = {}
+        # (kind, node_id) -> the entries for these calls, in order
+        self.calls = defaultdict(list)
+        with open(path) as feed:
+            for line in feed:
+                entry = json.loads(line)
+                if 'duration' in entry:
+                    self.calls[(entry['kind'], entry['node'])].append(entry)
+                else:
+                    self.notes[entry['kind']] = entry
+        for entries in self.calls.values():
+            entries.sort(key=lambda entry: entry['t'])
+        self.nodes = {info['id']: info for info in self.notes['nodes']['nodes']}
+        # (kind, node_id) -> how many have been replayed
+        self.cursors = defaultdict(int)
+        # kind -> how many calls had no record at all
+        self.misses = defaultdict(int)
+        # how many calls went beyond their records, and got the last one
+        self.repeats = 0
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.calls.values())
+
+    def next(self, kind, node_id):
+        """
+        the entry for the next such call, or None if there is none;
+        past the recorded ones, the last one is served again,
+        e.g. a CMC that keeps being asked answers as it last did
+        """
+        entries = self.calls.get((kind, node_id))
+        if not entries:
+            self.misses[kind] += 1
+            return None
+        index = self.cursors[(kind, node_id)]
+        self.cursors[(kind, node_id)] += 1
+        if index >= len(entries):
+            self.repeats += 1
+            return entries[-1]
+        return entries[index]
+
+    def unused(self):
+        return sum(max(0, len(entries) - self.cursors[key])
+                   for key, entries in self.calls.items())
+
+    async def sleep(self, duration, started=None):
+        """
+        sleep for that recorded duration, or what is left of it
+        if a time.monotonic() start is given
+        """
+        delay = duration * self.time_scale
+        if started is not None:
+            delay -= time.monotonic() - started
+        await asyncio.sleep(max(0., delay))
+
+    async def replay(self, kind, node_id):
+        """
+        returns the entry after its scaled duration, or None;
+        a call that was cancelled, typically by a timeout, times out
+        """
+        entry = self.next(kind, node_id)
+        if entry is None:
+            return None
+        await self.sleep(entry['duration'])
+        if entry.get('cancelled'):
+            raise asyncio.TimeoutError(f"replayed {kind} on {node_id}")
+        if 'error' in entry:
+            raise ReplayedError(entry['error'])
+        return entry
+
+
+class ReplayNode(Node):
+
+    def __init__(self, trace, cmc_name, message_bus):
+        super().__init__(cmc_name, message_bus)
+        self.trace = trace
+        self.info = trace.nodes[self.id]
+
+    def control_hostname(self):
+        return self.info['hostname']
+
+    def control_ip_address(self):
+        return self.info['ip']
+
+    def control_mac_address(self):
+        return self.info['mac']
+
+    def manage_nextboot_symlink(self, action):
+        pass
+
+    def restore(self, entry):
+        if entry is not None and 'state' in entry:
+            self.status = entry['state']['status']
+            self.action = entry['state']['action']
+
+    async def _get_cmc_verb(self, verb, strip_result=True):
+        entry = await self.trace.replay(f"cmc-{verb}", self.id)
+        setattr(self, verb, None if entry is None else entry['outcome'])
+        return getattr(self, verb)
+
+    async def send_action(self, message="on", check=False, check_delay=1.):
+        entry = await self.trace.replay('action', self.id)
+        self.action = None
+        self.restore(entry)
+        return self
+
+    async def ensure_reset(self):
+        self.restore(await self.trace.replay('reset', self.id))
+
+
+class ReplaySshPool(SshPool):
+
+    def __init__(self, trace):
+        super().__init__(connect=None)
+        self.trace = trace
+        self.replayed = 0
+
+    async def wait(self, node, backoff, timeout):
+        if await self.trace.replay('ssh-wait', node.id) is None:
+            raise ConnectionError(f"no recorded ssh for node {node.id}")
+        self.replayed += 1
+
+    async def run(self, node, command, timeout):
+        entry = await self.trace.replay('ssh-run', node.id)
+        if entry is None:
+            raise ConnectionError(f"no recorded ssh for node {node.id}")
+        self.replayed += 1
+        return SimpleNamespace(**entry['outcome'])
+
+    def summary(self):
+        return f"ssh: {self.replayed} call(s) replayed"
+
+
+class ReplaySidecar(SidecarPublisher):
+
+    def __init__(self, trace, printer):
+        super().__init__(None, printer=printer)
+        self.trace = trace
+
+    async def flush(self):
+        if not self.pending:
+            return True
+        batch, self.pending = self.pending, {}
+        try:
+            entry = await self.trace.replay('sidecar', None)
+        except asyncio.TimeoutError:
+            self.pending = {**batch, **self.pending}
+            raise
+        if entry is not None and not entry['outcome']:
+            for key, value in batch.items():
+                self.pending.setdefault(key, value)
+            return False
+        self.published.update(batch)
+        self.sent_batches += 1
+        self.sent_triples += len(batch)
+        return True
+
+
+class ReplayLoader(CohortLoader):
+    """
+    the frisbee clients report the recorded progress, and the evictions
+    happen as recorded, so there is no need to watch for stragglers
+    """
+
+    def __init__(self, nightly, nodes, actual_image, *, on_done):
+        super().__init__(nodes, actual_image, nightly.bandwidth, nightly.bus,
+                         nightly.display, progress=nightly.display.progress,
+                         on_done=on_done, evict=False)
+        self.trace = nightly.trace
+        self.key = min(node.id for node in nodes)
+
+    async def authorized(self):
+        entry = await self.trace.replay('lease', self.key)
+        return entry is None or entry['outcome']
+
+    async def stage1(self):
+        started = time.monotonic()
+        entry = self.trace.next('stage1', self.key)
+        await asyncio.gather(*(node.ensure_reset() for node in self.nodes))
+        if entry is not None:
+            await self.trace.sleep(entry['duration'], started)
+
+    async def start_frisbeed(self):
+        return 'replay', 0
+
+    async def run_node(self, node, ipaddr, port, reset):
+        trace = self.trace
+        entry = trace.next('frisbee', node.id)
+        if entry is None:
+            return False
+        started = time.monotonic()
+        for offset, percent in entry['percents']:
+            await trace.sleep(offset, started)
+            await node.feedback('percent', percent)
+        await trace.sleep(entry['duration'], started)
+        if entry['evicted']:
+            self.evicted.append(node)
+            await self.feedback(
+                'info', f"evicting straggler {node.id}"
+                f" at {self.progress.get(node.id, 0)}%")
+            await self.stop_node(node)
+            raise asyncio.CancelledError
+        if entry.get('cancelled'):
+            raise asyncio.TimeoutError(f"replayed frisbee on {node.id}")
+        if 'error' in entry:
+            raise ReplayedError(entry['error'])
+        node.restore(entry)
+        return entry['outcome']
+
+    def nextboot_cleanup(self):
+        pass
+
+
+class ReplayDisplay(NoProgressBarDisplay):
+    """
+    same as the nightly display, without the inventory lookups
+    """
+
+    def __init__(self, nodes, message_bus):
+        super().__init__(nodes, message_bus)
+        for rank, node in enumerate(nodes):
+            self._display_node_by_ip[node.control_ip_address()] = \
+                DisplayNode(node.control_hostname(), rank)
+
+
+class TraceSelector:
+
+    def __init__(self, trace):
+        self.trace = trace
+
+    def node_names(self):
+        return self.trace.notes['options']['names']
+
+    def cmc_names(self):
+        return [f"reboot{node_id:02}" for node_id in self.trace.nodes]
+
+
+class RecordedDeadlines:
+    """
+    the AdaptiveDeadlines of the recorded run
+    """
+
+    def __init__(self, deadlines):
+        # node_id -> phase -> (timeout, norm)
+        self.deadlines = {int(node_id): phases
+                          for node_id, phases in deadlines.items()}
+
+    def timeout(self, node_id, phase):
+        return self.deadlines[node_id][phase][0]
+
+    def norm(self, node_id, phase):
+        return self.deadlines.get(node_id, {}).get(phase, (None, None))[1]
+
+
+class ReplayNightly(Nightly):
+    """
+    a Nightly that replays a trace; it takes the recorded decisions
+    instead of looking at its lease and history, and waits at the time
+    scale of the trace, except for the deadlines that would only
+    fire on cancelled calls, that get replayed as timeouts anyway;
+    at time scale 0, the time budget is the recorded one
+    """
+
+    display_class = ReplayDisplay
+
+    def __init__(self, trace, *, verbose=False, monitor=None):
+        self.trace = trace
+        options = trace.notes['options']
+        super().__init__(TraceSelector(trace), verbose=verbose,
+                         dry_run=options['dry_run'], speedy=options['speedy'],
+                         history=':memory:', cohorts=options['cohorts'],
+                         incremental=options['incremental'],
+                         node_factory=partial(ReplayNode, trace))
+        self.sidecar = ReplaySidecar(trace, printer=self.print)
+        self.ssh = ReplaySshPool(trace)
+        self.load_linger = options['load_linger'] * trace.time_scale
+        self.off_verify = options['off_verify'] * trace.time_scale
+        self.off_poll = options['off_poll'] * trace.time_scale
+        self.evict_stragglers = False
+        # see nightsim.LoopMonitor
+        self.monitor = monitor
+        self.subject = None
+
+    def plan(self):
+        return {int(node_id): images for node_id, images
+                in self.trace.notes['plan']['plan'].items()}
+
+    def lease_budget(self):
+        budget = self.trace.notes['budget']
+        scale = self.trace.time_scale or 1.
+        return TimeBudget(budget['total'] * scale, budget['reserve'] * scale)
+
+    def compute_deadlines(self):
+        self.deadlines = RecordedDeadlines(self.trace.notes['deadlines']['nodes'])
+
+    def compute_bandwidth(self):
+        self.bandwidth = self.trace.notes['bandwidth']['value']
+        self.print(f"load bandwidth {self.bandwidth} Mibps - as recorded")
+
+    def affordable_images(self, power_modes, images):
+        planned = {image for images in self.plan().values() for image in images}
+        return [(image, checks) for image, checks in images
+                if image in planned] or images
+
+    def select_nodes(self, images):
+        alive = {node.id for node in self.nodes.alive()}
+        self.skipped = set(self.trace.notes['plan']['skipped']) & alive
+        for node_id in self.skipped:
+            self.nodes.exclude(node_id)
+
+    def plan_images(self, images):
+        checks = dict(images)
+        plan = self.plan()
+        return {node.id: [(image, checks[image]) for image in plan.get(node.id, [])
+                          if image in checks]
+                for node in self.nodes.alive()}
+
+    def locate_image(self, image_name):
+        return f"/replay/images/{image_name}.ndz"
+
+    def make_loader(self, batch, actual_image, *, evict, on_done):
+        return ReplayLoader(self, batch, actual_image, on_done=on_done)
+
+    async def ping(self, node, timeout):
+        entry = await self.trace.replay('ping', node.id)
+        return bool(entry and entry['outcome'])
+
+    async def ssh_banner(self, node, timeout):
+        entry = await self.trace.replay('banner', node.id)
+        return entry['outcome'] if entry else None
+
+    async def send_mail(self, receivers, subject, html, text=None):
+        self.subject = subject
+        self.print(f"not sending mail {subject!r}")
+
+    async def main(self):
+        monitor_task = (asyncio.create_task(self.monitor.run())
+                        if self.monitor else None)
+        try:
+            return await super().main()
+        finally:
+            if monitor_task:
+                monitor_task.cancel()
+
+    def differences(self):
+        """
+        how this replay ended differently from the recorded run
+        """
+        end = self.trace.notes.get('end')
+        mail = self.trace.notes.get('mail')
+        if end is None:
+            return ["the trace has no end, the recorded run did not complete"]
+        result = []
+        recorded = {int(node_id): reason
+                    for node_id, reason in end['failures'].items()}
+        replayed = {node_id: reason.name
+                    for node_id, reason in self.failures.items()}
+        for node_id in sorted(recorded.keys() | replayed.keys()):
+            if recorded.get(node_id) != replayed.get(node_id):
+                result.append(f"node {node_id} failed with"
+                              f" {recorded.get(node_id)} - replayed with"
+                              f" {replayed.get(node_id)}")
+        if set(end['completed']) != self.completed:
+            result.append(f"{len(end['completed'])} node(s) completed"
+                          f" - replayed {len(self.completed)}")
+        if mail and mail['subject'] != self.subject:
+            result.append(f"mail subject {mail['subject']!r}"
+                          f" - replayed {self.subject!r}")
+        return result
+
+
+def replay(path, time_scale=1., verbose=False):
+    """
+    replay one trace; returns the metrics as a dict
+    """
+    # pylint: disable=import-outside-toplevel
+    from nightsim import LoopMonitor, resources
+    trace = Trace(path, time_scale)
+    nightly = ReplayNightly(trace, verbose=verbose, monitor=LoopMonitor())
+    before = resources()
+    nightly.run(None)
+    after = resources()
+    lags = sorted(lag for _, lag in nightly.monitor.samples)
+    end = trace.notes.get('end', {})
+    return dict(
+        nodes=len(nightly.nodes), calls=len(trace), time_scale=time_scale,
+        recorded_wall=end.get('wall'),
+        wall=after[0] - before[0], cpu=after[1] - before[1], maxrss=after[2],
+        lag_p99=percentile(lags, .99) or 0., lag_max=max(lags, default=0.),
+        misses=dict(trace.misses), repeats=trace.repeats, unused=trace.unused(),
+        failures=len(nightly.failures), completed=len(nightly.completed),
+        differences=nightly.differences())
+
+
+def report(result):
+    recorded = result['recorded_wall']
+    lines = [
+        f"{result['nodes']} nodes, {result['calls']} recorded call(s)"
+        f" at time scale {result['time_scale']:g}:"
+        f" wall {result['wall']:.1f}s"
+        + (f" (recorded {recorded:.1f}s)" if recorded is not None else "")
+        + f" cpu {result['cpu']:.1f}s maxrss {result['maxrss']:.0f}MiB"
+        f" loop lag p99 {result['lag_p99']*1000:.1f}ms"
+        f" max {result['lag_max']*1000:.1f}ms",
+        f"  {result['completed']} completed, {result['failures']} failed;"
+        f" {result['unused']} record(s) unused, {result['repeats']} repeated,"
+        f" missing: {' '.join(f'{kind}={count}' for kind, count in result['misses'].items()) or 'none'}",
+    ]
+    if result['differences']:
+        lines.append("  differences with the recorded run:")
+        lines.extend(f"    {difference}" for difference in result['differences'])
+    else:
+        lines.append("  same outcome as the recorded run")
+    return "\n".join(lines)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__,
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("trace", help="as written by nightly.py --record")
+    parser.add_argument("-t", "--time-scale", type=float, default=1.,
+                        help="multiplies recorded durations; 0 means"
+                        " as fast as possible (%(default)s)")
+    parser.add_argument("-f", "--fast", dest='time_scale', action='store_const',
+                        const=0., help="same as --time-scale 0")
+    parser.add_argument("-j", "--json", default=None,
+                        help="also store the metrics in that file")
+    parser.add_argument("-v", "--verbose", action='store_true', default=False)
+    args = parser.parse_args()
+
+    result = replay(args.trace, args.time_scale, args.verbose)
+    # the nightly output goes on stdout
+    print(report(result), file=sys.stderr)
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(result, output, indent=2)
+    return 1 if result['differences'] else 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,1118 @@
+"""
+The nightly engine, i.e. what happens once nightly.py has figured out
+that we currently hold the nightly lease
+
+Performed checks on all nodes:
+
+(*) pre-flight: CMC status and ping, so that dead nodes are out early
+(*) turn node on - check it answers ping
+(*) turn node off - check it does not answer ping
+(*) uses 2 reference images (typically fedora and ubuntu)
+(*) uploads first one, check for running image
+(*) uploads second one, check for running image
+(*) or in cohort mode, each node checks only one of the images,
+    and the images take turns from one run to the next (see nightcohorts.py)
+
+In incremental mode, only the nodes that need it the most get tested,
+see nightpriority.py.
+
+A run can be recorded, and replayed later on without the testbed,
+see nightreplay.py.
+
+Each node goes through these steps on its own (see Nightly.node_pipeline),
+so a slow or broken node does not hold back the others; the only thing
+that nodes share is the multicast session for loading a given image
+(see ImageSession).
+
+This module is heavy to import, and so is only loaded when needed.
+"""
+
+# pylint: disable=c0111, r0201
+
+import time
+import math
+import ssl
+from enum import IntEnum
+import logging
+
+import asyncio
+
+import asyncssh
+from apssh import load_private_keys
+
+from rhubarbe.config import Config
+from rhubarbe.imagesrepo import ImagesRepo
+from rhubarbe.display import Display
+
+from rhubarbe.node import Node
+from rhubarbe.r2labapiproxy import iso_to_epoch
+from rhubarbe.logger import monitor_logger
+
+from nightmail import complete_html, complete_text, compose_email
+from nightoutbox import MailOutbox, DEFAULT_OUTBOX
+from nightsidecar import SidecarPublisher
+from nighthistory import NightlyHistory, AdaptiveDeadlines, DEFAULT_HISTORY
+from nightbudget import TimeBudget
+from nightbandwidth import AdaptiveBandwidth
+from nightssh import SshPool
+from nightload import CohortLoader, STRAGGLER_PERIOD
+from nightfrisbee import FrisbeeCapture, describe as describe_traffic
+from nightcohorts import assign_cohorts, overdue
+from nightpriority import NodePriorities, DAY
+from nightstatus import StatusBoard
+from nighttrace import Tracer, RUN
+from nightprobe import PROBE_COMMAND, parse_probe, image_matches, describe
+import nighttriage
+
+
+# global - need to be configurable ?
+EMAIL_FROM = "nightly@faraday.inria.fr"
+EMAIL_TO = ["fit-r2lab-dev@inria.fr"]
+
+# ws: looked more appropriate but won't work as it turns out
+# SIDECAR_URL = "ws://r2lab-sidecar.inria.fr:443/"
+SIDECAR_URL = "wss://r2lab-sidecar.inria.fr:443/"
+SSL_ARGS = dict(
+    # we cannot verify the server certificate - as it has none for now
+    # ssl=ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)) as sidecar:
+)
+
+# each image is defined by a tuple
+#  0: image name (for rload)
+#  1: strings to expect in /etc/rhubarbe-image (any of these means it's OK)
+IMAGES_TO_CHECK = [
+    ("ubuntu-24", ["ubuntu-24", "u24"]),
+    ("fedora-41", ["fedora-41", "f41"]),
+    # ("centos-8-ssh", ["CentOS"]),
+]
+
+
+# reasons for failure
+class Reason(IntEnum):
+    WONT_TURN_ON = 1
+    WONT_TURN_OFF = 2
+    WONT_RESET = 3
+    WONT_SSH = 4
+    CANT_CHECK_IMAGE = 5
+    DID_NOT_LOAD = 6
+
+    def mail_column(self):
+        # the outgoing mail comes with 3 columns
+        # return 0 1 or 2 depending on the outgoing column
+        return (0 if self.value <= 3                   # pylint: disable=w0143
+                else 1 if self.value <= 5              # pylint: disable=w0143
+                else 2)
+
+# not sure how progressbar would behave in unattended mode
+# that would meand no terminal and so no width to display a progressbar..
+
+
+class NoProgressBarDisplay(Display):
+    def __init__(self, nodes, message_bus):
+        super().__init__(nodes, message_bus)
+        # node_id -> the last load percentage it reported
+        self.progress = {}
+        # set by Nightly, see nightstatus.py
+        self.status = None
+
+    def dispatch_ip_percent_hook(self, ipaddr, node, message, *_ignore):
+        node_id = self.nodes[node.rank].id
+        self.progress[node_id] = message['percent']
+        if self.status is not None:
+            self.status.update(node_id, percent=message['percent'])
+        print('.', end='', flush=True)
+
+    def dispatch_ip_tick_hook(self, *_ignore):
+        print('.', end='', flush=True)
+
+
+cached_keys = None
+
+def private_keys():
+    global cached_keys
+    if cached_keys is None:
+        # load keys only once
+        cached_keys = load_private_keys()
+    return cached_keys
+
+
+# how long an image session waits for latecomers before it starts
+# a multicast load on the nodes that have shown up so far
+LOAD_LINGER = 15.
+
+# in case the lease end cannot be figured out
+LEASE_DURATION = 3600
+# at the end of the lease, keep that much time for sending the report
+# and turning off the testbed
+BUDGET_RESERVE = 240
+
+# when turning off the testbed: how many nodes are handled at the same
+# time, how many attempts at most, and how long to wait for a node
+# to report being off after it's been told to
+OFF_PARALLELISM = 16
+OFF_ATTEMPTS = 3
+OFF_VERIFY = 10.
+OFF_POLL = 1.
+
+# the pre-flight triage: how long to wait for a CMC or a node to answer,
+# and how many nodes are looked at the same time
+TRIAGE_TIMEOUT = 3.
+TRIAGE_PARALLELISM = 256
+
+# a node that takes that many times its usual duration on a phase
+# gets reported right away, without waiting for the phase timeout
+SLOW_FACTOR = 3.
+
+
+class ImageSession:
+    """
+    the multicast load of one image is the only step that nodes need
+    to go through together; nodes join the session when they are ready,
+    and a frisbee session gets fired as soon as all the nodes still
+    expected have shown up, or after nightly.load_linger seconds otherwise;
+    latecomers are then served by a subsequent frisbee session
+
+    each node is released as soon as its own load is over; the stragglers
+    that get evicted from a frisbee session - see nightload.py - are
+    served by a catch-up session once the main one is over
+    """
+
+    def __init__(self, nightly, image_name, actual_image):
+        self.nightly = nightly
+        self.image_name = image_name
+        self.actual_image = actual_image
+        # ids of the nodes that have not yet joined
+        self.expected = set()
+        # (node, future) for the nodes that have joined
+        # and wait for the next batch
+        self.waiting = []
+        self.linger_handle = None
+        # keep a reference on running batches
+        self.tasks = set()
+        # node_id -> when it joined, for the timeline
+        self.joined = {}
+
+    def expect(self, node_ids):
+        self.expected.update(node_ids)
+
+    def forget(self, node_id):
+        """
+        a node has been excluded, no need to wait for it anymore
+        """
+        self.expected.discard(node_id)
+        self._maybe_fire()
+
+    async def load(self, node):
+        """
+        returns True if the image went fine on this node
+        """
+        self.expected.discard(node.id)
+        self.joined[node.id] = time.time()
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.append((node, future))
+        self._maybe_fire()
+        return await future
+
+    def _maybe_fire(self):
+        if not self.waiting:
+            return
+        if not self.expected:
+            self._fire()
+        elif self.linger_handle is None:
+            self.linger_handle = asyncio.get_running_loop().call_later(
+                self.nightly.load_linger, self._fire)
+
+    def _fire(self):
+        if self.linger_handle is not None:
+            self.linger_handle.cancel()
+            self.linger_handle = None
+        batch, self.waiting = self.waiting, []
+        self._start(batch, catch_up=False)
+
+    def _start(self, batch, catch_up):
+        task = asyncio.create_task(self._run_batch(batch, catch_up))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def cancel(self):
+        """
+        abort all ongoing loads; cleanup is done in _run_batch
+        """
+        if self.linger_handle is not None:
+            self.linger_handle.cancel()
+            self.linger_handle = None
+        # catch-up batches get started while we cancel
+        while self.tasks:
+            tasks = list(self.tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run_batch(self, batch, catch_up):
+        nightly = self.nightly
+        nodes = [node for node, _ in batch]
+        futures = {node.id: future for node, future in batch}
+        started = time.time()
+        for node in nodes:
+            if node.id in self.joined:
+                nightly.tracer.add('session wait', 'operation', node.id,
+                                   self.joined.pop(node.id), started)
+
+        def on_done(node, is_ok):
+            if not futures[node.id].done():
+                futures[node.id].set_result(is_ok)
+                nightly.tracer.add('frisbee', 'operation', node.id,
+                                   started, time.time(), ok=is_ok)
+
+        # the batch can't be shorter than its slowest node
+        timeout = max(nightly.timeout(node, 'load') for node in nodes)
+        kind = "catch-up load" if catch_up else "loading"
+        nightly.print(f"{kind} image {self.actual_image} on {len(nodes)} node(s)"
+                      f" (timeout = {timeout})")
+        loader = nightly.make_loader(nodes, self.actual_image,
+                                     evict=not catch_up, on_done=on_done)
+        cancelled = timed_out = False
+        try:
+            is_ok = await asyncio.wait_for(
+                loader.run(reset=True), timeout=timeout)
+        except asyncio.TimeoutError:
+            nightly.print(f"load of {self.image_name} timed out")
+            is_ok, timed_out = False, True
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        except Exception as exc:                        # pylint: disable=w0703
+            nightly.print(f"load of {self.image_name} failed: {exc}")
+            is_ok = False
+        finally:
+            if loader.frisbeed:
+                loader.frisbeed.stop_nowait()
+            loader.nextboot_cleanup()
+            # if we get cancelled, no catch-up, and nobody waits forever
+            evicted = (set() if cancelled
+                       else {node.id for node in loader.evicted})
+            for node in nodes:
+                if node.id not in evicted:
+                    on_done(node, False)
+        nightly.print(f"load done on {len(nodes) - len(evicted)} node(s)"
+                      f" - all ok={is_ok}")
+        nightly.tracer.add(kind, 'load', self.image_name, started, time.time(),
+                           nodes=len(nodes), bandwidth=loader.bandwidth,
+                           evicted=len(evicted), timed_out=timed_out)
+        if loader.traffic:
+            nightly.print(f"frisbee traffic for {self.image_name}:"
+                          f" {describe_traffic(loader.traffic)}")
+            nightly.history.record_traffic(self.image_name, started, loader.traffic)
+        # what the bandwidth of the next runs gets derived from
+        nightly.history.record_load(
+            self.image_name, loader.bandwidth, started, time.time(),
+            catch_up=catch_up, nb_nodes=len(nodes),
+            # only the transfers count, not e.g. a node that did not reset
+            nb_failed=len(loader.failed),
+            nb_evicted=len(evicted), timed_out=timed_out, resent=loader.resent)
+        if evicted:
+            nightly.print(f"{len(evicted)} straggler(s) evicted from the load"
+                          f" of {self.image_name}:"
+                          f" {' '.join(str(node_id) for node_id in sorted(evicted))}")
+            self._start([(node, futures[node.id]) for node in nodes
+                         if node.id in evicted], catch_up=True)
+
+
+class NodeRegistry:
+    """
+    all the nodes involved in a run, keyed by node id and in ascending
+    id order; built once for the whole run, failing nodes are just
+    flagged as excluded
+    """
+
+    def __init__(self, cmc_names, bus, node_factory=Node):
+        self.nodes = {}
+        for cmc_name in cmc_names:
+            node = node_factory(cmc_name, bus)
+            self.nodes[node.id] = node
+        self.nodes = dict(sorted(self.nodes.items()))
+        self.excluded = set()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(self.nodes.values())
+
+    def __getitem__(self, node_id):
+        return self.nodes[node_id]
+
+    def exclude(self, node_id):
+        self.excluded.add(node_id)
+
+    def is_alive(self, node_id):
+        return node_id not in self.excluded
+
+    def alive(self):
+        return [node for node_id, node in self.nodes.items()
+                if node_id not in self.excluded]
+
+
+class Nightly:                                         # pylint: disable=r0902
+    """
+    the factories and the class attributes below are what a simulated
+    testbed needs to override - see nightsim.py
+    """
+
+    display_class = NoProgressBarDisplay
+    mailhost = 'localhost'
+
+    def __init__(self, selector, *, verbose, dry_run, speedy,
+                 history=DEFAULT_HISTORY, adaptive=True, capture_interface=None,
+                 cohorts=False, incremental=None, timeline=None, metrics=None,
+                 outbox=DEFAULT_OUTBOX, status=None, node_factory=Node):
+        self.verbose = verbose
+        self.dry_run = dry_run
+        self.speedy = speedy
+        # one image per node and per run, see nightcohorts.py
+        self.cohorts = cohorts
+        # the sweep period in days, or None to test all nodes;
+        # see select_nodes()
+        self.incremental = incremental
+        #
+        # keep a backup of initial scope for proper cleanup
+        self.all_names = list(selector.node_names())
+        # the list of failed nodes together with the reason why
+        self.failures = {}
+        # image name -> ImageSession
+        self.sessions = {}
+        # the lease that we are running under, and the time it leaves us
+        self.lease = None
+        self.budget = None
+        # the nodes that went through all the checks
+        self.completed = set()
+        # the nodes left out by an incremental run
+        self.skipped = set()
+        # node_id -> what the node reported on its last probe
+        self.facts = {}
+        #
+        # from rhubarbe config, retrieve bandwidth and other details;
+        # the bandwidth is then adapted, see compute_bandwidth()
+        config = Config()
+        self.bandwidth = int(config.value('networking', 'bandwidth'))
+        self.backoff = int(config.value('networking', 'ssh_backoff'))
+        self.load_timeout = float(config.value('nodes', 'load_nightly_timeout'))
+        self.wait_timeout = float(config.value('nodes', 'wait_nightly_timeout'))
+        self.ssh_timeout = float(config.value('nodes', 'ssh_nightly_timeout'))
+        self.cmc_timeout = float(config.value('nodes', 'cmc_safe_timeout'))
+        # how long to wait after an action before checking the node status
+        self.check_delay = 5.
+        self.load_linger = LOAD_LINGER
+        # how long, and how often, to check that a node is off, see node_off()
+        self.off_verify = OFF_VERIFY
+        self.off_poll = OFF_POLL
+        # see nightload.py
+        self.evict_stragglers = True
+        self.straggler_period = STRAGGLER_PERIOD
+        # where to capture the frisbee traffic, see nightfrisbee.py
+        self.capture_interface = capture_interface
+        # node_id -> seconds it took to turn it off, or None if it failed;
+        # remains None until all_off() has run
+        self.power_off = None
+        # one bus, one set of nodes and one display for the whole run,
+        # that all live on the loop created in run()
+        # any substraction (failing node) is done in mark_and_exclude()
+        self.bus = asyncio.Queue()
+        self.nodes = NodeRegistry(selector.cmc_names(), self.bus, node_factory)
+        self.display = self.display_class(list(self.nodes), self.bus)
+        self.sidecar = SidecarPublisher(
+            SIDECAR_URL, timeout=10, printer=self.print, **SSL_ARGS)
+        # at most one ssh connection per node
+        self.ssh = SshPool(self.ssh_connect)
+        # per-node and per-phase records
+        self.history = NightlyHistory(history)
+        # reports go through the outbox, see send_mail()
+        self.outbox = MailOutbox(outbox, printer=self.print)
+        # timing spans, and where to export them at the end of the run:
+        # a Chrome trace file and a Prometheus textfile, see nighttrace.py
+        self.tracer = Tracer()
+        self.timeline_path = timeline
+        self.metrics_path = metrics
+        # where each node is at, written in the status file if any
+        self.status = StatusBoard(status, printer=self.print)
+        self.display.status = self.status
+        # per-node and per-phase timeouts, see compute_deadlines()
+        self.adaptive = adaptive
+        self.deadlines = None
+        if verbose:
+            monitor_logger.setLevel(logging.DEBUG)
+        else:
+            monitor_logger.setLevel(logging.INFO)
+
+
+    def print(self, *args):
+        message = " ".join(str(x) for x in args)
+        self.display.dispatch(message)
+
+    def verbose_msg(self, *args):
+        if self.verbose:
+            self.print("verbose:", *args)
+
+
+    def mark_and_exclude(self, node, reason, message=None):
+        """
+        what to do when a node is found as being non-nominal
+        (*) remove it from further actions
+        (*) mark it as unavailable
+        (*) remember the reason why for producing summary
+        a node that fails because we ran out of time is not to blame,
+        it will just show up as incomplete
+        """
+        if self.budget is not None and self.budget.is_exhausted():
+            self.print(f"node {node.id} ran out of time {message or ''}")
+            return
+        self.nodes.exclude(node.id)
+        self.failures[node.id] = reason
+        self.ssh.drop(node.id)
+        self.print(f"marking node {node.id} as unavailable for reason {reason}"
+                   f" {message or ''}")
+        # image sessions should not wait for this one
+        for session in self.sessions.values():
+            session.forget(node.id)
+        self.sidecar.set_available(node.id, False)
+        self.sidecar.flush_soon()
+        self.status.update(node.id, state='failed', reason=reason.name.lower())
+
+
+    def compute_deadlines(self):
+        """
+        learn per-node timeouts from the history if so requested;
+        in any case, configured values act as an upper bound
+        """
+        defaults = {
+            'on': self.wait_timeout,
+            'reset': self.wait_timeout,
+            'off': self.wait_timeout,
+            'load': self.load_timeout,
+            'ssh': self.wait_timeout,
+            'check': self.wait_timeout,
+        }
+        if not self.adaptive:
+            self.deadlines = AdaptiveDeadlines(None, defaults)
+            return
+        self.deadlines = AdaptiveDeadlines(self.history, defaults)
+        for node in self.nodes:
+            adapted = {phase: self.deadlines.timeout(node.id, phase)
+                       for phase in defaults}
+            self.verbose_msg(f"node {node.id} timeouts: " + " ".join(
+                f"{phase}={timeout:.0f}" for phase, timeout in adapted.items()))
+
+
+    def compute_bandwidth(self):
+        """
+        derive this run's load bandwidth from how the last run's loads went,
+        if so requested; see nightbandwidth.py
+        """
+        chooser = AdaptiveBandwidth(self.history if self.adaptive else None,
+                                    self.bandwidth)
+        self.bandwidth, why = chooser.choose()
+        self.print(f"load bandwidth {self.bandwidth} Mibps - {why}")
+
+
+    def timeout(self, node, phase):
+        return self.budget.clamp(self.deadlines.timeout(node.id, phase))
+
+
+    def lease_budget(self):
+        """
+        the time left until the end of our lease
+        """
+        total = LEASE_DURATION
+        try:
+            total = iso_to_epoch(self.lease['t_until']) - time.time()
+        except (TypeError, KeyError, ValueError) as exc:
+            self.print(f"cannot figure out lease end ({exc}),"
+                       f" assuming {LEASE_DURATION}s")
+        return TimeBudget(total, BUDGET_RESERVE)
+
+
+    def image_cost(self, image):                       # pylint: disable=w0613
+        """
+        how long a load / wait / check cycle would take, worst node wins
+        """
+        return max(
+            (sum(self.deadlines.timeout(node.id, phase)
+                 for phase in ('load', 'ssh', 'check'))
+             for node in self.nodes.alive()),
+            default=0.)
+
+
+    def affordable_images(self, power_modes, images):
+        """
+        drop the last images if there is not enough time left for them
+        """
+        # all cohorts go at the same time, for the price of one image
+        if self.cohorts:
+            return images
+        power_cost = max(
+            (sum(self.deadlines.timeout(node.id, mode) for mode in power_modes)
+             for node in self.nodes.alive()),
+            default=0.)
+        kept = self.budget.affordable(
+            images, lambda image_check: self.image_cost(image_check[0]),
+            upfront=power_cost)
+        if len(kept) < len(images):
+            self.print(f"{self.budget}: only checking"
+                       f" {' '.join(image for image, _ in kept)}")
+        return kept
+
+
+    def locate_image(self, image_name):
+        return ImagesRepo().locate_image(image_name, look_in_global=True)
+
+
+    def select_nodes(self, images):
+        """
+        in incremental mode, leave out the nodes that need it the least;
+        they are neither failed nor incomplete, just not tested this time
+        """
+        if self.incremental is None:
+            return
+        period = self.incremental * DAY
+        now = time.time()
+        priorities = NodePriorities(
+            [image for image, _ in images], now=now, period=period,
+            last_pass=self.history.last_passes(),
+            flakiness=self.history.flakiness(now - period),
+            last_verified=self.history.last_verified())
+        # spread the sweep over the runs of one period
+        nb_runs = self.history.count_runs('nightly', now - period)
+        alive = [node.id for node in self.nodes.alive()]
+        quota = math.ceil(len(alive) / max(1, nb_runs))
+        selected, why = priorities.select(alive, quota)
+        for node_id in selected:
+            self.verbose_msg(f"node {node_id} selected - {why[node_id]}")
+        self.skipped = set(alive) - set(selected)
+        for node_id in self.skipped:
+            self.nodes.exclude(node_id)
+            self.status.update(node_id, state='skipped')
+        self.print(f"incremental: testing {len(selected)}/{len(alive)} node(s)"
+                   f" - quota {quota} over {nb_runs} run(s)"
+                   f" in the last {self.incremental:g} day(s)")
+
+
+    def plan_images(self, images):
+        """
+        node_id -> the images that this node checks in this run
+        """
+        alive = [node.id for node in self.nodes.alive()]
+        if not self.cohorts or len(images) < 2:
+            return {node_id: images for node_id in alive}
+        names = [image for image, _ in images]
+        last_tried = self.history.last_tried()
+        # every node should cover every image over as many runs as there
+        # are images; that is, this one and the previous ones since then,
+        # and this one is already in the history
+        previous = [started for run_id, _, started, *_ in
+                    self.history.last_runs(len(images), kind='nightly')
+                    if run_id != self.history.run_id][:len(images) - 1]
+        since = (previous[len(images) - 2] if len(previous) >= len(images) - 1
+                 else 0)
+        late = overdue(alive, names, last_tried, since)
+        cohorts = assign_cohorts(alive, names, last_tried)
+        for image, node_ids in cohorts.items():
+            self.print(f"cohort {image}: {len(node_ids)} node(s)"
+                       f" - {len(late[image])} overdue")
+            self.verbose_msg(f"cohort {image}: {' '.join(map(str, node_ids))}")
+        missed = [node_id for node_id in alive
+                  if all(node_id in late[image] for image in names)]
+        if missed:
+            self.print(f"{len(missed)} node(s) overdue on all images,"
+                       f" e.g. {' '.join(map(str, missed[:10]))}")
+        checks = dict(images)
+        return {node_id: [(image, checks[image])]
+                for image, node_ids in cohorts.items() for node_id in node_ids}
+
+
+    def locate_images(self, images, plan):
+        """
+        make sure all images are present before we start anything
+        """
+        for image_name, _ in images:
+            actual_image = self.locate_image(image_name)
+            if not actual_image:
+                self.print(f"image file {image_name} not found - emergency exit")
+                exit(1)
+            self.verbose_msg(f"image={actual_image}")
+            session = ImageSession(self, image_name, actual_image)
+            session.expect(node_id for node_id, planned in plan.items()
+                           if image_name in dict(planned))
+            self.sessions[image_name] = session
+
+
+    def make_loader(self, batch, actual_image, *, evict, on_done):
+        return CohortLoader(batch, image=actual_image,
+                            bandwidth=self.bandwidth,
+                            message_bus=self.bus,
+                            display=self.display,
+                            progress=self.display.progress, on_done=on_done,
+                            evict=evict and self.evict_stragglers,
+                            period=self.straggler_period,
+                            capture=(self.frisbee_capture
+                                     if self.capture_interface else None))
+
+
+    def frisbee_capture(self, group, port):
+        return FrisbeeCapture(self.capture_interface, group, port)
+
+
+    async def send_mail(self, receivers, subject, html, text=None):
+        """
+        the report is safe on disk before anything is attempted; delivery
+        takes along whatever previous runs could not get through, and runs
+        in a thread, as smtplib is blocking
+        """
+        self.outbox.put(EMAIL_FROM, receivers,
+                        compose_email(EMAIL_FROM, receivers, subject, html, text))
+        delivered, left = await asyncio.to_thread(
+            self.outbox.deliver, self.mailhost)
+        self.print(f"mail: {delivered} message(s) delivered, {left} left")
+
+
+    async def ssh_connect(self, node, timeout):
+        return await asyncssh.connect(
+            node.control_hostname(), username='root',
+            known_hosts=None, client_keys=private_keys(),
+            connect_timeout=timeout)
+
+
+    async def ping(self, node, timeout):
+        return await nighttriage.ping(node.control_ip_address(), timeout)
+
+
+    async def ssh_banner(self, node, timeout):
+        return await nighttriage.ssh_banner(node.control_hostname(), timeout)
+
+
+    async def node_triage(self, node, semaphore):
+        """
+        exclude the node right away if it clearly cannot take part:
+        (*) its CMC does not answer, or makes no sense
+        (*) it answers ping while its CMC says it is off
+        (*) in dry-run mode, nothing will reboot it, so if it is on
+            already it has to run sshd
+        """
+        async def status():
+            try:
+                return await asyncio.wait_for(node.get_status(),
+                                              timeout=TRIAGE_TIMEOUT)
+            except asyncio.TimeoutError:
+                return None
+        async with semaphore:
+            cmc_status, pings = await asyncio.gather(
+                status(), self.ping(node, TRIAGE_TIMEOUT))
+            banner = (await self.ssh_banner(node, TRIAGE_TIMEOUT)
+                      if pings else None)
+        self.history.record_facts(
+            node.id, None, dict(cmc=cmc_status, ping=pings, banner=banner))
+        if cmc_status is None:
+            message = "pre-flight: CMC does not answer"
+            reason = Reason.WONT_TURN_ON
+        elif cmc_status not in ('on', 'off'):
+            message = f"pre-flight: CMC status is {cmc_status!r}"
+            reason = Reason.WONT_TURN_ON
+        elif cmc_status == 'off' and pings:
+            message = "pre-flight: answers ping while its CMC says off"
+            reason = Reason.WONT_TURN_OFF
+        elif self.dry_run and cmc_status == 'on' and not banner:
+            message = "pre-flight: on but no ssh banner, and dry-run won't reset"
+            reason = Reason.WONT_SSH
+        else:
+            return True
+        self.mark_and_exclude(node, reason, message)
+        return False
+
+
+    async def preflight(self):
+        """
+        a quick look at the whole fleet, before any power action
+        """
+        started = time.time()
+        semaphore = asyncio.Semaphore(TRIAGE_PARALLELISM)
+        nodes = self.nodes.alive()
+        outcomes = await asyncio.gather(
+            *(self.timed(node, 'triage', None, self.node_triage(node, semaphore))
+              for node in nodes))
+        self.print(f"pre-flight: {outcomes.count(False)}/{len(nodes)}"
+                   f" node(s) excluded in {time.time() - started:.1f}s")
+
+
+    async def node_send_action(self, node, mode):
+        delay = self.check_delay
+        reason = (
+            Reason.WONT_TURN_ON if mode == 'on'
+            else Reason.WONT_TURN_OFF if mode == 'off'
+            else Reason.WONT_RESET)
+        try:
+            # somewhat arbitrary, but use wait_timeout
+            await asyncio.wait_for(
+                node.send_action(message=mode, check=True, check_delay=delay),
+                timeout=self.timeout(node, mode))
+        except asyncio.TimeoutError:
+            node.action = None
+        if node.action:
+            self.print(f"{node.control_hostname()}: {mode} OK")
+            return True
+        self.mark_and_exclude(
+            node, reason, f"can't send action {mode} - delay was {delay}")
+        return False
+
+
+    async def node_wait_ssh(self, node):
+        # wait for node to be ssh-reachable; the connection is kept
+        try:
+            await asyncio.wait_for(
+                self.ssh.wait(node, self.backoff, timeout=self.ssh_timeout),
+                timeout=self.timeout(node, 'ssh'))
+        except Exception as exc:                        # pylint: disable=w0703
+            self.verbose_msg(f"node {node.id} wait_ssh -> exc={exc}")
+            message = f"OOPS {type(exc)} {exc}"
+            self.mark_and_exclude(node, Reason.WONT_SSH, message)
+            return False
+        return True
+
+
+    async def node_check_image(self, node, image, check_strings):
+        # check image marker, and collect a few facts on the way
+        grep_pattern = "|".join(check_strings)
+        try:
+            completed = await asyncio.wait_for(
+                self.ssh.run(node, PROBE_COMMAND, timeout=self.ssh_timeout),
+                timeout=self.timeout(node, 'check'))
+        except Exception as exc:                        # pylint: disable=w0703
+            self.verbose_msg(
+                f"checking {grep_pattern}: something went badly wrong with {node}")
+            message = f"OOPS {type(exc)} {exc}"
+            self.mark_and_exclude(node, Reason.CANT_CHECK_IMAGE, message)
+            return False
+        facts = parse_probe(completed.stdout)
+        self.facts[node.id] = facts
+        self.history.record_facts(node.id, image, facts)
+        if not image_matches(facts, check_strings):
+            explanation = (f"wrong image found on {node} - looking for {grep_pattern}"
+                           f" - found {facts.get('image')!r} ({describe(facts)})")
+            self.verbose_msg(explanation)
+            self.mark_and_exclude(node, Reason.DID_NOT_LOAD, explanation)
+            return False
+        self.print(f"node {node} checked out OK")
+        self.verbose_msg(f"node {node.id}: {describe(facts)}")
+        return True
+
+
+    async def timed(self, node, phase, image, coro):
+        """
+        run one step for one node, and keep track of how it went
+        """
+        started = time.time()
+        self.status.update(node.id, state='running', phase=phase, image=image,
+                           since=started, percent=None)
+        norm = self.deadlines.norm(node.id, phase)
+        slow_handle = None
+        if norm is not None:
+            slow_handle = asyncio.get_running_loop().call_later(
+                norm * SLOW_FACTOR + 1, self.print,
+                f"node {node.id} is slow on {phase}: more than"
+                f" {SLOW_FACTOR:.0f} times its usual {norm:.1f}s")
+        try:
+            is_ok = await coro
+        finally:
+            if slow_handle is not None:
+                slow_handle.cancel()
+        ended = time.time()
+        self.history.record(node.id, phase, image, started, ended,
+                            is_ok, None if is_ok else self.failures.get(node.id))
+        self.tracer.add(phase, 'phase', node.id, started, ended,
+                        image=image, ok=is_ok)
+        return is_ok
+
+
+    async def node_pipeline(self, node, power_modes, images):
+        """
+        the whole sequence for one node; returns as soon as the node fails;
+        images are the ones that this node checks, see plan_images()
+        """
+        for mode in power_modes:
+            if not await self.timed(node, mode, None,
+                                    self.node_send_action(node, mode)):
+                return False
+        for image, check_strings in images:
+            if not self.dry_run:
+                # the node is going to reboot
+                self.ssh.drop(node.id)
+                await self.timed(node, 'load', image,
+                                 self.sessions[image].load(node))
+            if not await self.timed(node, 'ssh', image,
+                                    self.node_wait_ssh(node)):
+                return False
+            if not await self.timed(node, 'check', image,
+                                    self.node_check_image(node, image, check_strings)):
+                return False
+        self.sidecar.set_available(node.id, True)
+        self.sidecar.flush_soon()
+        self.completed.add(node.id)
+        self.status.update(node.id, state='completed', phase=None, image=None)
+        return True
+
+
+    async def pipelines(self, power_modes, plan):
+        """
+        run all node pipelines together, with the display on the side
+        plan is a dict node_id -> images, see plan_images()
+        """
+        display_task = asyncio.create_task(self.display.run())
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(
+                    *(self.node_pipeline(node, power_modes, plan[node.id])
+                      for node in self.nodes.alive())),
+                timeout=self.budget.available())
+        except asyncio.TimeoutError:
+            self.print(f"time budget exhausted after {self.budget.elapsed():.0f}s"
+                       f" - {len(self.incomplete())} node(s) not completed")
+            # pending frisbee sessions are not attached to the pipelines
+            for session in self.sessions.values():
+                await session.cancel()
+        await self.ssh.close()
+        self.print(self.ssh.summary())
+        try:
+            await asyncio.wait_for(self.sidecar.close(),
+                                   timeout=self.sidecar.timeout * 3)
+        except asyncio.TimeoutError:
+            self.print("sidecar: could not flush in time")
+        self.print(self.sidecar.summary())
+        display_task.cancel()
+
+
+    def export_metrics(self):
+        """
+        write the timing spans as a Chrome trace, and the run metrics
+        as a Prometheus textfile, if so requested; see nighttrace.py
+        """
+        incomplete = self.incomplete()
+        gauges = [
+            ("nightly_last_run_timestamp_seconds",
+             "when the last run started", None, self.tracer.origin),
+            ("nightly_load_bandwidth_mibps",
+             "the load bandwidth of the last run", None, self.bandwidth),
+        ]
+        if self.budget is not None:
+            gauges.append(("nightly_lease_left_seconds",
+                           "what was left of the lease at the end of the last run",
+                           None, self.budget.remaining()))
+        for outcome, count in (('completed', len(self.completed)),
+                               ('failed', len(self.failures)),
+                               ('incomplete', len(incomplete)),
+                               ('skipped', len(self.skipped))):
+            gauges.append(("nightly_nodes", "nodes in the last run, by outcome",
+                           dict(outcome=outcome), count))
+        reasons = list(self.failures.values())
+        for reason in Reason:
+            gauges.append(("nightly_failed_nodes",
+                           "nodes that failed in the last run, by reason",
+                           dict(reason=reason.name), reasons.count(reason)))
+        try:
+            if self.timeline_path:
+                self.tracer.write_chrome_trace(self.timeline_path)
+            if self.metrics_path:
+                self.tracer.write_prometheus(self.metrics_path, gauges)
+        except OSError as exc:
+            self.print(f"could not export the run metrics: {exc}")
+
+
+    def incomplete(self):
+        """
+        the nodes that have neither failed nor completed
+        """
+        return [node.id for node in self.nodes.alive()
+                if node.id not in self.completed]
+
+
+    async def node_off(self, node, semaphore):
+        """
+        turn one node off - with its usrp - and wait until its CMC says so
+        returns True if the node is found off
+        """
+        async with semaphore:
+            with self.tracer.span('turn off', 'operation', node.id):
+                try:
+                    await asyncio.wait_for(node.turn_both_off(),
+                                           timeout=self.cmc_timeout)
+                except asyncio.TimeoutError:
+                    pass
+            with self.tracer.span('check off', 'operation', node.id) as args:
+                deadline = time.time() + self.off_verify
+                while True:
+                    # a CMC that does not answer is just a failed attempt
+                    try:
+                        status = await asyncio.wait_for(node.get_status(),
+                                                        timeout=TRIAGE_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        status = None
+                    if status == 'off':
+                        args['ok'] = True
+                        return True
+                    if time.time() >= deadline:
+                        args['ok'] = False
+                        return False
+                    await asyncio.sleep(self.off_poll)
+
+
+    async def all_off(self):
+        """
+        turn off all nodes in the initial scope, failed ones included;
+        the ones that won't are retried a couple times;
+        the outcome is stored in self.power_off
+        """
+        if self.dry_run:
+            self.print("dry_run mode: skip all-off")
+            self.power_off = {}
+            return
+        self.status.set_stage('all-off')
+        semaphore = asyncio.Semaphore(OFF_PARALLELISM)
+        started = time.time()
+        self.power_off = {node.id: None for node in self.nodes}
+        pending = list(self.nodes)
+        for attempt in range(1, OFF_ATTEMPTS+1):
+            outcomes = await asyncio.gather(
+                *(self.node_off(node, semaphore) for node in pending),
+                return_exceptions=True)
+            stragglers = []
+            for node, outcome in zip(pending, outcomes):
+                if outcome is True:
+                    self.power_off[node.id] = time.time() - started
+                else:
+                    stragglers.append(node)
+            pending = stragglers
+            if not pending:
+                break
+            self.print(f"all_off: attempt {attempt} left {len(pending)} node(s) on:"
+                       f" {' '.join(str(node.id) for node in pending)}")
+        ended = time.time()
+        for node in self.nodes:
+            latency = self.power_off[node.id]
+            self.history.record(node.id, 'bye', None, started,
+                                started + latency if latency is not None else ended,
+                                latency is not None)
+            self.tracer.add('bye', 'phase', node.id, started,
+                            started + latency if latency is not None else ended,
+                            ok=latency is not None)
+        self.tracer.add('all-off', 'stage', RUN, started, ended)
+        self.print(f"all_off: {len(self.nodes) - len(pending)}/{len(self.nodes)}"
+                   f" nodes off in {ended - started:.1f}s")
+
+
+    def run(self, lease):
+        """
+        does everything and returns True if all nodes are fine
+        lease is the nightly lease that we currently hold
+        """
+        self.lease = lease
+        # the one loop for the whole run
+        return asyncio.run(self.main())
+
+
+    async def main(self):
+        """
+        the body of run(), on the one loop that the registry lives on
+        """
+        self.print(40*'=')
+        started = time.time()
+        showtime = time.strftime("%Y-%m-%d@%H:%M:%S", time.localtime(started))
+        self.print(f"Nightly check - starting at {showtime}")
+
+        self.print(40*'=')
+
+        self.verbose_msg(f"focus is {self.all_names}")
+
+        number_nodes = len(self.all_names)
+
+        # the end of the lease is a hard deadline for everything
+        self.budget = self.lease_budget()
+        self.verbose_msg(f"budget={self.budget}")
+        self.compute_deadlines()
+        self.compute_bandwidth()
+        self.history.start_run(
+            'dry-run' if self.dry_run else 'nightly', number_nodes)
+        for node in self.nodes:
+            self.status.update(node.id, state='waiting')
+
+        if not self.dry_run:
+            power_modes = ['on', 'reset', 'off']
+        else:
+            print("nightly in dry_run mode just does ON - off and reset are skipped")
+            print("nightly in dry_run mode won't load any image on node")
+            power_modes = ['on']
+
+        images_expected = (
+            IMAGES_TO_CHECK
+            if not self.speedy
+            else IMAGES_TO_CHECK[:1])
+        try:
+            self.status.set_stage('pre-flight')
+            with self.tracer.span('pre-flight'):
+                await self.preflight()
+            self.status.set_stage('planning')
+            with self.tracer.span('planning'):
+                images_expected = self.affordable_images(power_modes, images_expected)
+                self.select_nodes(images_expected)
+                plan = self.plan_images(images_expected)
+
+                if not self.dry_run:
+                    self.locate_images(images_expected, plan)
+
+            self.status.set_stage('pipelines')
+            with self.tracer.span('pipelines'):
+                await self.pipelines(power_modes, plan)
+            for node_id in self.incomplete():
+                self.status.update(node_id, state='incomplete')
+
+            self.print("turning off")
+            await self.all_off()
+            self.history.end_run(len(self.failures))
+
+            self.print("sending summary mail")
+            self.status.set_stage('report')
+            report_started = time.time()
+            incomplete = self.incomplete()
+            durations = self.history.run_durations(self.history.run_id)
+            trends = self.history.trends()
+            report = (self.all_names, self.failures, incomplete,
+                      self.power_off, self.skipped, durations, trends)
+            html, text = complete_html(*report), complete_text(*report)
+            if self.failures:
+                subject = (f"R2lab nightly : {len(self.failures)} issue(s)"
+                           f" on {number_nodes} node(s)")
+            else:
+                subject = (f"R2lab nightly : all is fine"
+                           f" on {number_nodes} node(s)")
+            if incomplete:
+                subject += f" - {len(incomplete)} not completed"
+            if self.skipped:
+                subject += f" - {len(self.skipped)} skipped"
+
+            if self.dry_run:
+                print("dry_run mode: sending just one mail")
+                await self.send_mail(['thierry.parmentelat@inria.fr'], subject,
+                                     html, text)
+            else:
+                await self.send_mail(EMAIL_TO, subject, html, text)
+            self.tracer.add('report', 'stage', RUN, report_started, time.time())
+        finally:
+            # whatever happens, do not leave the testbed on
+            if self.power_off is None:
+                self.print("turning off")
+                await self.all_off()
+            self.print("turned off - bye")
+            self.tracer.add('nightly', 'run', RUN, started, time.time(),
+                            nodes=number_nodes, failures=len(self.failures))
+            self.export_metrics()
+            self.status.close()
+            self.verbose_msg(self.status.summary())
+
+        # True means everything is OK
+        return True
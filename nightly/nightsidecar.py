@@ -0,0 +1,188 @@
+"""
+a single sidecar session for the whole nightly run
+
+node attributes are recorded as they are set, and sent later on
+in batches, only for the values that differ from what the sidecar
+already knows about; none of this is ever awaited by node work
+"""
+
+# pylint: disable=c0111
+
+import asyncio
+
+from r2lab.sidecar import SidecarAsyncClient
+
+
+class SidecarPublisher:                                 # pylint: disable=r0902
+    """
+    url and kwds are passed to SidecarAsyncClient, so a local websocket
+    stand-in can be used by just passing e.g. ws://localhost:10000/
+    """
+
+    def __init__(self, url, *, timeout=10, printer=print, **kwds):
+        self.url = url
+        self.timeout = timeout
+        self.printer = printer
+        self.kwds = kwds
+        #
+        self.connection = None
+        # (node_id, attribute) -> value, as last seen on the sidecar side
+        self.published = {}
+        # same, for what still needs to be sent
+        self.pending = {}
+        # at most one flush in progress, plus possibly one more afterwards
+        self.flush_task = None
+        self.dirty = False
+        # counters, for the record
+        self.sent_batches = 0
+        self.sent_triples = 0
+        self.connections = 0
+
+    def set(self, node_id, attribute, value):
+        """
+        record a change, does not send anything
+        """
+        key = (node_id, attribute)
+        if self.published.get(key) == value:
+            self.pending.pop(key, None)
+        else:
+            self.pending[key] = value
+
+    def set_available(self, node_id, is_ok):
+        self.set(node_id, 'available', 'ok' if is_ok else 'ko')
+
+    async def _connect(self):
+        if self.connection is not None:
+            return
+        self.connection = await asyncio.wait_for(
+            SidecarAsyncClient(self.url, open_timeout=self.timeout, **self.kwds),
+            timeout=self.timeout)
+        self.connections += 1
+        # learn the current state, so we only send actual changes
+        try:
+            status = await asyncio.wait_for(
+                self.connection.nodes_status(), timeout=self.timeout)
+            for node_id, info in status.items():
+                for attribute, value in info.items():
+                    self.published.setdefault((int(node_id), attribute), value)
+            # some of the pending changes may be moot now
+            for (node_id, attribute), value in list(self.pending.items()):
+                self.set(node_id, attribute, value)
+        except Exception as exc:                        # pylint: disable=w0703
+            self.printer(f"sidecar: could not get nodes status: {exc}")
+
+    async def flush(self):
+        """
+        send all pending changes in one message
+        returns True if there is nothing left to send
+        """
+        if not self.pending:
+            return True
+        batch = {}
+        try:
+            await self._connect()
+            batch, self.pending = self.pending, {}
+            triples = [(node_id, attribute, value)
+                       for (node_id, attribute), value in batch.items()]
+            if triples:
+                await asyncio.wait_for(
+                    self.connection.set_nodes_triples(*triples),
+                    timeout=self.timeout)
+                self.published.update(batch)
+                self.sent_batches += 1
+                self.sent_triples += len(triples)
+            return True
+        except Exception as exc:                        # pylint: disable=w0703
+            self.printer(f"sidecar: flush failed: {type(exc).__name__} {exc}")
+            # keep what was not sent, unless it was superseded meanwhile
+            for key, value in batch.items():
+                self.pending.setdefault(key, value)
+            await self._drop_connection()
+            return False
+
+    def flush_soon(self):
+        """
+        trigger a flush in the background; if one is already running,
+        another one will follow so as to pick the latest changes
+        """
+        if self.flush_task is not None:
+            self.dirty = True
+            return
+        self.flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        try:
+            while True:
+                self.dirty = False
+                await self.flush()
+                if not self.dirty:
+                    break
+        finally:
+            self.flush_task = None
+
+    async def _drop_connection(self):
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            try:
+                await asyncio.wait_for(connection.close(), timeout=self.timeout)
+            except Exception:                           # pylint: disable=w0703
+                pass
+
+    async def close(self):
+        """
+        last chance flush, then close the session
+        """
+        if self.flush_task is not None:
+            await self.flush_task
+        await self.flush()
+        await self._drop_connection()
+
+    def summary(self):
+        return (f"sidecar: {self.sent_triples} update(s) in"
+                f" {self.sent_batches} batch(es)"
+                f" over {self.connections} connection(s)"
+                f"{f', {len(self.pending)} unsent' if self.pending else ''}")
+
+
+def main():
+    """
+    manual unit test, against a local websocket stand-in
+    that just prints what it receives
+    """
+    import json                         # pylint: disable=import-outside-toplevel
+    import websockets                   # pylint: disable=import-outside-toplevel
+
+    received = []
+
+    async def stand_in(websocket, *_ignored):
+        async for wired in websocket:
+            umbrella = json.loads(wired)
+            if umbrella['action'] == 'request':
+                answer = dict(category='nodes', action='info',
+                              message=[dict(id=1, available='ok'),
+                                       dict(id=2, available='ok')])
+                await websocket.send(json.dumps(answer))
+            else:
+                received.append(umbrella['message'])
+
+    async def scenario():
+        async with websockets.serve(stand_in, 'localhost', 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            publisher = SidecarPublisher(f"ws://localhost:{port}/")
+            # already ok: nothing to send
+            publisher.set_available(1, True)
+            publisher.set_available(2, False)
+            publisher.set_available(3, False)
+            publisher.flush_soon()
+            publisher.set_available(3, True)
+            publisher.flush_soon()
+            await publisher.close()
+            print(publisher.summary())
+        for message in received:
+            print(f"stand-in received {message}")
+
+    asyncio.run(scenario())
+
+
+if __name__ == '__main__':
+    main()
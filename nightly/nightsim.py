@@ -0,0 +1,843 @@
+#!/usr/bin/env python3
+
+"""
+a simulated testbed, for running the nightly engine end to end
+without tying up the real one
+
+the testbed side runs in a separate process, so that what gets measured
+on the nightly side is not mixed up with the simulation itself; it offers
+
+(*) fake CMC HTTP endpoints - http://127.0.0.1:<port>/cmc/<id>/<verb>
+    with configurable latency and failure rates; ping and the ssh banner
+    are answered on http://127.0.0.1:<port>/net/<id>/ping|banner
+(*) a fake SSH server, where the username tells the node,
+    and that serves /etc/rhubarbe-image
+(*) a fake sidecar websocket, a fake R2lab API that exposes one
+    nightly lease, and an SMTP sink
+
+on the nightly side, SimNightly is a regular Nightly, that gets pointed
+at these through its factories; the image loads are simulated as well,
+they take the time that frisbee would at the chosen bandwidth, more on
+slow receivers, and they slow down their session; above the capacity
+of the simulated network, part of the image has to be sent again
+
+all durations on the testbed side, and the nightly delays that are not
+about the nodes themselves, are multiplied by --time-scale
+
+run as a script, this performs one simulated run and reports wall-clock
+time, CPU, memory and event-loop lag; see bench-nightly.py for running
+a suite of such runs; with --nights, consecutive runs share their history,
+which shows how the load bandwidth adapts from one night to the next;
+with --record, the run gets recorded for nightreplay.py
+
+    nightsim.py -n 400 --time-scale .1
+    nightsim.py -n 37 --nights 8 --capacity 650
+"""
+
+# pylint: disable=c0111, r0902, r0903
+
+import sys
+import json
+import time
+import random
+import bisect
+import asyncio
+import resource
+import tempfile
+import multiprocessing
+from pathlib import Path
+from functools import partial
+from urllib.parse import urlsplit, parse_qs
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+import aiohttp
+import asyncssh
+import websockets
+
+from rhubarbe.node import Node
+from rhubarbe.display import DisplayNode
+from rhubarbe.r2labapiproxy import R2labApiProxy
+
+from nightrun import Nightly, NoProgressBarDisplay
+from nightreplay import recording
+from nightload import CohortLoader
+from nightsidecar import SidecarPublisher
+from nighthistory import percentile
+from nightprobe import PROBE_COMMAND, MARKER
+
+
+# node boot time, in seconds before --time-scale
+BOOT_DURATION = (25., 45.)
+# CMC answer time
+CMC_LATENCY = (.01, .1)
+# what frisbee has to send for one image
+IMAGE_SIZE = 2500 * 2**20
+# how many progress reports per node and per load
+FRISBEE_STEPS = 20
+# how much slower a slow receiver is, and how much slower
+# the other nodes of its session get
+SLOWNESS = 4.
+SLOW_DRAG = 2.
+# what the network can take, in Mibps; above that, the data that gets
+# lost has to be sent again, which costs more than it gains
+CAPACITY = 700
+# the nightly lease, in real seconds
+LEASE_DURATION = 3600
+# how often the event loop gets probed
+LAG_INTERVAL = .05
+
+IMAGE_STAMP = "/etc/rhubarbe-image"
+KERNELS = {
+    'ubuntu-24': "6.8.0-45-generic",
+    'fedora-41': "6.11.4-301.fc41.x86_64",
+}
+
+
+def scaled(bounds, time_scale):
+    low, high = bounds
+    return low * time_scale, high * time_scale
+
+
+##########
+# the testbed side
+class SimNodeState:
+    """
+    the power and image status of one simulated node;
+    the failure flags are drawn once for the whole run
+    """
+
+    def __init__(self, node_id, rng, failure_rates):
+        self.id = node_id
+        self.power = False
+        # ssh-reachable after that time, if on
+        self.up_at = 0.
+        self.image = "ubuntu-22"
+        self.stamps = [f"2024-01-01@00:00 by sim on fit{node_id:02} image={self.image}"]
+        self.disk_used = rng.randint(20, 60)
+        self.slowness = SLOWNESS if rng.random() < failure_rates['slow'] else 1.
+        self.dead_cmc = rng.random() < failure_rates['cmc']
+        self.wont_boot = rng.random() < failure_rates['boot']
+        self.bad_load = rng.random() < failure_rates['load']
+
+    def is_up(self):
+        return self.power and not self.wont_boot and time.time() >= self.up_at
+
+    def boot(self, delay):
+        self.up_at = time.time() + delay
+
+    def write_image(self, image):
+        if self.bad_load:
+            return
+        self.image = image
+        self.stamps.append(
+            f"{time.strftime('%Y-%m-%d@%H:%M')} by sim on fit{self.id:02} image={image}")
+
+    def run(self, command):
+        """
+        returns retcod, output
+        """
+        if command == f"cat {IMAGE_STAMP}":
+            return 0, "".join(f"{stamp}\n" for stamp in self.stamps)
+        if command == PROBE_COMMAND:
+            return 0, self.probe()
+        return 127, f"sim: command not found: {command}\n"
+
+    def probe(self):
+        now = time.time()
+        sections = dict(
+            stamp=self.stamps,
+            kernel=[KERNELS.get(self.image, "5.15.0-generic")],
+            uptime=[f"{now - self.up_at:.2f} {4 * (now - self.up_at):.2f}"],
+            btime=[f"btime {self.up_at:.0f}"],
+            disk=[f"/dev/sda1 41152736 {411527 * self.disk_used}"
+                  f" {411527 * (100 - self.disk_used)} {self.disk_used}% /"],
+            links=["lo UNKNOWN 00:00:00:00:00:00 <LOOPBACK,UP,LOWER_UP>",
+                   "control UP 00:03:1d:0e:03:19 <BROADCAST,MULTICAST,UP,LOWER_UP>",
+                   "data DOWN 00:03:1d:0e:03:18 <BROADCAST,MULTICAST>"],
+            dmesg=[])
+        return "".join(f"{MARKER}{name}\n" + "".join(f"{line}\n" for line in lines)
+                       for name, lines in sections.items())
+
+
+class SimSshServer(asyncssh.SSHServer):
+
+    def __init__(self, testbed):
+        self.testbed = testbed
+
+    def begin_auth(self, username):
+        """
+        no authentication needed on a node that is up;
+        none can succeed otherwise, as no method is supported
+        """
+        self.testbed.stats['ssh_connections'] += 1
+        node = self.testbed.by_name(username)
+        return node is None or not node.is_up()
+
+
+class SimTestbed:
+
+    def __init__(self, nb_nodes, *, time_scale, failure_rates, seed,
+                 cmc_latency=CMC_LATENCY):
+        rng = random.Random(seed)
+        self.rng = rng
+        self.time_scale = time_scale
+        self.cmc_latency = scaled(cmc_latency, time_scale)
+        self.boot_duration = scaled(BOOT_DURATION, time_scale)
+        self.nodes = {node_id: SimNodeState(node_id, rng, failure_rates)
+                      for node_id in range(1, nb_nodes+1)}
+        now = time.time()
+        self.lease = dict(
+            id=1, slice_name="r2lab-nightly",
+            t_from=time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(now - 60)),
+            t_until=time.strftime("%Y-%m-%dT%H:%M:%S%z",
+                                  time.localtime(now + LEASE_DURATION)))
+        self.stats = dict(cmc_requests=0, api_requests=0, frisbee_requests=0,
+                          ssh_connections=0, ssh_commands=0,
+                          sidecar_updates=0, mails=0, mail_bytes=0)
+
+    def by_name(self, hostname):
+        digits = "".join(x for x in hostname if x.isdigit())
+        return self.nodes.get(int(digits)) if digits else None
+
+    def boot_delay(self):
+        return self.rng.uniform(*self.boot_duration)
+
+    # http
+    async def handle_http(self, reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            _, target, _ = request.decode().split(' ', 2)
+            status, body = await self.route(urlsplit(target))
+            payload = body.encode()
+            writer.write(f"HTTP/1.1 {status}\r\n"
+                         f"Content-Type: text/plain\r\n"
+                         f"Content-Length: {len(payload)}\r\n"
+                         f"Connection: close\r\n\r\n".encode() + payload)
+            await writer.drain()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, url):
+        parts = url.path.strip('/').split('/')
+        if parts[:2] == ['api', 'leases']:
+            self.stats['api_requests'] += 1
+            return "200 OK", json.dumps([self.lease])
+        if (len(parts) != 3 or parts[0] not in ('cmc', 'net')
+                or not parts[1].isdigit()):
+            return "404 Not Found", ""
+        node = self.nodes.get(int(parts[1]))
+        if node is None:
+            return "404 Not Found", ""
+        verb = parts[2]
+        if parts[0] == 'net':
+            return "200 OK", self.net(node, verb)
+        if verb.startswith('frisbee'):
+            self.stats['frisbee_requests'] += 1
+            return "200 OK", self.frisbee(node, verb, parse_qs(url.query))
+        self.stats['cmc_requests'] += 1
+        if node.dead_cmc:
+            # like a CMC that does not answer: the client times out
+            await asyncio.sleep(3600)
+        await asyncio.sleep(self.rng.uniform(*self.cmc_latency))
+        return "200 OK", self.cmc(node, verb)
+
+    def cmc(self, node, verb):
+        if verb == 'status':
+            return 'on' if node.power else 'off'
+        if verb == 'usrpstatus':
+            return 'off'
+        if verb == 'on':
+            if not node.power:
+                node.power = True
+                node.boot(self.boot_delay())
+        elif verb == 'reset':
+            if node.power:
+                node.boot(self.boot_delay())
+        elif verb == 'off':
+            node.power = False
+        elif verb not in ('usrpon', 'usrpoff', 'info'):
+            return 'unknown verb'
+        return 'ok'
+
+    def net(self, node, verb):
+        if not node.is_up():
+            return ""
+        return 'ok' if verb == 'ping' else "SSH-2.0-sim"
+
+    def frisbee(self, node, verb, query):
+        """
+        frisbee-start: the node is in its frisbee client, returns how slow
+        a receiver it is, 0 if it is off
+        frisbee-done: it got its image and reboots
+        """
+        if not node.power:
+            return '0'
+        if verb == 'frisbee-start':
+            node.boot(float('inf'))
+            return str(node.slowness)
+        node.write_image(query['image'][0])
+        node.boot(self.boot_delay())
+        return 'ok'
+
+    # ssh
+    def handle_ssh(self, process):
+        self.stats['ssh_commands'] += 1
+        node = self.by_name(process.get_extra_info('username'))
+        retcod, output = node.run(process.command)
+        process.stdout.write(output)
+        process.exit(retcod)
+
+    # sidecar
+    async def handle_sidecar(self, websocket, *_ignored):
+        async for wired in websocket:
+            umbrella = json.loads(wired)
+            if umbrella['action'] == 'request':
+                answer = dict(category='nodes', action='info',
+                              message=[dict(id=node_id, available='ok')
+                                       for node_id in self.nodes])
+                await websocket.send(json.dumps(answer))
+            else:
+                self.stats['sidecar_updates'] += len(umbrella['message'])
+
+    # smtp
+    async def handle_smtp(self, reader, writer):
+        try:
+            writer.write(b"220 sim ESMTP\r\n")
+            while (line := await reader.readline()):
+                verb = line[:4].upper()
+                if verb == b'DATA':
+                    writer.write(b"354 go ahead\r\n")
+                    await writer.drain()
+                    while (line := await reader.readline()) not in (b'.\r\n', b''):
+                        self.stats['mail_bytes'] += len(line)
+                    self.stats['mails'] += 1
+                    writer.write(b"250 queued\r\n")
+                elif verb == b'QUIT':
+                    writer.write(b"221 bye\r\n")
+                    break
+                else:
+                    writer.write(b"250 ok\r\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, conn):
+        """
+        sends the endpoints over conn, and then the stats
+        when the other end asks for them
+        """
+        http = await asyncio.start_server(
+            self.handle_http, '127.0.0.1', 0, backlog=4096)
+        smtp = await asyncio.start_server(self.handle_smtp, '127.0.0.1', 0)
+        ssh = await asyncssh.create_server(
+            lambda: SimSshServer(self), '127.0.0.1', 0, backlog=4096,
+            server_host_keys=[asyncssh.generate_private_key('ssh-ed25519')],
+            process_factory=self.handle_ssh)
+        sidecar = await websockets.serve(self.handle_sidecar, '127.0.0.1', 0)
+        conn.send(dict(
+            http=f"127.0.0.1:{http.sockets[0].getsockname()[1]}",
+            smtp=f"127.0.0.1:{smtp.sockets[0].getsockname()[1]}",
+            ssh=ssh.get_port(),
+            sidecar=f"ws://127.0.0.1:{sidecar.sockets[0].getsockname()[1]}/"))
+        await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+        conn.send(dict(self.stats, cpu=time.process_time()))
+        for server in (http, smtp, ssh, sidecar):
+            server.close()
+
+
+def run_testbed(conn, nb_nodes, kwds):
+    raise_file_limit()
+    asyncio.run(SimTestbed(nb_nodes, **kwds).serve(conn))
+
+
+def raise_file_limit():
+    # each node may hold a couple of sockets at the same time
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+##########
+# the nightly side
+class SimSelector:
+    def __init__(self, nb_nodes):
+        self.ids = range(1, nb_nodes+1)
+
+    def node_names(self):
+        return [f"fit{node_id:02}" for node_id in self.ids]
+
+    def cmc_names(self):
+        return [f"reboot{node_id:02}" for node_id in self.ids]
+
+
+class SimNode(Node):
+    """
+    rhubarbe builds the CMC urls as http://<cmc_name>/<verb>,
+    so pointing cmc_name to the fake CMCs is all it takes;
+    there is no inventory for the other names
+    """
+
+    def __init__(self, cmc_base, cmc_name, message_bus):
+        super().__init__(cmc_name, message_bus)
+        self.cmc_name = f"{cmc_base}/cmc/{self.id}"
+
+    def control_hostname(self):
+        return f"fit{self.id:02}"
+
+    def control_ip_address(self):
+        return f"10.{self.id // 256}.{self.id % 256}.1"
+
+    def control_mac_address(self):
+        return f"02:00:00:00:{self.id // 256:02x}:{self.id % 256:02x}"
+
+
+class SimDisplay(NoProgressBarDisplay):
+    """
+    same as the nightly display, without the inventory lookups
+    """
+
+    def __init__(self, nodes, message_bus):
+        super().__init__(nodes, message_bus)
+        for rank, node in enumerate(nodes):
+            self._display_node_by_ip[node.control_ip_address()] = \
+                DisplayNode(node.control_hostname(), rank)
+
+
+class SimCohortLoader(CohortLoader):
+    """
+    the nightly loader, where frisbee is simulated: a node's client
+    gets its image at the pace of the session, unless the node is a
+    slow receiver; as long as slow receivers are around, the whole
+    session is slowed down by their retransmission requests;
+    concurrent sessions share the capacity of the network
+    """
+
+    def __init__(self, nightly, nodes, actual_image, **kwds):
+        super().__init__(nodes, actual_image, nightly.bandwidth, nightly.bus,
+                         nightly.display, progress=nightly.display.progress,
+                         period=nightly.straggler_period, **kwds)
+        self.nightly = nightly
+        self.image_name = Path(actual_image).stem
+        # the ids of the slow receivers that are still running
+        self.slow = set()
+
+    def share(self):
+        """
+        the share of what gets sent that makes it through
+        """
+        offered = sum(loader.bandwidth for loader in self.nightly.loading)
+        return min(1., self.nightly.capacity / offered)
+
+    async def stage2(self, reset):
+        self.nightly.loading.add(self)
+        self.resent = 0.
+        try:
+            return await super().stage2(reset)
+        finally:
+            self.nightly.loading.discard(self)
+
+    async def authorized(self):
+        # the simulated leases are for nightly.py
+        return True
+
+    async def stage1(self):
+        await asyncio.gather(*(node.ensure_reset() for node in self.nodes))
+
+    async def start_frisbeed(self):
+        return '127.0.0.1', 0
+
+    async def cmc(self, node, verb):
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://{node.cmc_name}/{verb}") as response:
+                return await response.text()
+
+    async def run_node(self, node, ipaddr, port, reset):
+        nightly = self.nightly
+        duration = IMAGE_SIZE * 8 / (self.bandwidth * 2**20) * nightly.time_scale
+        slowness = float(await self.cmc(node, "frisbee-start"))
+        if not slowness:
+            return False
+        if slowness > 1:
+            self.slow.add(node.id)
+        done, step = 0., duration / FRISBEE_STEPS
+        try:
+            while done < 1.:
+                await asyncio.sleep(step)
+                drag = SLOW_DRAG if self.slow - {node.id} else 1.
+                # over capacity, the lost share gets sent again,
+                # which costs more than it gains
+                share = self.share()
+                self.resent = max(self.resent, 1 - share)
+                done += step * share * share / (duration * slowness * drag)
+                await node.feedback('percent', min(100, int(100 * done)))
+        finally:
+            self.slow.discard(node.id)
+        return await self.cmc(node, f"frisbee-done?image={self.image_name}") == 'ok'
+
+    def nextboot_cleanup(self):
+        pass
+
+
+class LoopMonitor:
+    """
+    how late the event loop is when waking up a sleeping task
+    """
+
+    def __init__(self, interval=LAG_INTERVAL):
+        self.interval = interval
+        # (wall-clock time, lag)
+        self.samples = []
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            before = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(
+                (time.time(), loop.time() - before - self.interval))
+
+
+def resources():
+    """
+    wall-clock, CPU, peak memory in MiB
+    """
+    return (time.perf_counter(), time.process_time(),
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+class SimNightly(Nightly):
+    """
+    a Nightly against a SimTestbed, that keeps track of
+    what it costs, per stage and per phase
+    """
+
+    display_class = SimDisplay
+
+    def __init__(self, nb_nodes, endpoints, *, time_scale,
+                 capacity=CAPACITY, **kwds):
+        self.endpoints = endpoints
+        self.time_scale = time_scale
+        self.capacity = capacity
+        # the loaders that are running, see SimCohortLoader.share()
+        self.loading = set()
+        super().__init__(SimSelector(nb_nodes),
+                         node_factory=partial(SimNode, endpoints['http']), **kwds)
+        self.sidecar = SidecarPublisher(
+            endpoints['sidecar'], timeout=10, printer=self.print)
+        self.mailhost = endpoints['smtp']
+        self.check_delay *= time_scale
+        self.load_linger *= time_scale
+        self.straggler_period *= time_scale
+        self.backoff *= time_scale
+        # what gets measured
+        self.monitor = LoopMonitor()
+        # (stage that just ended, resources())
+        self.marks = []
+        # (phase, started, ended, is_ok)
+        self.spans = []
+
+    def mark(self, stage):
+        self.marks.append((stage, resources()))
+
+    def locate_image(self, image_name):
+        return f"/sim/images/{image_name}.ndz"
+
+    def make_loader(self, batch, actual_image, *, evict, on_done):
+        return SimCohortLoader(self, batch, actual_image,
+                               evict=evict and self.evict_stragglers,
+                               on_done=on_done)
+
+    async def ssh_connect(self, node, timeout):
+        # the fake server tells nodes apart from the username
+        return await asyncssh.connect(
+            '127.0.0.1', port=self.endpoints['ssh'],
+            username=node.control_hostname(), known_hosts=None,
+            client_keys=None, agent_path=None, connect_timeout=timeout)
+
+    async def net(self, node, verb, timeout):
+        url = f"http://{self.endpoints['http']}/net/{node.id}/{verb}"
+        try:
+            async with aiohttp.ClientSession(
+                    timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+                async with session.get(url) as response:
+                    return await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return ""
+
+    async def ping(self, node, timeout):
+        return await self.net(node, 'ping', timeout) == 'ok'
+
+    async def ssh_banner(self, node, timeout):
+        return await self.net(node, 'banner', timeout) or None
+
+    async def timed(self, node, phase, image, coro):
+        started = time.time()
+        is_ok = False
+        try:
+            is_ok = await super().timed(node, phase, image, coro)
+            return is_ok
+        finally:
+            self.spans.append((phase, started, time.time(), is_ok))
+
+    async def main(self):
+        monitor_task = asyncio.create_task(self.monitor.run())
+        self.mark(None)
+        try:
+            return await super().main()
+        finally:
+            self.mark('wrap-up')
+            monitor_task.cancel()
+
+    async def preflight(self):
+        self.mark('setup')
+        await super().preflight()
+        self.mark('pre-flight')
+
+    async def pipelines(self, power_modes, plan):
+        await super().pipelines(power_modes, plan)
+        self.mark('pipelines')
+
+    async def all_off(self):
+        await super().all_off()
+        self.mark('all-off')
+
+    def stages(self):
+        result = []
+        for (_, before), (stage, after) in zip(self.marks, self.marks[1:]):
+            result.append(dict(stage=stage, wall=after[0] - before[0],
+                               cpu=after[1] - before[1], maxrss=after[2]))
+        return result
+
+    def phases(self):
+        """
+        durations, and the event-loop lag while some node was in that phase
+        """
+        samples = self.monitor.samples
+        result = {}
+        for phase in dict.fromkeys(span[0] for span in self.spans):
+            spans = sorted(span[1:] for span in self.spans if span[0] == phase)
+            durations = sorted(ended - started for started, ended, _ in spans)
+            # merge the spans so that each sample is looked up once
+            starts, ends = [], []
+            for started, ended, _ in spans:
+                if ends and started <= ends[-1]:
+                    ends[-1] = max(ends[-1], ended)
+                else:
+                    starts.append(started)
+                    ends.append(ended)
+            lags = []
+            for timestamp, lag in samples:
+                index = bisect.bisect_right(starts, timestamp) - 1
+                if index >= 0 and timestamp <= ends[index]:
+                    lags.append(lag)
+            lags.sort()
+            result[phase] = dict(
+                nodes=len(spans), ok=sum(1 for *_, is_ok in spans if is_ok),
+                p50=percentile(durations, .5), p95=percentile(durations, .95),
+                max=durations[-1], span=max(ends) - min(starts),
+                lag_p99=percentile(lags, .99) or 0., lag_max=max(lags, default=0.))
+        return result
+
+    def metrics(self):
+        lags = sorted(lag for _, lag in self.monitor.samples)
+        (_, first), (_, last) = self.marks[0], self.marks[-1]
+        return dict(
+            nodes=len(self.nodes), tested=len(self.nodes) - len(self.skipped),
+            wall=last[0] - first[0], cpu=last[1] - first[1],
+            maxrss=last[2], failures=len(self.failures),
+            completed=len(self.completed), incomplete=len(self.incomplete()),
+            lag_p99=percentile(lags, .99) or 0., lag_max=max(lags, default=0.),
+            ssh=self.ssh.summary(), bandwidth=self.bandwidth,
+            stages=self.stages(), phases=self.phases())
+
+
+def simulate(nb_nodes, *, time_scale=.1, failure_rates=None, seed=0,
+             speedy=False, evict=True, cohorts=False, incremental=None,
+             capacity=CAPACITY, history=None, record=None,
+             timeline=None, metrics=None, status=None, verbose=False):
+    """
+    one simulated run; returns the metrics as a dict
+    history is the sqlite file, a fresh one if not specified
+    record, if set, is where to write a trace, see nightreplay.py
+    timeline and metrics are passed to the Nightly, see nighttrace.py
+    status is where to keep the live status, see nightstatus.py
+    """
+    failure_rates = failure_rates or dict(cmc=0., boot=0., load=0., slow=0.)
+    random.seed(seed)
+    raise_file_limit()
+    ours, theirs = multiprocessing.Pipe()
+    testbed = multiprocessing.Process(
+        target=run_testbed, args=(theirs, nb_nodes, dict(
+            time_scale=time_scale, failure_rates=failure_rates, seed=seed)))
+    testbed.start()
+    try:
+        endpoints = ours.recv()
+        # what nightly.py does to find its lease
+        proxy = R2labApiProxy(f"http://{endpoints['http']}/api")
+        lease = proxy.get_current_leases()[0]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            nightly_class, more = SimNightly, {}
+            if record:
+                nightly_class, more = recording(SimNightly), dict(record=record)
+            nightly = nightly_class(
+                nb_nodes, endpoints, time_scale=time_scale, capacity=capacity,
+                verbose=verbose, dry_run=False, speedy=speedy, cohorts=cohorts,
+                incremental=incremental, timeline=timeline, metrics=metrics,
+                status=status,
+                history=history or str(Path(tmpdir) / "history.sqlite"),
+                outbox=str(Path(tmpdir) / "outbox"), **more)
+            nightly.evict_stragglers = evict
+            nightly.run(lease)
+        ours.send('stats')
+        result = nightly.metrics()
+        result['testbed'] = ours.recv()
+        return result
+    finally:
+        testbed.join(timeout=10)
+        if testbed.is_alive():
+            testbed.terminate()
+
+
+def report(result):
+    """
+    the metrics as a human-readable text
+    """
+    lines = [
+        f"{result['nodes']} nodes: wall {result['wall']:.1f}s"
+        f" cpu {result['cpu']:.1f}s maxrss {result['maxrss']:.0f}MiB"
+        f" loop lag p99 {result['lag_p99']*1000:.1f}ms"
+        f" max {result['lag_max']*1000:.1f}ms",
+        f"  {result['completed']} completed, {result['failures']} failed,"
+        f" {result['incomplete']} incomplete, loads at {result['bandwidth']} Mibps",
+        f"  {result['ssh']}",
+        f"  {'stage':<10} {'wall':>8} {'cpu':>8} {'maxrss':>8}",
+    ]
+    for stage in result['stages']:
+        lines.append(f"  {stage['stage']:<10} {stage['wall']:>7.2f}s"
+                     f" {stage['cpu']:>7.2f}s {stage['maxrss']:>5.0f}MiB")
+    lines.append(f"  {'phase':<10} {'ok':>11} {'p50':>7} {'p95':>7} {'max':>7}"
+                 f" {'span':>7} {'lag-p99':>8} {'lag-max':>8}")
+    for phase, stats in result['phases'].items():
+        lines.append(
+            f"  {phase:<10} {stats['ok']:>5}/{stats['nodes']:<5}"
+            f" {stats['p50']:>6.2f}s {stats['p95']:>6.2f}s {stats['max']:>6.2f}s"
+            f" {stats['span']:>6.1f}s {stats['lag_p99']*1000:>6.1f}ms"
+            f" {stats['lag_max']*1000:>6.1f}ms")
+    testbed = result['testbed']
+    lines.append("  testbed: " + " ".join(
+        f"{key}={value:.1f}" if isinstance(value, float) else f"{key}={value}"
+        for key, value in testbed.items()))
+    return "\n".join(lines)
+
+
+def add_simulation_arguments(parser):
+    parser.add_argument("--time-scale", type=float, default=.1,
+                        help="multiplies simulated durations (%(default)s)")
+    parser.add_argument("--cmc-failures", type=float, default=.01,
+                        help="rate of nodes whose CMC won't answer (%(default)s)")
+    parser.add_argument("--boot-failures", type=float, default=.01,
+                        help="rate of nodes that won't boot (%(default)s)")
+    parser.add_argument("--load-failures", type=float, default=.01,
+                        help="rate of nodes that won't take an image (%(default)s)")
+    parser.add_argument("--slow-nodes", type=float, default=.02,
+                        help="rate of nodes that are slow receivers (%(default)s)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="for the failures and latencies (%(default)s)")
+    parser.add_argument("-s", "--speedy", action='store_true', default=False,
+                        help="only load one image")
+    parser.add_argument("--no-eviction", dest='evict', action='store_false',
+                        default=True, help="keep stragglers in their session")
+    parser.add_argument("-C", "--cohorts", action='store_true', default=False,
+                        help="one image per node and per run")
+    parser.add_argument("-I", "--incremental", metavar="DAYS", type=float,
+                        default=None, help="incremental runs, with that sweep"
+                        " period; not scaled, use e.g. .01 with --nights")
+    parser.add_argument("--capacity", type=int, default=CAPACITY,
+                        help="what the network can take, in Mibps (%(default)s)")
+
+
+def simulation_kwds(args):
+    return dict(time_scale=args.time_scale, seed=args.seed, speedy=args.speedy,
+                evict=args.evict, cohorts=args.cohorts,
+                incremental=args.incremental, capacity=args.capacity,
+                failure_rates=dict(cmc=args.cmc_failures, boot=args.boot_failures,
+                                   load=args.load_failures, slow=args.slow_nodes))
+
+
+def simulation_argv(args):
+    """
+    the options above, as a command line
+    """
+    return [
+        "--time-scale", str(args.time_scale), "--seed", str(args.seed),
+        "--cmc-failures", str(args.cmc_failures),
+        "--boot-failures", str(args.boot_failures),
+        "--load-failures", str(args.load_failures),
+        "--slow-nodes", str(args.slow_nodes),
+        "--capacity", str(args.capacity),
+    ] + (["--speedy"] if args.speedy else []) + (
+        ["--cohorts"] if args.cohorts else []) + (
+            [] if args.incremental is None
+            else ["--incremental", str(args.incremental)]) + (
+        [] if args.evict else ["--no-eviction"])
+
+
+def main():
+    parser = ArgumentParser(description=__doc__,
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--nodes", type=int, default=37,
+                        help="number of simulated nodes (%(default)s)")
+    parser.add_argument("-j", "--json", default=None,
+                        help="also store the metrics in that file")
+    parser.add_argument("--nights", type=int, default=1,
+                        help="consecutive runs that share one history (%(default)s)")
+    parser.add_argument("--record", metavar="TRACE", default=None,
+                        help="record the run for nightreplay.py; with --nights,"
+                        " the night number gets appended")
+    parser.add_argument("--timeline", metavar="FILE", default=None,
+                        help="write the run timing as a Chrome trace")
+    parser.add_argument("--metrics", metavar="FILE", default=None,
+                        help="write the run metrics as a Prometheus textfile")
+    parser.add_argument("--status", metavar="FILE", default=None,
+                        help="keep the live status of the run in that file")
+    parser.add_argument("-v", "--verbose", action='store_true', default=False)
+    add_simulation_arguments(parser)
+    args = parser.parse_args()
+
+    kwds = simulation_kwds(args)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        results = []
+        for night in range(args.nights):
+            # not the same failures every night
+            kwds['seed'] = args.seed + night
+            record = args.record
+            if record and args.nights > 1:
+                record += f".{night + 1}"
+            result = simulate(args.nodes, verbose=args.verbose, record=record,
+                              timeline=args.timeline, metrics=args.metrics,
+                              status=args.status,
+                              history=str(Path(tmpdir) / "history.sqlite"), **kwds)
+            results.append(result)
+            # the nightly output goes on stdout
+            print(report(result), file=sys.stderr)
+    if args.nights > 1:
+        print(f"{'night':>5} {'tested':>6} {'Mibps':>6} {'load-p50':>9}"
+              f" {'load-p95':>9} {'wall':>7}", file=sys.stderr)
+        for night, result in enumerate(results, 1):
+            load = result['phases'].get('load', {})
+            print(f"{night:>5} {result['tested']:>6} {result['bandwidth']:>6}"
+                  f" {load.get('p50') or 0:>8.2f}s {load.get('p95') or 0:>8.2f}s"
+                  f" {result['wall']:>6.1f}s", file=sys.stderr)
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results[0] if args.nights == 1 else results, output, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
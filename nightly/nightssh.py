@@ -0,0 +1,110 @@
+"""
+one ssh connection per node for the whole nightly run
+
+waiting for a node to come up and then checking its image used to
+cost two handshakes; here the connection that answers the wait is
+kept, and reused by whatever runs on the node afterwards
+
+a node that gets its image reloaded reboots, so its connection must
+be dropped beforehand; a connection that is found broken when used
+gets re-established once
+"""
+
+# pylint: disable=c0111
+
+import time
+import random
+import asyncio
+
+import asyncssh
+
+from nighthistory import percentile
+
+
+class SshPool:
+
+    def __init__(self, connect):
+        """
+        connect is a coroutine function (node, timeout) -> connection
+        """
+        self.connect = connect
+        # node_id -> asyncssh connection
+        self.connections = {}
+        # the durations of all successful handshakes
+        self.handshakes = []
+        self.failed = 0
+        self.reuses = 0
+        self.reconnects = 0
+
+    def __len__(self):
+        return len(self.connections)
+
+    async def _handshake(self, node, timeout):
+        started = time.monotonic()
+        try:
+            connection = await self.connect(node, timeout)
+        # connect_timeout fires as asyncio.TimeoutError from within asyncssh
+        # and ValueError has been seen as well
+        except (OSError, asyncssh.Error, asyncio.TimeoutError, ValueError):
+            self.failed += 1
+            return None
+        self.handshakes.append(time.monotonic() - started)
+        self.connections[node.id] = connection
+        return connection
+
+    async def wait(self, node, backoff, timeout):
+        """
+        wait until the node is ssh-reachable, and keep the connection;
+        timeout applies to each attempt, the caller sets the overall one
+        """
+        if node.id in self.connections:
+            self.reuses += 1
+            return
+        while await self._handshake(node, timeout) is None:
+            await asyncio.sleep((0.5 + random.random()) * backoff)
+
+    async def run(self, node, command, timeout):
+        """
+        returns an asyncssh SSHCompletedProcess; raises ConnectionError
+        if no connection can be established
+        """
+        connection = self.connections.get(node.id)
+        if connection is not None:
+            self.reuses += 1
+            try:
+                return await connection.run(command, check=False)
+            except (OSError, asyncssh.Error):
+                self.drop(node.id)
+                self.reconnects += 1
+        connection = await self._handshake(node, timeout)
+        if connection is None:
+            raise ConnectionError(f"cannot ssh into node {node.id}")
+        return await connection.run(command, check=False)
+
+    def drop(self, node_id):
+        """
+        forget about a node, e.g. because it is going to reboot
+        """
+        connection = self.connections.pop(node_id, None)
+        if connection is not None:
+            connection.close()
+
+    async def close(self):
+        connections = list(self.connections.values())
+        self.connections = {}
+        for connection in connections:
+            connection.close()
+        await asyncio.gather(
+            *(connection.wait_closed() for connection in connections),
+            return_exceptions=True)
+
+    def summary(self):
+        durations = sorted(self.handshakes)
+        if not durations:
+            return f"ssh: no handshake, {self.failed} failed attempt(s)"
+        return (f"ssh: {len(durations)} handshake(s)"
+                f" p50={percentile(durations, .5):.3f}s"
+                f" p95={percentile(durations, .95):.3f}s"
+                f" max={durations[-1]:.3f}s,"
+                f" {self.failed} failed attempt(s),"
+                f" {self.reuses} reuse(s), {self.reconnects} reconnect(s)")
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+"""
+a live status of the nightly run, for dashboards and the faraday.sh helpers
+
+while nightly runs, it keeps a table of where each node is at - phase,
+image, load progress, outcome - and writes it as a compact json snapshot
+in a well-known file; updates are only recorded in memory, and the
+snapshots are coalesced so that the file is written at most once per
+period, however many updates come in; a snapshot replaces the previous
+one atomically, so readers never see a half-written file
+
+the snapshot looks like
+    {"started": .., "updated": .., "running": true, "stage": "pipelines",
+     "counts": {"running": 12, "completed": 20, "failed": 2},
+     "nodes": {"1": {"state": "running", "phase": "load", "image": "ubuntu",
+                     "since": .., "percent": 40}, ...}}
+
+run as a script, this shows the current snapshot, see faraday.sh;
+nightly.py imports this on every hourly run, so keep it light
+"""
+
+# pylint: disable=c0111
+
+import os
+import json
+import time
+from argparse import ArgumentParser
+
+
+DEFAULT_STATUS = "/run/r2lab-nightly/status.json"
+
+# at most one snapshot per that many seconds
+STATUS_PERIOD = 1.
+
+
+class StatusBoard:
+    """
+    path may be None, in which case the table is kept but never written
+    """
+
+    def __init__(self, path=DEFAULT_STATUS, *, period=STATUS_PERIOD, printer=print):
+        self.path = path
+        self.period = period
+        self.printer = printer
+        self.started = time.time()
+        self.stage = None
+        self.running = True
+        # node_id -> dict of fields, see the module docstring
+        self.nodes = {}
+        # the pending write, if any, and when the last one happened
+        self.write_handle = None
+        self.written = 0.
+        # counters, for the record
+        self.updates = 0
+        self.writes = 0
+        self.failed = False
+
+    def update(self, node_id, **fields):
+        """
+        record a change in memory, the file gets written later on
+        """
+        self.nodes.setdefault(node_id, {}).update(fields)
+        self.write_soon()
+
+    def set_stage(self, stage):
+        self.stage = stage
+        self.write_soon()
+
+    def write_soon(self):
+        """
+        schedule a write, unless one is already pending; this is what
+        coalesces the updates, and bounds the rate of the writes
+        """
+        self.updates += 1
+        if self.write_handle is not None or self.path is None:
+            return
+        # pylint: disable=import-outside-toplevel
+        import asyncio
+        delay = max(0., self.written + self.period - time.time())
+        self.write_handle = asyncio.get_running_loop().call_later(delay, self.write)
+
+    def snapshot(self):
+        counts = {}
+        for fields in self.nodes.values():
+            state = fields.get('state')
+            counts[state] = counts.get(state, 0) + 1
+        return dict(started=self.started, updated=time.time(),
+                    running=self.running, stage=self.stage, period=self.period,
+                    counts=counts, nodes=self.nodes)
+
+    def write(self):
+        self.write_handle = None
+        self.written = time.time()
+        if self.path is None:
+            return
+        temporary = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(temporary, 'w') as output:
+                json.dump(self.snapshot(), output, separators=(',', ':'))
+            os.replace(temporary, self.path)
+            self.writes += 1
+        except OSError as exc:
+            # once is enough, this is no reason to disturb the run
+            if not self.failed:
+                self.printer(f"status: could not write {self.path}: {exc}")
+            self.failed = True
+
+    def close(self):
+        """
+        the run is over; write the final snapshot right away
+        """
+        if self.write_handle is not None:
+            self.write_handle.cancel()
+        self.running = False
+        self.stage = 'done'
+        self.write()
+
+    def summary(self):
+        return (f"status: {self.updates} update(s) in {self.writes}"
+                f" snapshot(s) of {self.path}")
+
+
+####################
+def show(snapshot, all_nodes):
+    now = time.time()
+    age = now - snapshot['updated']
+    if snapshot['running']:
+        header = (f"nightly running for {now - snapshot['started']:.0f}s,"
+                  f" stage {snapshot['stage']}")
+        # the run would not stay that long without a write
+        if age > 10 * snapshot['period'] + 60:
+            header += f" - no news for {age:.0f}s, is it still alive ?"
+    else:
+        header = (f"last nightly ended {age:.0f}s ago,"
+                  f" after {snapshot['updated'] - snapshot['started']:.0f}s")
+    counts = " ".join(f"{count} {state}"
+                      for state, count in sorted(snapshot['counts'].items()))
+    print(f"{header} - {len(snapshot['nodes'])} nodes: {counts}")
+    for node_id, fields in sorted(snapshot['nodes'].items(),
+                                  key=lambda item: int(item[0])):
+        if not all_nodes and fields.get('state') in ('completed', 'skipped'):
+            continue
+        line = f"{node_id:>4} {fields.get('state', '?'):>10}"
+        if fields.get('phase'):
+            line += f" {fields['phase']:>6}"
+        if fields.get('image'):
+            line += f" {fields['image']}"
+        if fields.get('percent') is not None and fields.get('phase') == 'load':
+            line += f" {fields['percent']}%"
+        if fields.get('since') and fields.get('state') == 'running':
+            line += f" for {now - fields['since']:.0f}s"
+        if fields.get('reason'):
+            line += f" - {fields['reason']}"
+        print(line)
+
+
+def main():
+    parser = ArgumentParser(description="show the status of the nightly run")
+    parser.add_argument("-f", "--file", default=DEFAULT_STATUS,
+                        help="the status file (default: %(default)s)")
+    parser.add_argument("-a", "--all", action='store_true', default=False,
+                        help="show all nodes, not just the ones of interest")
+    parser.add_argument("-w", "--watch", metavar="SECONDS", type=float,
+                        nargs='?', const=STATUS_PERIOD * 2, default=None,
+                        help="show again every so often, until ^C")
+    args = parser.parse_args()
+
+    while True:
+        try:
+            with open(args.file) as feed:
+                snapshot = json.load(feed)
+        except FileNotFoundError:
+            print(f"no nightly status in {args.file}")
+            return 1
+        if args.watch:
+            print("\033[H\033[J", end='')
+        show(snapshot, args.all)
+        if not args.watch:
+            return 0
+        try:
+            time.sleep(args.watch)
+        except KeyboardInterrupt:
+            return 0
+
+
+if __name__ == '__main__':
+    exit(main())
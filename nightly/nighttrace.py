@@ -0,0 +1,168 @@
+"""
+timing spans for a nightly run, and what they get exported to
+
+spans nest as run -> stage -> node phase -> operation; while the run
+goes, they are only appended as plain tuples, and they get written
+at the end of the run as
+
+(*) a trace in the Chrome trace event format, that chrome://tracing,
+    ui.perfetto.dev or speedscope can load; there is one track for the
+    run and its stages, one per node, and one per image session
+(*) a Prometheus textfile, for node_exporter's textfile collector:
+    per-phase latency summaries, stage durations, node counts;
+    this is written atomically, as the collector requires
+"""
+
+# pylint: disable=c0111
+
+import os
+import math
+import json
+import time
+from contextlib import contextmanager
+
+from nighthistory import percentile
+
+
+# the track for the run itself and its stages
+RUN = 'run'
+# the quantiles in the phase summaries
+QUANTILES = (.5, .95, .99)
+
+
+class Tracer:
+
+    def __init__(self):
+        self.origin = time.time()
+        # (name, category, track, started, ended, args)
+        # a track is RUN, a node id, or an image name
+        self.spans = []
+
+    def add(self, name, category, track,               # pylint: disable=r0913
+            started, ended, **args):
+        """
+        a span that was measured elsewhere, in time.time() seconds
+        """
+        self.spans.append((name, category, track, started, ended, args))
+
+    @contextmanager
+    def span(self, name, category='stage', track=RUN, **args):
+        started = time.time()
+        try:
+            yield args
+        finally:
+            self.spans.append((name, category, track, started, time.time(), args))
+
+    def durations(self, category):
+        """
+        name -> sorted durations, for the spans of that category
+        """
+        result = {}
+        for name, span_category, _, started, ended, _ in self.spans:
+            if span_category == category:
+                result.setdefault(name, []).append(ended - started)
+        for durations in result.values():
+            durations.sort()
+        return result
+
+    def chrome_trace(self):
+        """
+        as a dict, ready for json
+        """
+        tids = {RUN: 0}
+        events = []
+
+        def tid(track):
+            if track not in tids:
+                tids[track] = (track if isinstance(track, int)
+                               else 1000 + len(tids))
+                name = (f"node {track:02}" if isinstance(track, int)
+                        else f"load {track}")
+                events.append(dict(ph='M', name='thread_name', pid=1,
+                                   tid=tids[track], args=dict(name=name)))
+                events.append(dict(ph='M', name='thread_sort_index', pid=1,
+                                   tid=tids[track],
+                                   args=dict(sort_index=tids[track])))
+            return tids[track]
+
+        events.append(dict(ph='M', name='process_name', pid=1,
+                           args=dict(name='nightly')))
+        events.append(dict(ph='M', name='thread_name', pid=1, tid=0,
+                           args=dict(name='run')))
+        # parents first when they start at the same time
+        for name, category, track, started, ended, args in sorted(
+                self.spans, key=lambda span: (span[3], span[3] - span[4])):
+            events.append(dict(
+                ph='X', name=name, cat=category, pid=1, tid=tid(track),
+                ts=round((started - self.origin) * 1e6),
+                dur=round((ended - started) * 1e6),
+                args={key: value for key, value in args.items()
+                      if value is not None}))
+        return dict(traceEvents=events, displayTimeUnit='ms',
+                    otherData=dict(started=time.strftime(
+                        "%Y-%m-%d@%H:%M:%S", time.localtime(self.origin))))
+
+    def write_chrome_trace(self, path):
+        with open(path, 'w') as output:
+            json.dump(self.chrome_trace(), output)
+
+    def prometheus(self, gauges):
+        """
+        the textfile contents; gauges is a list of
+        (metric name, help, labels dict or None, value)
+        """
+        lines = []
+        described = set()
+
+        def sample(metric, labels, value):
+            labels = ",".join(f'{key}="{label}"'
+                              for key, label in (labels or {}).items())
+            # full precision, e.g. for epochs; and the way prometheus
+            # spells infinities and nan
+            value = float(value)
+            text = (repr(value) if math.isfinite(value)
+                    else 'NaN' if math.isnan(value)
+                    else '+Inf' if value > 0 else '-Inf')
+            lines.append(f"{metric}{{{labels}}} {text}" if labels
+                         else f"{metric} {text}")
+
+        def describe(metric, kind, text):
+            if metric not in described:
+                described.add(metric)
+                lines.append(f"# HELP {metric} {text}")
+                lines.append(f"# TYPE {metric} {kind}")
+
+        for metric, text, labels, value in gauges:
+            describe(metric, 'gauge', text)
+            sample(metric, labels, value)
+        for stage, durations in self.durations('stage').items():
+            describe("nightly_stage_duration_seconds", 'gauge',
+                     "how long each stage of the last run took")
+            sample("nightly_stage_duration_seconds", dict(stage=stage),
+                   sum(durations))
+        for phase, durations in self.durations('phase').items():
+            metric = "nightly_phase_duration_seconds"
+            describe(metric, 'summary',
+                     "per-node phase durations in the last run")
+            for quantile in QUANTILES:
+                sample(metric, dict(phase=phase, quantile=quantile),
+                       percentile(durations, quantile))
+            sample(f"{metric}_sum", dict(phase=phase), sum(durations))
+            sample(f"{metric}_count", dict(phase=phase), len(durations))
+        failed = {}
+        for name, category, _, _, _, args in self.spans:
+            if category == 'phase' and args.get('ok') is False:
+                failed[name] = failed.get(name, 0) + 1
+        for phase in self.durations('phase'):
+            describe("nightly_phase_failures", 'gauge',
+                     "how many nodes failed each phase in the last run")
+            sample("nightly_phase_failures", dict(phase=phase),
+                   failed.get(phase, 0))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, gauges):
+        # the collector must never see a half-written file
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'w') as output:
+            output.write(self.prometheus(gauges))
+        os.replace(temporary, path)
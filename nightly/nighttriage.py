@@ -0,0 +1,48 @@
+"""
+cheap network checks for the pre-flight triage of nodes
+
+the triage itself - see Nightly.preflight() - also asks each CMC for
+its status; these are the parts that go to the node itself: a ping
+on the control network, and reading the banner that sshd sends
+as soon as a TCP connection is accepted, without any handshake
+"""
+
+# pylint: disable=c0111
+
+import asyncio
+
+
+async def ping(address, timeout):
+    """
+    True if address answers one ping within timeout seconds
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "ping", "-c", "1", "-W", str(max(1, round(timeout))), address,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+    except OSError:
+        return False
+    try:
+        return await asyncio.wait_for(process.wait(), timeout=timeout + 1) == 0
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        return False
+
+
+async def ssh_banner(hostname, timeout, port=22):
+    """
+    the banner sent by sshd, e.g. 'SSH-2.0-OpenSSH_9.6', or None
+    """
+    writer = None
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(hostname, port), timeout=timeout)
+        line = await asyncio.wait_for(reader.readline(), timeout=timeout)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    finally:
+        if writer is not None:
+            writer.close()
+    banner = line.decode(errors='replace').strip()
+    return banner if banner.startswith("SSH-") else None
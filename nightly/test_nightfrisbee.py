@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+"""
+checks nightfrisbee.py against frisbee-sample.pcap, a small synthetic
+capture of two frisbee sessions:
+
+(*) port 7001, little-endian, ethernet with one 802.1Q-tagged frame:
+    2 receivers join; the server sends 32 blocks of chunk 0 and 16 of
+    chunk 1; receiver .1 asks again for 4 blocks of chunk 0, that get
+    resent; receiver .2 asks again, through a PREQUEST on its second
+    try, for 2 blocks of chunk 1 that it missed, and for block 40 that
+    was never sent yet; all 3 get sent; both receivers leave
+(*) port 7002, big-endian: 10 blocks, one of them sent twice
+(*) plus one UDP packet that is not frisbee
+
+blocks are captured on 256 bytes only, like FrisbeeCapture does
+
+    pytest test_nightfrisbee.py
+    test_nightfrisbee.py          # writes the sample again
+"""
+
+# pylint: disable=c0111
+
+import struct
+import socket
+from pathlib import Path
+
+from nightfrisbee import (
+    FrisbeeAnalyzer, FrisbeeSession, PcapStream, PKTTYPE_REQUEST, PKTTYPE_REPLY,
+    JOIN, LEAVE, BLOCK, REQUEST, PREQUEST, BLOCK_SIZE, CHUNK_BYTES, SNAPLEN)
+
+
+SAMPLE = Path(__file__).parent / "frisbee-sample.pcap"
+
+SERVER = "192.168.3.200"
+GROUP = "234.5.6.7"
+RECEIVER1, RECEIVER2 = "192.168.3.1", "192.168.3.2"
+
+
+def udp_frame(source, destination, port, payload, vlan=False):
+    """
+    an ethernet frame, checksums left to 0
+    """
+    udp = struct.pack("!HHHH", 7000, port, 8 + len(payload), 0) + payload
+    ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(udp), 0, 0, 1, 17, 0,
+                     socket.inet_aton(source), socket.inet_aton(destination))
+    tag = b'\x81\x00\x00\x05' if vlan else b''
+    return b'\x01\x00\x5e\x05\x06\x07' + b'\x02' * 6 + tag + b'\x08\x00' + ip + udp
+
+
+def frisbee(endian, kind, subtype, message):
+    return struct.pack(endian + "iiii", kind, subtype, len(message), 0) + message
+
+
+def prequest(chunk, retries, blocks):
+    """
+    the body of a PREQUEST: chunk, retries, and the map of the blocks
+    """
+    blockmap = bytearray(CHUNK_BYTES)
+    for number in blocks:
+        blockmap[number // 8] |= 1 << (number % 8)
+    return struct.pack("<ii", chunk, retries) + bytes(blockmap)
+
+
+def synthesize():
+    """
+    the bytes of the sample capture
+    """
+    frames = []
+
+    def block(port, chunk, number, endian="<", vlan=False):
+        message = struct.pack(endian + "ii", chunk, number) + bytes(BLOCK_SIZE)
+        frames.append(udp_frame(SERVER, GROUP, port, frisbee(
+            endian, PKTTYPE_REPLY, BLOCK, message), vlan))
+
+    def request(source, subtype, message):
+        frames.append(udp_frame(source, SERVER, 7001, frisbee(
+            "<", PKTTYPE_REQUEST, subtype, message)))
+
+    for receiver in RECEIVER1, RECEIVER2:
+        request(receiver, JOIN, struct.pack("<ii", 0, 0))
+    for number in range(32):
+        block(7001, 0, number, vlan=(number == 5))
+    for number in range(16):
+        block(7001, 1, number)
+    request(RECEIVER1, REQUEST, struct.pack("<iii", 0, 10, 4))
+    for number in range(10, 14):
+        block(7001, 0, number)
+    request(RECEIVER2, PREQUEST, prequest(1, 2, (0, 1, 40)))
+    for number in 0, 1, 40:
+        block(7001, 1, number)
+    for number in list(range(10)) + [3]:
+        block(7002, 0, number, endian=">")
+    frames.append(udp_frame(RECEIVER1, "192.168.3.100", 53, b'not frisbee'))
+    for receiver in RECEIVER1, RECEIVER2:
+        request(receiver, LEAVE, struct.pack("<ii", 0, 0))
+
+    # microsecond pcap, ethernet
+    result = [struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, SNAPLEN, 1)]
+    for index, frame in enumerate(frames):
+        captured = frame[:SNAPLEN]
+        result.append(struct.pack("<IIII", 1_800_000_000, index * 1000,
+                                  len(captured), len(frame)) + captured)
+    return b''.join(result)
+
+
+def check(sessions):
+    first, second = sessions
+    assert first['port'] == 7001 and first['group'] == GROUP
+    assert first['blocks'] == 32 + 16 + 4 + 3
+    assert first['distinct_blocks'] == 32 + 16 + 1
+    assert first['resent'] == 6 / 55
+    # block 40 had not been sent when asked for
+    assert first['loss'] == 6 / 49
+    # first block is frame 2, last one frame 58, 1ms apart
+    assert first['duration'] == 0.056
+    assert first['receivers'] == {
+        RECEIVER1: dict(requests=1, requested=4, joins=1, leaves=1),
+        RECEIVER2: dict(requests=1, requested=3, joins=1, leaves=1)}
+    assert second['port'] == 7002 and second['group'] == GROUP
+    assert second['blocks'] == 11 and second['distinct_blocks'] == 10
+    assert second['resent'] == 1 / 11 and second['loss'] == 0
+    assert second['receivers'] == {}
+
+
+def test_sample_is_up_to_date():
+    assert SAMPLE.read_bytes() == synthesize()
+
+
+def test_whole():
+    analyzer = FrisbeeAnalyzer()
+    analyzer.feed(SAMPLE.read_bytes())
+    check(analyzer.metrics())
+    assert analyzer.skipped == 1
+
+
+def test_chunks():
+    data = SAMPLE.read_bytes()
+    for size in 1, 7, 16, 24, 25, 271, 4096:
+        analyzer = FrisbeeAnalyzer()
+        for offset in range(0, len(data), size):
+            analyzer.feed(data[offset:offset + size])
+        check(analyzer.metrics())
+        assert analyzer.skipped == 1
+
+
+def test_prequest():
+    """
+    the map comes after the retries, and goes up to the last block
+    """
+    session = FrisbeeSession(None, 7001)
+    for number in 0, 1, 1020, 1023:
+        session.feed(0., b'server', 1024, "<", BLOCK, struct.pack("<ii", 3, number))
+    # that many retries would look like blocks 0 to 2 if read as the map
+    session.feed(1., b'rcvr', 152, "<", PREQUEST,
+                 prequest(3, 7, (1, 40, 1020, 1023)))
+    assert session.receivers[b'rcvr'][:2] == [1, 4]
+    # 40 had not been sent yet
+    assert session.lost == 3
+    # a PREQUEST cut short of its map is ignored
+    session.feed(2., b'rcvr', 148, "<", PREQUEST, prequest(3, 7, (1, ))[:-4])
+    assert session.receivers[b'rcvr'][:2] == [1, 4]
+
+
+def test_pcap_stream():
+    data = SAMPLE.read_bytes()
+    stream = PcapStream()
+    packets = [packet for offset in range(0, len(data), 100)
+               for packet in stream.feed(data[offset:offset + 100])]
+    assert len(packets) == 2 + 32 + 16 + 1 + 4 + 1 + 3 + 11 + 1 + 2
+    assert all(linktype == 1 and len(frame) <= SNAPLEN
+               for _, linktype, _, frame in packets)
+    # the block frames are truncated, their original length is not
+    assert max(original for _, _, original, _ in packets) > SNAPLEN
+    assert not stream.buffer
+
+
+if __name__ == '__main__':
+    SAMPLE.write_bytes(synthesize())
+    print(f"{SAMPLE}: {SAMPLE.stat().st_size} bytes")
@@ -398,6 +398,27 @@ function tcpdump-frisbee () {
     set +x
 }
 
+# same, but with throughput, retransmissions and per-node requests
+doc-admin frisbee-stats "analyze frisbee traffic on the control interface until ^C - or in a pcap file if given"
+function frisbee-stats () {
+    if [ -n "$1" ]; then
+        python3 /root/r2lab-embedded/nightly/nightfrisbee.py -v "$@"
+    else
+        python3 /root/r2lab-embedded/nightly/nightfrisbee.py -v --live $control_dev
+    fi
+}
+
+# where the nightly run is at, from the status file that it keeps up to date
+doc-admin nightly-status "show the nodes of interest in the current - or last - nightly run; -a for all nodes"
+function nightly-status () {
+    python3 /root/r2lab-embedded/nightly/nightstatus.py "$@"
+}
+
+doc-admin nightly-watch "same as nightly-status, refreshed every 2s until ^C"
+function nightly-watch () {
+    python3 /root/r2lab-embedded/nightly/nightstatus.py --watch 2 "$@"
+}
+
 ####################
 # prepare a node to boot on the standard pxe image - or another variant
 # *) 2 special forms are